@@ -0,0 +1,451 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+import datetime
+import hashlib
+import io
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from types import SimpleNamespace
+from urllib.parse import quote, unquote
+
+import botocore.client
+import botocore.exceptions
+import botocore.response
+
+from synthetic_tenant import syntheticAccountId, syntheticRegions
+
+# Access keys handed out by AssumeRole are this prefix followed by the Account ID
+assumedKeyPrefix = 'ASIABENCH'
+
+class AwsStub():
+    '''
+    In-process stand-in for the S3, SSM, STS, Organizations, EC2 and QuickSight calls report.py makes, in the spirit of moto. Every
+    botocore client call (from any Session, Region or thread) is answered locally instead of being sent to AWS. S3 objects
+    are kept on disk so they do not count towards the memory of the process being measured, EC2 Instances come from
+    a SyntheticTenant and QuickSight keeps just enough state to answer the create / describe / list calls and paging
+    '''
+    def __init__(self, tenant, storageDir, accountId=syntheticAccountId, latencyMs=0, quicksightUserCount=250):
+        self.tenant = tenant
+        self.storageDir = storageDir
+        self.accountId = accountId
+        self.latency = latencyMs / 1000
+        self.lock = threading.Lock()
+        self.conditionalLock = threading.Lock()
+        self.calls = Counter()
+        self.objects = {}
+        self.multipartUploads = {}
+        self.parameters = {}
+        self.quicksight = {}
+        self.quicksightUserCount = quicksightUserCount
+        self.originalMakeApiCall = None
+        os.makedirs(storageDir, exist_ok=True)
+        self.load_objects()
+
+    def install(self):
+        stub = self
+        self.originalMakeApiCall = botocore.client.BaseClient._make_api_call
+        def _make_api_call(client, operationName, apiParams):
+            # Emit the same before / after call events botocore does, so hooks registered on the client still see every call
+            eventSuffix = f'{client.meta.service_model.service_id.hyphenize()}.{operationName}'
+            operationModel = client.meta.service_model.operation_model(operationName)
+            context = {}
+            # botocore's own before-call handlers only look at the serialized request, an empty one keeps them happy
+            requestDict = {'url_path': '/', 'query_string': {}, 'method': 'POST', 'headers': {}, 'body': b'', 'url': '', 'context': context}
+            client.meta.events.emit(f'before-call.{eventSuffix}', model=operationModel, params=requestDict, request_signer=client._request_signer, context=context)
+            try:
+                response = stub.handle(client.meta.service_model.service_name, operationName, apiParams, client.meta.region_name, stub.get_client_account(client))
+            except botocore.exceptions.ClientError as e:
+                statusCode = e.response['ResponseMetadata']['HTTPStatusCode']
+                client.meta.events.emit(f'after-call.{eventSuffix}', http_response=SimpleNamespace(status_code=statusCode), parsed=e.response, model=operationModel, context=context)
+                raise e
+            except Exception as e:
+                client.meta.events.emit(f'after-call-error.{eventSuffix}', exception=e, context=context)
+                raise e
+            client.meta.events.emit(f'after-call.{eventSuffix}', http_response=SimpleNamespace(status_code=200), parsed=response, model=operationModel, context=context)
+
+            return response
+        botocore.client.BaseClient._make_api_call = _make_api_call
+
+        return self
+
+    def uninstall(self):
+        if self.originalMakeApiCall is not None:
+            botocore.client.BaseClient._make_api_call = self.originalMakeApiCall
+            self.originalMakeApiCall = None
+
+    def get_client_account(self, client):
+        # Clients built from AssumeRole credentials carry the Account in their access key, everything else is the home Account
+        credentials = client._request_signer._credentials
+        accessKey = credentials.access_key if credentials is not None else ''
+        if accessKey.startswith(assumedKeyPrefix):
+            return accessKey[len(assumedKeyPrefix):]
+
+        return self.accountId
+
+    def handle(self, serviceName, operationName, apiParams, regionName, accountId=None):
+        with self.lock:
+            self.calls[f'{serviceName}.{operationName}'] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        handler = getattr(self, f'{serviceName}_{operationName}', None)
+        if handler is None:
+            raise NotImplementedError(f'{serviceName}.{operationName} is not covered by the AWS stub')
+        # API parameters are always PascalCase, so the client's Region and Account can be passed alongside them
+        response = handler(regionName=regionName, accountId=accountId or self.accountId, **apiParams)
+        response.setdefault('ResponseMetadata', {'HTTPStatusCode': 200, 'RetryAttempts': 0})
+
+        return response
+
+    def client_error(self, code, operationName, statusCode=400, message=''):
+        return botocore.exceptions.ClientError(
+            {
+                'Error': {'Code': code, 'Message': message},
+                'ResponseMetadata': {'HTTPStatusCode': statusCode}
+            },
+            operationName
+        )
+
+    # STS
+    def sts_GetCallerIdentity(self, accountId, **kwargs):
+        return {'Account': accountId, 'Arn': f'arn:aws:iam::{accountId}:role/benchmark', 'UserId': 'benchmark'}
+
+    def sts_AssumeRole(self, RoleArn, RoleSessionName, DurationSeconds=3600, **kwargs):
+        targetAccountId = RoleArn.split(':')[4]
+        if targetAccountId not in self.tenant.accountIds:
+            raise self.client_error('AccessDenied', 'AssumeRole', 403, f'Not authorized to perform sts:AssumeRole on {RoleArn}')
+
+        return {
+            'Credentials': {
+                'AccessKeyId': f'{assumedKeyPrefix}{targetAccountId}',
+                'SecretAccessKey': 'benchmark',
+                'SessionToken': 'benchmark',
+                'Expiration': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=DurationSeconds)
+            },
+            'AssumedRoleUser': {'AssumedRoleId': f'AROA:{RoleSessionName}', 'Arn': f'{RoleArn}/{RoleSessionName}'}
+        }
+
+    # Organizations
+    def organizations_ListAccounts(self, **kwargs):
+        return {
+            'Accounts': [
+                {'Id': accountId, 'Name': f'benchmark-{accountId}', 'Status': 'ACTIVE'} for accountId in self.tenant.accountIds
+            ]
+        }
+
+    # SSM
+    def ssm_GetParameters(self, Names, **kwargs):
+        return {
+            'Parameters': [{'Name': name, 'Value': self.parameters.get(name, f'benchmark-{name}')} for name in Names],
+            'InvalidParameters': []
+        }
+
+    # EC2
+    def ec2_DescribeRegions(self, **kwargs):
+        return {
+            'Regions': [
+                {'RegionName': region, 'Endpoint': f'ec2.{region}.amazonaws.com', 'OptInStatus': 'opt-in-not-required'}
+                for region in syntheticRegions
+            ]
+        }
+
+    def ec2_DescribeInstances(self, regionName, accountId, NextToken=None, MaxResults=1000, Filters=None, **kwargs):
+        # Only the instance-id and instance-state-name filters report.py sends are understood
+        filterValues = {instanceFilter['Name']: instanceFilter['Values'] for instanceFilter in Filters or []}
+        states = filterValues.get('instance-state-name')
+        if 'instance-id' in filterValues:
+            return self.tenant.describe_instances_by_id(regionName, filterValues['instance-id'], accountId, states)
+        return self.tenant.describe_instances_page(regionName, NextToken, MaxResults, accountId, states)
+
+    # S3 - objects are files named after the quoted Key
+    def load_objects(self):
+        # Objects left in a reused storage directory by an earlier run are served again, like a bucket would
+        for fileName in os.listdir(self.storageDir):
+            bucket, _, key = unquote(fileName).partition('/')
+            with open(os.path.join(self.storageDir, fileName), 'rb') as f:
+                data = f.read()
+            self.objects[(bucket, key)] = {'ContentLength': len(data), 'ETag': f'"{hashlib.md5(data).hexdigest()}"'}
+
+    def object_path(self, bucket, key):
+        return os.path.join(self.storageDir, quote(f'{bucket}/{key}', safe=''))
+
+    def read_body(self, body):
+        if isinstance(body, (bytes, bytearray)):
+            return bytes(body)
+        if isinstance(body, str):
+            return body.encode('utf-8')
+
+        return body.read()
+
+    def store_object(self, bucket, key, data):
+        with open(self.object_path(bucket, key), 'wb') as f:
+            f.write(data)
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        with self.lock:
+            self.objects[(bucket, key)] = {'ContentLength': len(data), 'ETag': etag}
+
+        return etag
+
+    def get_object_meta(self, bucket, key, operationName):
+        with self.lock:
+            meta = self.objects.get((bucket, key))
+        if meta is None:
+            if operationName == 'HeadObject':
+                raise self.client_error('404', operationName, 404, 'Not Found')
+            raise self.client_error('NoSuchKey', operationName, 404, 'The specified key does not exist.')
+
+        return meta
+
+    def s3_PutObject(self, Bucket, Key, Body=b'', IfNoneMatch=None, IfMatch=None, **kwargs):
+        data = self.read_body(Body)
+        if IfNoneMatch is None and IfMatch is None:
+            return {'ETag': self.store_object(Bucket, Key, data)}
+        # Conditional writes are checked and stored in one step, like S3 does
+        with self.conditionalLock:
+            with self.lock:
+                meta = self.objects.get((Bucket, Key))
+            if IfNoneMatch == '*' and meta is not None:
+                raise self.client_error('PreconditionFailed', 'PutObject', 412, 'At least one of the pre-conditions you specified did not hold')
+            if IfMatch is not None:
+                if meta is None:
+                    raise self.client_error('NoSuchKey', 'PutObject', 404, 'The specified key does not exist.')
+                if meta['ETag'] != IfMatch:
+                    raise self.client_error('PreconditionFailed', 'PutObject', 412, 'At least one of the pre-conditions you specified did not hold')
+            return {'ETag': self.store_object(Bucket, Key, data)}
+
+    def s3_HeadObject(self, Bucket, Key, **kwargs):
+        meta = self.get_object_meta(Bucket, Key, 'HeadObject')
+
+        return {'ContentLength': meta['ContentLength'], 'ETag': meta['ETag']}
+
+    def s3_GetObject(self, Bucket, Key, Range=None, **kwargs):
+        meta = self.get_object_meta(Bucket, Key, 'GetObject')
+        with open(self.object_path(Bucket, Key), 'rb') as f:
+            data = f.read()
+        if Range:
+            start, end = Range.replace('bytes=', '').split('-')
+            data = data[int(start):int(end) + 1 if end else None]
+
+        return {
+            'Body': botocore.response.StreamingBody(io.BytesIO(data), len(data)),
+            'ContentLength': len(data),
+            'ETag': meta['ETag']
+        }
+
+    def s3_ListObjectsV2(self, Bucket, Prefix='', MaxKeys=1000, ContinuationToken=None, **kwargs):
+        with self.lock:
+            keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+            contents = [{'Key': key, 'Size': self.objects[(Bucket, key)]['ContentLength']} for key in keys]
+        start = int(ContinuationToken or 0)
+        response = {'Contents': contents[start:start + MaxKeys], 'KeyCount': len(contents[start:start + MaxKeys]), 'IsTruncated': False}
+        if start + MaxKeys < len(contents):
+            response.update({'IsTruncated': True, 'NextContinuationToken': str(start + MaxKeys)})
+
+        return response
+
+    def s3_DeleteObject(self, Bucket, Key, **kwargs):
+        self.s3_DeleteObjects(Bucket, {'Objects': [{'Key': Key}]})
+
+        return {}
+
+    def s3_DeleteObjects(self, Bucket, Delete, **kwargs):
+        for o in Delete['Objects']:
+            with self.lock:
+                meta = self.objects.pop((Bucket, o['Key']), None)
+            if meta is not None:
+                os.remove(self.object_path(Bucket, o['Key']))
+
+        return {'Deleted': [{'Key': o['Key']} for o in Delete['Objects']]}
+
+    def s3_CreateMultipartUpload(self, Bucket, Key, **kwargs):
+        uploadId = uuid.uuid4().hex
+        with self.lock:
+            self.multipartUploads[uploadId] = {}
+
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': uploadId}
+
+    def s3_UploadPart(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        data = self.read_body(Body)
+        partPath = self.object_path(Bucket, f'{Key}.{UploadId}.{PartNumber}')
+        with open(partPath, 'wb') as f:
+            f.write(data)
+        with self.lock:
+            self.multipartUploads[UploadId][PartNumber] = partPath
+
+        return {'ETag': f'"{hashlib.md5(data).hexdigest()}"'}
+
+    def s3_CompleteMultipartUpload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        with self.lock:
+            parts = self.multipartUploads.pop(UploadId)
+        data = bytearray()
+        for part in MultipartUpload['Parts']:
+            partPath = parts[part['PartNumber']]
+            with open(partPath, 'rb') as f:
+                data += f.read()
+            os.remove(partPath)
+
+        return {'Bucket': Bucket, 'Key': Key, 'ETag': self.store_object(Bucket, Key, bytes(data))}
+
+    def s3_AbortMultipartUpload(self, Bucket, Key, UploadId, **kwargs):
+        with self.lock:
+            parts = self.multipartUploads.pop(UploadId, {})
+        for partPath in parts.values():
+            os.remove(partPath)
+
+        return {}
+
+    # QuickSight - resources are keyed on their type and ID
+    def put_resource(self, resourceType, resourceId, resource, operationName):
+        with self.lock:
+            if (resourceType, resourceId) in self.quicksight:
+                raise self.client_error('ResourceExistsException', operationName, 409, f'{resourceType} {resourceId} already exists')
+            self.quicksight[(resourceType, resourceId)] = resource
+
+    def get_resource(self, resourceType, resourceId, operationName):
+        with self.lock:
+            resource = self.quicksight.get((resourceType, resourceId))
+        if resource is None:
+            raise self.client_error('ResourceNotFoundException', operationName, 404, f'{resourceType} {resourceId} not found')
+
+        return resource
+
+    def quicksight_CreateGroup(self, GroupName, AwsAccountId, Namespace, **kwargs):
+        group = {'Arn': f'arn:aws:quicksight:us-east-1:{AwsAccountId}:group/{Namespace}/{GroupName}', 'GroupName': GroupName, 'Members': set()}
+        self.put_resource('group', GroupName, group, 'CreateGroup')
+
+        return {'Group': {'Arn': group['Arn'], 'GroupName': GroupName}}
+
+    def quicksight_DescribeGroup(self, GroupName, **kwargs):
+        group = self.get_resource('group', GroupName, 'DescribeGroup')
+
+        return {'Group': {'Arn': group['Arn'], 'GroupName': GroupName}}
+
+    def get_page(self, items, itemsKey, MaxResults=100, NextToken=None):
+        # List calls hand out MaxResults items at a time, the NextToken is the position of the next page
+        start = int(NextToken or 0)
+        page = {itemsKey: items[start:start + MaxResults]}
+        if start + MaxResults < len(items):
+            page['NextToken'] = str(start + MaxResults)
+
+        return page
+
+    def quicksight_ListUsers(self, AwsAccountId, MaxResults=100, NextToken=None, **kwargs):
+        roles = ['ADMIN', 'AUTHOR', 'AUTHOR', 'READER']
+        users = [
+            {'UserName': f'user-{u}', 'Role': roles[u % len(roles)], 'Arn': f'arn:aws:quicksight:us-east-1:{AwsAccountId}:user/default/user-{u}'}
+            for u in range(self.quicksightUserCount)
+        ]
+
+        return self.get_page(users, 'UserList', MaxResults, NextToken)
+
+    def quicksight_ListGroupMemberships(self, GroupName, MaxResults=100, NextToken=None, **kwargs):
+        group = self.get_resource('group', GroupName, 'ListGroupMemberships')
+        with self.lock:
+            members = [{'MemberName': memberName} for memberName in sorted(group['Members'])]
+
+        return self.get_page(members, 'GroupMemberList', MaxResults, NextToken)
+
+    def quicksight_CreateGroupMembership(self, MemberName, GroupName, **kwargs):
+        group = self.get_resource('group', GroupName, 'CreateGroupMembership')
+        with self.lock:
+            group['Members'].add(MemberName)
+
+        return {'GroupMember': {'MemberName': MemberName}}
+
+    def quicksight_CreateDataSource(self, AwsAccountId, DataSourceId, regionName, **kwargs):
+        dataSource = dict(kwargs, DataSourceId=DataSourceId, Arn=f'arn:aws:quicksight:{regionName}:{AwsAccountId}:datasource/{DataSourceId}')
+        self.put_resource('dataSource', DataSourceId, dataSource, 'CreateDataSource')
+
+        return {'DataSourceId': DataSourceId, 'Arn': dataSource['Arn'], 'CreationStatus': 'CREATION_SUCCESSFUL'}
+
+    def quicksight_DescribeDataSource(self, DataSourceId, **kwargs):
+        dataSource = self.get_resource('dataSource', DataSourceId, 'DescribeDataSource')
+
+        return {'DataSource': {'DataSourceId': DataSourceId, 'Arn': dataSource['Arn'], 'Status': 'CREATION_SUCCESSFUL'}}
+
+    def list_resources(self, resourceType):
+        with self.lock:
+            return [resource for (storedType, _), resource in sorted(self.quicksight.items()) if storedType == resourceType]
+
+    def quicksight_ListDataSources(self, MaxResults=100, NextToken=None, **kwargs):
+        dataSources = [{'DataSourceId': d['DataSourceId'], 'Arn': d['Arn']} for d in self.list_resources('dataSource')]
+
+        return self.get_page(dataSources, 'DataSources', MaxResults, NextToken)
+
+    def quicksight_CreateDataSet(self, AwsAccountId, DataSetId, regionName, PhysicalTableMap, **kwargs):
+        for table in PhysicalTableMap.values():
+            self.get_resource('dataSource', table['S3Source']['DataSourceArn'].rsplit('/', 1)[1], 'CreateDataSet')
+        dataSet = {'DataSetId': DataSetId, 'Arn': f'arn:aws:quicksight:{regionName}:{AwsAccountId}:dataset/{DataSetId}', 'Ingestions': {}}
+        self.put_resource('dataSet', DataSetId, dataSet, 'CreateDataSet')
+        # Creating a SPICE Data Set starts its first ingestion
+        ingestionId = 'initial'
+        self.quicksight_CreateIngestion(DataSetId, ingestionId)
+
+        return {'DataSetId': DataSetId, 'Arn': dataSet['Arn'], 'IngestionId': ingestionId, 'Status': 201}
+
+    def quicksight_ListDataSets(self, MaxResults=100, NextToken=None, **kwargs):
+        dataSets = [{'DataSetId': d['DataSetId'], 'Arn': d['Arn']} for d in self.list_resources('dataSet')]
+
+        return self.get_page(dataSets, 'DataSetSummaries', MaxResults, NextToken)
+
+    def quicksight_CreateIngestion(self, DataSetId, IngestionId, IngestionType='FULL_REFRESH', **kwargs):
+        dataSet = self.get_resource('dataSet', DataSetId, 'CreateIngestion')
+        with self.lock:
+            if IngestionId in dataSet['Ingestions']:
+                raise self.client_error('ResourceExistsException', 'CreateIngestion', 409, f'Ingestion {IngestionId} already exists')
+            dataSet['Ingestions'][IngestionId] = {'IngestionId': IngestionId, 'IngestionType': IngestionType, 'StartedAt': time.time()}
+
+        return {'IngestionId': IngestionId, 'IngestionStatus': 'INITIALIZED'}
+
+    def quicksight_DescribeIngestion(self, DataSetId, IngestionId, **kwargs):
+        dataSet = self.get_resource('dataSet', DataSetId, 'DescribeIngestion')
+        with self.lock:
+            ingestion = dataSet['Ingestions'].get(IngestionId)
+        if ingestion is None:
+            raise self.client_error('ResourceNotFoundException', 'DescribeIngestion', 404, f'Ingestion {IngestionId} not found')
+        # Ingestions finish as soon as they are looked at, the benchmark is not about how fast SPICE is
+        return {
+            'Ingestion': {
+                'IngestionId': IngestionId,
+                'IngestionStatus': 'COMPLETED',
+                'IngestionTimeInSeconds': round(time.time() - ingestion['StartedAt'])
+            }
+        }
+
+    def quicksight_ListIngestions(self, DataSetId, MaxResults=100, NextToken=None, **kwargs):
+        dataSet = self.get_resource('dataSet', DataSetId, 'ListIngestions')
+        with self.lock:
+            ingestions = sorted(dataSet['Ingestions'].values(), key=lambda ingestion: ingestion['StartedAt'], reverse=True)
+        ingestions = [
+            {
+                'IngestionId': ingestion['IngestionId'],
+                'IngestionStatus': 'COMPLETED',
+                'CreatedTime': datetime.datetime.fromtimestamp(ingestion['StartedAt'], datetime.timezone.utc)
+            } for ingestion in ingestions
+        ]
+
+        return self.get_page(ingestions, 'Ingestions', MaxResults, NextToken)
+
+    def get_stored_bytes(self):
+        with self.lock:
+            return sum(meta['ContentLength'] for meta in self.objects.values())
@@ -0,0 +1,117 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import time
+
+def load_report():
+    '''
+    Imports report.py - AWS clients and Environment Variables are only touched once a stage runs, so only the pure
+    serialization helpers are exercised
+    '''
+    reportPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'report.py')
+    spec = importlib.util.spec_from_file_location('report', reportPath)
+    report = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(report)
+
+    return report
+
+class CountingWriter():
+    '''
+    Binary file-like sink which only counts the bytes written to it
+    '''
+    def __init__(self):
+        self.bytesWritten = 0
+
+    def write(self, data):
+        self.bytesWritten += len(data)
+
+    def flush(self):
+        pass
+
+def generate_vulns(recordCount, distinctCves=2000, seed=42):
+    '''
+    Generates shaped processed_machine_vulns records - every CVE is repeated across many Machines just like a real fleet
+    '''
+    rng = random.Random(seed)
+    words = ['remote', 'code', 'execution', 'vulnerability', 'kernel', 'privilege', 'escalation', 'memory', 'corruption',
+             'attacker', 'crafted', 'request', 'buffer', 'overflow', 'denial', 'service', 'information', 'disclosure']
+    catalog = []
+    for c in range(distinctCves):
+        cveId = f'CVE-20{rng.randint(10, 23)}-{rng.randint(1000, 49999)}'
+        catalog.append(
+            {
+                'id': cveId,
+                'name': cveId,
+                'description': ' '.join(rng.choice(words) for _ in range(rng.randint(20, 60))),
+                'severity': rng.choice(['Low', 'Medium', 'High', 'Critical']),
+                'cvssV3': round(rng.uniform(1, 10), 1),
+                'exposedMachines': rng.randint(1, 5000),
+                'publishedOn': '2021-06-08T00:00:00Z',
+                'updatedOn': '2022-01-11T00:00:00Z',
+                'publicExploit': rng.random() < 0.3,
+                'exploitVerified': rng.random() < 0.1,
+                'exploitInKit': rng.random() < 0.05,
+                'exploitTypes': rng.choice(['None', 'Remote', 'Local', 'PrivilegeEscalation']),
+                'exploitUris': rng.choice(['None', 'https://www.exploit-db.com/exploits/50000']),
+                'cveInformation': f'https://cve.mitre.org/cgi-bin/cvename.cgi?name={cveId}'
+            }
+        )
+    records = []
+    for r in range(recordCount):
+        record = dict(rng.choice(catalog))
+        record['vuln_MachineId'] = f'{rng.getrandbits(160):040x}'
+        records.append(record)
+
+    return records
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares bytes written and serialization time of the report.py output formats')
+    parser.add_argument('--records', type=int, default=100000, help='Number of synthetic vulnerability records')
+    args = parser.parse_args()
+
+    report = load_report()
+    records = generate_vulns(args.records)
+    fileName = 'processed_machine_vulns'
+    results = []
+
+    # The original output, a single indented JSON document
+    startTime = time.perf_counter()
+    legacyBytes = len(json.dumps(records, indent=4, default=str).encode('utf-8'))
+    results.append(('json (indent=4)', legacyBytes, time.perf_counter() - startTime))
+
+    for outputFormat in report.outputFormats:
+        writer = CountingWriter()
+        startTime = time.perf_counter()
+        report.write_records(iter(records), writer, fileName, outputFormat)
+        results.append((outputFormat, writer.bytesWritten, time.perf_counter() - startTime))
+
+    print(f'{args.records} {fileName} records')
+    print(f'{"format":<18}{"bytes":>14}{"vs legacy":>12}{"seconds":>10}{"records/sec":>14}')
+    for outputFormat, byteCount, elapsed in results:
+        print(f'{outputFormat:<18}{byteCount:>14}{byteCount / legacyBytes:>11.1%}{elapsed:>10.2f}{args.records / elapsed:>14.0f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+import argparse
+import contextlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import traceback
+from collections import Counter
+
+import requests
+
+import mde_stub
+from aws_stub import AwsStub
+from synthetic_tenant import SyntheticTenant
+
+# report.py functions timed as stages - the stages run concurrently so their times add up to more than the wall time
+timedStages = {
+    'ec2': 'get_ec2_metadata',
+    'machines': 'get_machines',
+    'vulns': 'get_machine_vulns',
+    'quicksight_group': 'setup_quicksight_group',
+    'pipeline': 'send_to_quicksight'
+}
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peakRss = peakRss / 1024
+
+    return round(peakRss / 1024, 1)
+
+def start_mde_stub(tenantArgs, serverArgs):
+    '''
+    Runs the MDE stub in its own process so serving the synthetic tenant does not count towards the measured process
+    '''
+    readyQueue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=mde_stub.serve, args=(tenantArgs, serverArgs, readyQueue), daemon=True)
+    process.start()
+    port = readyQueue.get(timeout=300)
+
+    return process, f'http://127.0.0.1:{port}'
+
+def load_report(stubUrl, bucketName):
+    '''
+    Points report.py at the local stubs through its Environment Variables and imports it. Tuning Environment Variables
+    which are already set are left alone so any configuration can be benchmarked
+    '''
+    for envVar in ('AZURE_APP_TENANT_ID_PARAM', 'AZURE_APP_CLIENT_ID_PARAM', 'AZURE_APP_SECRET_ID_PARAM'):
+        os.environ.setdefault(envVar, envVar.lower())
+    os.environ['QUICKSIGHT_S3_BUCKET_NAME'] = bucketName
+    os.environ['MDE_API_URL'] = stubUrl
+    os.environ['MDE_LOGIN_URL'] = stubUrl
+    # The stub has no quota, the throttle rate decides how often it pushes back
+    os.environ.setdefault('MDE_API_CALLS_PER_MINUTE', '1000000')
+    os.environ.setdefault('MDE_API_CALLS_PER_HOUR', '0')
+    os.environ.setdefault('MDE_HUNTING_CALLS_PER_MINUTE', '1000000')
+    os.environ.setdefault('MDE_HUNTING_CALLS_PER_HOUR', '0')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+    reportPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'report.py')
+    spec = importlib.util.spec_from_file_location('report', reportPath)
+    report = importlib.util.module_from_spec(spec)
+    # Registered under its name so the worker processes of the partitioned output can find its functions
+    sys.modules['report'] = report
+    spec.loader.exec_module(report)
+
+    return report
+
+def instrument_report(report, stageTimes, datasetRecords):
+    '''
+    Wraps the stage functions to time them and DatasetSink.close() (and its partitioned counterpart) to count the records of every dataset. report.py
+    looks these up as module globals when it runs, so replacing the attributes is enough
+    '''
+    def timed(stageName, func):
+        def wrapper(*args, **kwargs):
+            startTime = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stageTimes[stageName] = time.perf_counter() - startTime
+        return wrapper
+
+    for stageName, funcName in timedStages.items():
+        setattr(report, funcName, timed(stageName, getattr(report, funcName)))
+
+    originalWaitForUploads = report.S3Publisher.wait_for_uploads
+    report.S3Publisher.wait_for_uploads = timed('publish', originalWaitForUploads)
+
+    def counted(originalClose):
+        def counted_close(sink):
+            recordCount = originalClose(sink)
+            datasetRecords[sink.fileName] = recordCount
+            return recordCount
+        return counted_close
+    report.DatasetSink.close = counted(report.DatasetSink.close)
+    report.PartitionedDatasetSink.close = counted(report.PartitionedDatasetSink.close)
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs report.py end to end against a synthetic MDE tenant and AWS account')
+    parser.add_argument('--machines', type=int, default=1000, help='Number of synthetic MDE Machines (1k to 100k)')
+    parser.add_argument('--vulns-per-machine', type=int, default=20, help='Average number of vulnerabilities per Machine')
+    parser.add_argument('--cves', type=int, default=5000, help='Number of distinct CVEs in the vulnerability catalog')
+    parser.add_argument('--ec2-ratio', type=float, default=0.8, help='Share of the Machines which are EC2 Instances')
+    parser.add_argument('--regions', type=int, default=4, help='Number of AWS Regions holding EC2 Instances')
+    parser.add_argument('--accounts', type=int, default=1, help='Number of AWS Accounts holding EC2 Instances, more than one runs report.py in organization mode')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Latency added to every MDE API request')
+    parser.add_argument('--aws-latency-ms', type=float, default=0, help='Latency added to every AWS API call')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of MDE API requests answered with a 429')
+    parser.add_argument('--hunting-max-rows', type=int, default=mde_stub.mdeHuntingMaxRows, help='Most rows the stub returns for one Advanced Hunting query')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Also write the results as JSON to this path')
+    parser.add_argument('--event', action='append', default=[], help='EventBridge (or SQS batch) event JSON file handed to report.lambda_handler after the full scan, can be repeated')
+    parser.add_argument('--s3-dir', help='Directory holding the S3 objects of the AWS stub, reuse it so the publish state and the EC2 Region activity index carry over to the next run')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of report.py')
+    args = parser.parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    args.event = [os.path.abspath(eventFile) for eventFile in args.event]
+
+    tenantArgs = {
+        'machineCount': args.machines,
+        'vulnsPerMachine': args.vulns_per_machine,
+        'cveCount': args.cves,
+        'ec2Ratio': args.ec2_ratio,
+        'regionCount': args.regions,
+        'accountCount': args.accounts,
+        'seed': args.seed
+    }
+    print(f'Generating a synthetic tenant with {args.machines} machines and starting the MDE stub')
+    stubProcess, stubUrl = start_mde_stub(
+        tenantArgs,
+        {'latencyMs': args.latency_ms, 'throttleRate': args.throttle_rate, 'huntingMaxRows': args.hunting_max_rows, 'seed': args.seed}
+    )
+    os.environ.setdefault('MDE_HUNTING_MAX_ROWS', str(args.hunting_max_rows))
+
+    if args.accounts > 1:
+        os.environ.setdefault('ORGANIZATION_MODE', 'true')
+    workDir = tempfile.mkdtemp(prefix='mde-bench-')
+    s3Dir = os.path.abspath(args.s3_dir) if args.s3_dir else os.path.join(workDir, 's3')
+    awsStub = AwsStub(SyntheticTenant(**tenantArgs), s3Dir, latencyMs=args.aws_latency_ms).install()
+    report = load_report(stubUrl, 'mde-benchmark')
+    stageTimes = {}
+    datasetRecords = {}
+    instrument_report(report, stageTimes, datasetRecords)
+
+    baselineRss = get_peak_rss_mb()
+    error = None
+    # report.py writes its local files into the working directory
+    os.chdir(workDir)
+    startCpu = time.process_time()
+    startTime = time.perf_counter()
+    try:
+        with open(os.path.join(workDir, 'report.log'), 'w') as logFile:
+            with contextlib.redirect_stdout(sys.stdout if args.verbose else logFile):
+                report.send_to_quicksight()
+    except Exception as e:
+        error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+        if args.verbose:
+            traceback.print_exc()
+    wallTime = time.perf_counter() - startTime
+    cpuTime = time.process_time() - startCpu
+
+    # The change events patch what the full scan published, like the Lambda function would between two scans
+    eventResults = []
+    for eventFile in args.event if error is None else []:
+        with open(eventFile) as f:
+            event = json.load(f)
+        awsCalls = sum(awsStub.calls.values())
+        eventStart = time.perf_counter()
+        with open(os.path.join(workDir, 'report.log'), 'a') as logFile:
+            with contextlib.redirect_stdout(sys.stdout if args.verbose else logFile):
+                summary = report.lambda_handler(event)
+        eventResults.append({
+            'event': os.path.basename(eventFile),
+            'wallSeconds': round(time.perf_counter() - eventStart, 3),
+            'awsApiCalls': sum(awsStub.calls.values()) - awsCalls,
+            'patchedDatasets': summary['patchedDatasets']
+        })
+
+    stubStats = requests.get(f'{stubUrl}/_stats').json()
+    stubProcess.terminate()
+    awsStub.uninstall()
+
+    recordCount = sum(datasetRecords.values())
+    results = {
+        'machines': args.machines,
+        'accounts': args.accounts,
+        'latencyMs': args.latency_ms,
+        'throttleRate': args.throttle_rate,
+        'error': error,
+        'wallSeconds': round(wallTime, 3),
+        'cpuSeconds': round(cpuTime, 3),
+        'records': recordCount,
+        'recordsPerSecond': round(recordCount / wallTime, 1),
+        'datasetRecords': datasetRecords,
+        'stageSeconds': {stageName: round(seconds, 3) for stageName, seconds in stageTimes.items()},
+        'mdeApiCalls': stubStats['calls'],
+        'mdeThrottled': stubStats['throttled'],
+        'mdeBytesReceived': stubStats['bytesSent'],
+        'mdeNotModified': stubStats['notModified'],
+        'mdeClientStats': report.mdeClient.get_stats() if report.mdeClient is not None else {},
+        'responseCache': report.responseCache.get_stats() if report.responseCache is not None else {},
+        'awsApiCalls': dict(sorted(awsStub.calls.items())),
+        's3BytesStored': awsStub.get_stored_bytes(),
+        'baselineRssMb': baselineRss,
+        'peakRssMb': get_peak_rss_mb(),
+        # The metrics report.py collected about itself, as written to its metrics file
+        'reportMetrics': report.runMetrics.to_dict(),
+        'events': eventResults
+    }
+
+    print(f'\n{args.machines} machines, {args.latency_ms} ms MDE latency, {args.throttle_rate:.0%} throttled. Work directory: {workDir}')
+    if error:
+        print(f'FAILED: {error}')
+    print(f'Wall time:        {results["wallSeconds"]} seconds ({results["cpuSeconds"]} seconds of CPU)')
+    print(f'Records:          {recordCount} ({results["recordsPerSecond"]} records/sec)')
+    for fileName, count in sorted(datasetRecords.items()):
+        print(f'  {fileName:<28}{count:>10}')
+    print('Stage time (seconds, stages overlap):')
+    for stageName, seconds in results['stageSeconds'].items():
+        print(f'  {stageName:<28}{seconds:>10.2f}')
+    print(f'MDE API calls:    {sum(Counter(stubStats["calls"]).values())} ({sum(Counter(stubStats["throttled"]).values())} throttled)')
+    for route, count in sorted(stubStats['calls'].items()):
+        print(f'  {route:<28}{count:>10}{stubStats["bytesSent"].get(route, 0):>14} bytes')
+    if results['mdeClientStats']:
+        clientStats = results['mdeClientStats']
+        print(f'  retries {clientStats["retries"]}, {clientStats["throttledSeconds"]} s throttled, {clientStats["backoffSeconds"]} s backing off, {clientStats["rateLimitWaitSeconds"]} s waiting on the rate limiter')
+    if sum(stubStats['notModified'].values()):
+        print(f'  {sum(stubStats["notModified"].values())} answered 304 Not Modified')
+    if results['responseCache']:
+        print(f'Response cache:   {results["responseCache"]}')
+    print(f'AWS API calls:    {sum(awsStub.calls.values())}')
+    for operation, count in results['awsApiCalls'].items():
+        print(f'  {operation:<40}{count:>10}')
+    print(f'S3 bytes stored:  {results["s3BytesStored"]}')
+    print(f'Peak RSS:         {results["peakRssMb"]} MB (baseline {baselineRss} MB before the run)')
+    for eventResult in eventResults:
+        print(f'Event {eventResult["event"]}: {eventResult["wallSeconds"]} seconds, {eventResult["awsApiCalls"]} AWS API calls, patched {", ".join(eventResult["patchedDatasets"]) or "nothing"}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if error:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
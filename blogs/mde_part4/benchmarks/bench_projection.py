@@ -0,0 +1,116 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+import argparse
+import random
+import time
+
+from bench_formats import CountingWriter, load_report
+from synthetic_tenant import SyntheticTenant
+
+def legacy_process_machine_vuln(v, machineId):
+    '''
+    The hand written per-record shaping report.py used before the projection specs, kept here as the baseline
+    '''
+    if v['exploitTypes']:
+        exploitTypes = str(v['exploitTypes'][0])
+        del v['exploitTypes']
+        v['exploitTypes'] = exploitTypes
+    else:
+        exploitTypes = 'None'
+        del v['exploitTypes']
+        v['exploitTypes'] = exploitTypes
+    if v['exploitUris']:
+        exploitUris = str(v['exploitUris'][0])
+        del v['exploitUris']
+        v['exploitUris'] = exploitUris
+    else:
+        exploitUris = 'None'
+        del v['exploitUris']
+        v['exploitUris'] = exploitUris
+    vulnId = str(v['id'])
+    cveUrl = f'https://cve.mitre.org/cgi-bin/cvename.cgi?name={vulnId}'
+    v['cveInformation'] = cveUrl
+    v['vuln_MachineId'] = machineId
+
+    return v
+
+def generate_machine_pages(tenant, machineCount, vulnsPerMachine, seed=42):
+    '''
+    Raw per-machine vulnerability pages as the MDE API returns them, as (machineId, rows) pairs
+    '''
+    rng = random.Random(seed)
+    for m in range(machineCount):
+        yield f'{rng.getrandbits(160):040x}', [dict(rng.choice(tenant.catalog)) for _ in range(vulnsPerMachine)]
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the legacy per-record vulnerability shaping with the compiled projection')
+    parser.add_argument('--records', type=int, default=1000000, help='Number of raw vulnerability rows')
+    parser.add_argument('--vulns-per-machine', type=int, default=20, help='Rows per Machine, the size of each batch')
+    parser.add_argument('--chunk-machines', type=int, default=5000, help='Machines generated at a time to bound memory')
+    args = parser.parse_args()
+
+    report = load_report()
+    tenant = SyntheticTenant(machineCount=0, cveCount=5000)
+    machineCount = args.records // args.vulns_per_machine
+    methods = {
+        'projection (per record)': lambda rows, machineId: [report.projectMachineVuln(v, machineId) for v in rows],
+        'projection (batch)': report.projectMachineVulns,
+        # The legacy shaping rewrites records in place, so it has to run last on each chunk
+        'legacy (per record)': lambda rows, machineId: [legacy_process_machine_vuln(v, machineId) for v in rows]
+    }
+    shapeTimes = {method: 0.0 for method in methods}
+    encodeTimes = {method: 0.0 for method in methods}
+    encodedBytes = {method: 0 for method in methods}
+
+    # Rows are generated a chunk at a time and the generation is not timed. Each method's output is then serialized the
+    # way the json output format does it, since dropping unused fields early mostly pays off there
+    pages = generate_machine_pages(tenant, machineCount, args.vulns_per_machine)
+    remaining = machineCount
+    while remaining:
+        chunk = [next(pages) for _ in range(min(args.chunk_machines, remaining))]
+        remaining -= len(chunk)
+        for method, shape in methods.items():
+            startTime = time.perf_counter()
+            shaped = [shape(rows, machineId) for machineId, rows in chunk]
+            shapeTimes[method] += time.perf_counter() - startTime
+
+            writer = CountingWriter()
+            startTime = time.perf_counter()
+            encoder = report.JsonArrayEncoder(writer)
+            for records in shaped:
+                for record in records:
+                    encoder.write(record)
+            encoder.close()
+            encodeTimes[method] += time.perf_counter() - startTime
+            encodedBytes[method] += writer.bytesWritten
+
+    recordCount = machineCount * args.vulns_per_machine
+    legacyShapeRate = recordCount / shapeTimes['legacy (per record)']
+    legacyTotalRate = recordCount / (shapeTimes['legacy (per record)'] + encodeTimes['legacy (per record)'])
+    print(f'{recordCount} processed_machine_vulns rows in batches of {args.vulns_per_machine}')
+    print(f'{"method":<26}{"shape rec/s":>14}{"vs legacy":>11}{"shape+json rec/s":>19}{"vs legacy":>11}{"json bytes":>14}')
+    for method in ('legacy (per record)', 'projection (per record)', 'projection (batch)'):
+        shapeRate = recordCount / shapeTimes[method]
+        totalRate = recordCount / (shapeTimes[method] + encodeTimes[method])
+        print(f'{method:<26}{shapeRate:>14.0f}{shapeRate / legacyShapeRate:>10.2f}x{totalRate:>19.0f}{totalRate / legacyTotalRate:>10.2f}x{encodedBytes[method]:>14}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from itertools import islice
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from synthetic_tenant import SyntheticTenant
+
+# Largest page the MDE API hands out for the machines and vulnerability list endpoints
+mdeMaxPageSize = 10000
+# Most rows a single Advanced Hunting query returns, and the hash() slice report.py adds to its queries
+mdeHuntingMaxRows = 100000
+huntingChunkRegex = re.compile(r'hash\(\w+, (\d+)\) == (\d+)')
+# The OData $filter clauses the stub understands on the machines list endpoint
+odataClauseRegex = re.compile(r"(\w+) (eq|ne) '([^']*)'")
+
+class MdeStubHandler(BaseHTTPRequestHandler):
+    '''
+    Serves the login.microsoftonline.com token endpoint and the MDE API endpoints report.py calls from a SyntheticTenant.
+    Every request is delayed by the configured latency and a share of them are throttled with a 429 and Retry-After.
+    API responses carry an ETag and are answered with a 304 when the client already holds them
+    '''
+    # Keep-alive, so pooled connections in the client are actually reused
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        route = self.get_route(urlparse(self.path).path) or 'other'
+        headers = dict(headers or {})
+        if status == 200 and route != 'token':
+            # Successful API responses carry an ETag, a client sending it back in If-None-Match gets an empty 304
+            headers['ETag'] = f'"{hashlib.sha1(payload).hexdigest()}"'
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                with self.server.lock:
+                    self.server.notModified[route] += 1
+                self.send_response(304)
+                self.send_header('ETag', headers['ETag'])
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+        with self.server.lock:
+            self.server.bytesSent[route] += len(payload)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def get_route(self, path):
+        if re.fullmatch(r'/[^/]+/oauth2/token', path):
+            return 'token'
+        if path == '/api/machines':
+            return 'machines'
+        if re.fullmatch(r'/api/machines/[0-9a-f]+/vulnerabilities', path):
+            return 'machineVulnerabilities'
+        if re.fullmatch(r'/api/machines/[0-9a-f]+', path):
+            return 'machine'
+        if path == '/api/vulnerabilities/machinesVulnerabilities':
+            return 'machinesVulnerabilities'
+        if path == '/api/vulnerabilities':
+            return 'vulnerabilities'
+        if path == '/api/advancedqueries/run':
+            return 'advancedQueries'
+
+        return None
+
+    def handle_request(self):
+        server = self.server
+        url = urlparse(self.path)
+        route = self.get_route(url.path)
+        # Always read the request body so the connection can be reused
+        requestBody = b''
+        if int(self.headers.get('Content-Length', 0)):
+            requestBody = self.rfile.read(int(self.headers['Content-Length']))
+
+        if url.path == '/_stats':
+            with server.lock:
+                stats = {
+                    'calls': dict(server.calls),
+                    'throttled': dict(server.throttled),
+                    'notModified': dict(server.notModified),
+                    'bytesSent': dict(server.bytesSent)
+                }
+            return self.send_json(200, stats)
+        if route is None:
+            return self.send_json(404, {'error': {'code': 'NotFound', 'message': url.path}})
+
+        with server.lock:
+            server.calls[route] += 1
+            isThrottled = route != 'token' and server.rng.random() < server.throttleRate
+            if isThrottled:
+                server.throttled[route] += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if isThrottled:
+            return self.send_json(
+                429,
+                {'error': {'code': 'TooManyRequests', 'message': 'API calls quota exceeded! Maximum admitted 100 per Minute.'}},
+                {'Retry-After': str(server.retryAfter)}
+            )
+
+        if route == 'token':
+            return self.send_json(
+                200,
+                {
+                    'token_type': 'Bearer',
+                    'expires_in': '3599',
+                    'expires_on': str(int(time.time()) + 3599),
+                    'access_token': 'benchmark-token'
+                }
+            )
+
+        tenant = server.tenant
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if route == 'machineVulnerabilities':
+            try:
+                m = tenant.machine_index(url.path.split('/')[3])
+            except KeyError:
+                return self.send_json(404, {'error': {'code': 'ResourceNotFound', 'message': 'Machine was not found'}})
+            return self.send_json(200, {'value': tenant.machine_vulns(m)})
+
+        if route == 'machine':
+            try:
+                m = tenant.machine_index(url.path.split('/')[3])
+            except KeyError:
+                return self.send_json(404, {'error': {'code': 'ResourceNotFound', 'message': 'Machine was not found'}})
+            return self.send_json(200, tenant.build_machine(m))
+
+        if route == 'advancedQueries':
+            return self.send_json(200, self.run_hunting_query(json.loads(requestBody)['Query']))
+
+        if route == 'machines':
+            try:
+                machineIndexes = self.get_filtered_machine_indexes(query.get('$filter', ''))
+            except ValueError as e:
+                return self.send_json(400, {'error': {'code': 'InvalidRequestBody', 'message': str(e)}})
+            total = len(machineIndexes)
+            selectFields = query['$select'].split(',') if '$select' in query else None
+            def pager(skip, top):
+                for m in machineIndexes[skip:skip + top]:
+                    machine = tenant.build_machine(m)
+                    yield {field: machine.get(field) for field in selectFields} if selectFields else machine
+        elif route == 'machinesVulnerabilities':
+            total = tenant.bulk_row_count()
+            pager = tenant.iter_bulk_rows
+        else:
+            total = len(tenant.catalog)
+            pager = lambda skip, top: (dict(v) for v in tenant.catalog[skip:skip + top])
+
+        # Like the real API, pages are capped and the rest is reachable through @odata.nextLink
+        skip = int(query.get('$skip', 0))
+        top = min(int(query.get('$top', server.pageSize)), server.pageSize)
+        body = {'value': list(pager(skip, top))}
+        if skip + top < total:
+            nextQuery = dict(query)
+            nextQuery.update({'$top': top, '$skip': skip + top})
+            body['@odata.nextLink'] = f'http://{self.headers["Host"]}{url.path}?{urlencode(nextQuery)}'
+
+        return self.send_json(200, body)
+
+    def get_filtered_machine_indexes(self, machineFilter):
+        '''
+        Indexes of the Machines matching an OData $filter, cached per filter so paging through them stays cheap. Only
+        "field eq|ne 'value'" clauses joined with "and" are understood, anything else raises a ValueError
+        '''
+        server = self.server
+        with server.lock:
+            machineIndexes = server.filteredMachineIndexes.get(machineFilter)
+        if machineIndexes is not None:
+            return machineIndexes
+
+        clauses = []
+        for clause in machineFilter.split(' and ') if machineFilter else []:
+            clauseMatch = odataClauseRegex.fullmatch(clause.strip())
+            if clauseMatch is None:
+                raise ValueError(f'Unsupported $filter clause: {clause}')
+            clauses.append(clauseMatch.groups())
+        machineIndexes = []
+        for m in range(server.tenant.machineCount):
+            machine = server.tenant.build_machine(m)
+            if all((str(machine.get(field)) == value) == (operator == 'eq') for field, operator, value in clauses):
+                machineIndexes.append(m)
+        with server.lock:
+            server.filteredMachineIndexes[machineFilter] = machineIndexes
+
+        return machineIndexes
+
+    def run_hunting_query(self, query):
+        '''
+        Answers the Advanced Hunting queries report.py sends. The query is not parsed, only its table and hash() slice are
+        read from it, and like the real API no more than the row limit is returned
+        '''
+        if query.startswith('DeviceInfo'):
+            table = 'machines'
+        elif 'count_distinct' in query:
+            table = 'vuln_catalog'
+        else:
+            table = 'vuln_edges'
+        chunk, chunkCount = 0, 1
+        chunkMatch = huntingChunkRegex.search(query)
+        if chunkMatch:
+            chunkCount, chunk = int(chunkMatch.group(1)), int(chunkMatch.group(2))
+
+        rows = list(islice(self.server.tenant.iter_hunting_rows(table, chunk, chunkCount), self.server.huntingMaxRows))
+        schema = [{'Name': column, 'Type': 'Object'} for column in (rows[0] if rows else {})]
+
+        return {'Stats': {'ExecutionTime': 0.1}, 'Schema': schema, 'Results': rows}
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+def create_server(tenant, host='127.0.0.1', port=0, latencyMs=0, throttleRate=0.0, retryAfter=1, pageSize=mdeMaxPageSize,
+                  huntingMaxRows=mdeHuntingMaxRows, seed=42):
+    '''
+    Creates (but does not start) the stub server, port 0 picks a free port - the bound one is in server.server_address
+    '''
+    server = ThreadingHTTPServer((host, port), MdeStubHandler)
+    server.daemon_threads = True
+    server.tenant = tenant
+    server.latency = latencyMs / 1000
+    server.throttleRate = throttleRate
+    server.retryAfter = retryAfter
+    server.pageSize = pageSize
+    server.huntingMaxRows = huntingMaxRows
+    server.filteredMachineIndexes = {}
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+    server.calls = Counter()
+    server.throttled = Counter()
+    server.notModified = Counter()
+    server.bytesSent = Counter()
+
+    return server
+
+def serve(tenantArgs, serverArgs, readyQueue=None):
+    '''
+    Builds the tenant and serves it forever, meant to be the target of a separate process so the stub does not count
+    towards the memory and CPU of the process being measured. The bound port is put on readyQueue once listening
+    '''
+    server = create_server(SyntheticTenant(**tenantArgs), **serverArgs)
+    if readyQueue is not None:
+        readyQueue.put(server.server_address[1])
+    server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the MDE API and the Azure AD token endpoint')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--machines', type=int, default=1000, help='Number of synthetic MDE Machines')
+    parser.add_argument('--vulns-per-machine', type=int, default=20, help='Average number of vulnerabilities per Machine')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Delay added to every request')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of API requests answered with a 429')
+    args = parser.parse_args()
+
+    print(f'Serving a synthetic MDE tenant with {args.machines} machines on http://127.0.0.1:{args.port}')
+    print(f'Point report.py at it with MDE_API_URL=http://127.0.0.1:{args.port} MDE_LOGIN_URL=http://127.0.0.1:{args.port}')
+    serve(
+        {'machineCount': args.machines, 'vulnsPerMachine': args.vulns_per_machine},
+        {'port': args.port, 'latencyMs': args.latency_ms, 'throttleRate': args.throttle_rate}
+    )
+
+if __name__ == '__main__':
+    main()
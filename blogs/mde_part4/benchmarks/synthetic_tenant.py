@@ -0,0 +1,385 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+import bisect
+import datetime
+import hashlib
+import random
+import zlib
+
+# Account the benchmark runs in
+syntheticAccountId = '123456789012'
+
+# Regions the synthetic account is opted in to, the EC2 Instances are spread across the first few of them
+syntheticRegions = [
+    'us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'ca-central-1', 'eu-west-1', 'eu-west-2', 'eu-west-3',
+    'eu-central-1', 'eu-north-1', 'ap-south-1', 'ap-northeast-1', 'ap-northeast-2', 'ap-northeast-3',
+    'ap-southeast-1', 'ap-southeast-2', 'sa-east-1'
+]
+
+words = [
+    'remote', 'code', 'execution', 'vulnerability', 'kernel', 'privilege', 'escalation', 'memory', 'corruption',
+    'attacker', 'crafted', 'request', 'buffer', 'overflow', 'denial', 'service', 'information', 'disclosure'
+]
+
+class SyntheticTenant():
+    '''
+    Deterministic MDE tenant and AWS account of any size. Machines, vulnerabilities and EC2 Instances are derived from
+    their index and the seed on demand, so 100k Machines with millions of vulnerability rows never sit in memory at once.
+    Payloads have the same shape as the MDE API and EC2 DescribeInstances responses report.py consumes
+    '''
+    def __init__(self, machineCount=1000, vulnsPerMachine=20, cveCount=5000, ec2Ratio=0.8, inactiveRatio=0.05,
+                 regionCount=4, accountCount=1, seed=42):
+        self.machineCount = machineCount
+        self.vulnsPerMachine = vulnsPerMachine
+        self.cveCount = cveCount
+        self.ec2Ratio = ec2Ratio
+        self.inactiveRatio = inactiveRatio
+        self.regions = syntheticRegions[:max(1, min(regionCount, len(syntheticRegions)))]
+        # The first Account is the one the benchmark runs in, the rest are members of its Organization
+        self.accountIds = [syntheticAccountId] + [f'{200000000000 + a:012d}' for a in range(1, max(accountCount, 1))]
+        self.seed = seed
+        self.catalog = [self.build_cve(c) for c in range(cveCount)]
+        self.fleetCveIndexes = None
+
+        # Offset of each Machine's first row in the flattened machinesVulnerabilities export, so any page can be served
+        # without walking the Machines in front of it
+        self.bulkOffsets = [0]
+        for m in range(machineCount):
+            self.bulkOffsets.append(self.bulkOffsets[-1] + len(self.machine_cve_indexes(m)))
+
+    def rng(self, *parts):
+        return random.Random(f'{self.seed}:' + ':'.join(str(p) for p in parts))
+
+    def build_cve(self, c):
+        rng = self.rng('cve', c)
+        cveId = f'CVE-20{rng.randint(10, 23)}-{10000 + c}'
+        hasExploit = rng.random() < 0.3
+
+        return {
+            'id': cveId,
+            'name': cveId,
+            'description': ' '.join(rng.choice(words) for _ in range(rng.randint(20, 60))),
+            'severity': rng.choice(['Low', 'Medium', 'High', 'Critical']),
+            'cvssV3': round(rng.uniform(1, 10), 1),
+            'exposedMachines': rng.randint(1, 5000),
+            'publishedOn': '2021-06-08T00:00:00Z',
+            'updatedOn': '2022-01-11T00:00:00Z',
+            'publicExploit': hasExploit,
+            'exploitVerified': hasExploit and rng.random() < 0.3,
+            'exploitInKit': hasExploit and rng.random() < 0.1,
+            'exploitTypes': [rng.choice(['Remote', 'Local', 'PrivilegeEscalation'])] if hasExploit else [],
+            'exploitUris': ['https://www.exploit-db.com/exploits/50000'] if hasExploit else [],
+            # Newer fields the API returns which report.py does not publish
+            'cvssVector': 'CVSS:3.1/AV:N/AC:L/PR:N/UI:N/S:U/C:H/I:H/A:H/E:U/RL:O/RC:C',
+            'firstDetected': '2021-07-01T09:12:45Z',
+            'cveSupportability': 'Supported',
+            'tags': [],
+            'epss': round(rng.random(), 5)
+        }
+
+    def machine_id(self, m):
+        # MDE Machine IDs are 40 hex characters, the index is kept in the first 8 so the stub can map an ID back to it
+        return f'{m:08x}' + hashlib.sha1(f'{self.seed}:{m}'.encode('utf-8')).hexdigest()[:32]
+
+    def machine_index(self, machineId):
+        m = int(machineId[:8], 16)
+        if m >= self.machineCount or self.machine_id(m) != machineId:
+            raise KeyError(machineId)
+
+        return m
+
+    def instance_count(self):
+        return int(self.machineCount * self.ec2Ratio)
+
+    def instance_id(self, n):
+        return f'i-{n:017x}'
+
+    def machine_cve_indexes(self, m):
+        rng = self.rng('machine-cves', m)
+        cveTotal = min(self.cveCount, max(0, int(rng.gauss(self.vulnsPerMachine, self.vulnsPerMachine / 4))))
+
+        return rng.sample(range(self.cveCount), cveTotal)
+
+    def build_machine(self, m):
+        rng = self.rng('machine', m)
+        seen = datetime.datetime(2022, 1, 1) + datetime.timedelta(minutes=rng.randint(0, 500000))
+        isLinux = rng.random() < 0.6
+        # The first ec2Ratio share of the Machines are EC2 Instances, tagged with their Instance ID
+        machineTags = [self.instance_id(m)] if m < self.instance_count() else []
+
+        return {
+            'id': self.machine_id(m),
+            'computerDnsName': f'host-{m}.corp.example',
+            'firstSeen': '2021-11-02T10:15:12.1234567Z',
+            'lastSeen': seen.strftime('%Y-%m-%dT%H:%M:%S.1234567Z'),
+            'osPlatform': 'Linux' if isLinux else 'WindowsServer2019',
+            'osVersion': None,
+            'osProcessor': 'x64',
+            'version': '5.10' if isLinux else '1809',
+            'lastIpAddress': f'10.{m // 65536 % 256}.{m // 256 % 256}.{m % 256}',
+            'lastExternalIpAddress': f'52.1.{m // 256 % 256}.{m % 256}',
+            'agentVersion': '101.62.17',
+            'osBuild': 17763,
+            'healthStatus': 'Inactive' if rng.random() < self.inactiveRatio else 'Active',
+            'deviceValue': 'Normal',
+            'rbacGroupId': 0,
+            'rbacGroupName': None,
+            'riskScore': rng.choice(['None', 'Low', 'Medium', 'High']),
+            'exposureLevel': rng.choice(['Low', 'Medium', 'High']),
+            'isAadJoined': False,
+            'aadDeviceId': None,
+            'machineTags': machineTags,
+            'defenderAvStatus': 'Updated',
+            'onboardingStatus': 'Onboarded',
+            'osArchitecture': '64-bit',
+            'managedBy': 'Unknown',
+            'managedByStatus': 'Unknown',
+            'ipAddresses': [
+                {
+                    'ipAddress': f'10.{m // 65536 % 256}.{m // 256 % 256}.{m % 256}',
+                    'macAddress': f'0A{m:010X}',
+                    'type': 'Ethernet',
+                    'operationalStatus': 'Up'
+                }
+            ],
+            'vmMetadata': None
+        }
+
+    def iter_machines(self, skip=0, top=None):
+        end = self.machineCount if top is None else min(self.machineCount, skip + top)
+        for m in range(skip, end):
+            yield self.build_machine(m)
+
+    def machine_vulns(self, m):
+        return [dict(self.catalog[c]) for c in self.machine_cve_indexes(m)]
+
+    def bulk_row_count(self):
+        return self.bulkOffsets[-1]
+
+    def iter_bulk_rows(self, skip=0, top=None):
+        '''
+        Rows of the machinesVulnerabilities export from position skip onwards - one per Machine, CVE and software product
+        '''
+        end = self.bulk_row_count() if top is None else min(self.bulk_row_count(), skip + top)
+        m = bisect.bisect_right(self.bulkOffsets, skip) - 1
+        position = self.bulkOffsets[m]
+        while position < end and m < self.machineCount:
+            machineId = self.machine_id(m)
+            for c in self.machine_cve_indexes(m):
+                if skip <= position < end:
+                    cve = self.catalog[c]
+                    yield {
+                        'id': f'{machineId}_{cve["id"]}_openssl_1.1.1',
+                        'cveId': cve['id'],
+                        'machineId': machineId,
+                        'fixingKbId': None,
+                        'productName': 'openssl',
+                        'productVendor': 'openssl',
+                        'productVersion': '1.1.1',
+                        'severity': cve['severity']
+                    }
+                position += 1
+            m += 1
+
+    def hunting_hash(self, value, mod):
+        # Stands in for the KQL hash() function, any stable hash keeps the hash(x, 2N) slices inside the hash(x, N) ones
+        return zlib.crc32(str(value).encode('utf-8')) % mod
+
+    def hunting_machine_row(self, m):
+        '''
+        The DeviceInfo row of a Machine as report.py projects it server-side, None for Inactive Machines which the query drops
+        '''
+        machine = self.build_machine(m)
+        if machine['healthStatus'] == 'Inactive':
+            return None
+
+        return {
+            'id': machine['id'],
+            'computerDnsName': machine['computerDnsName'],
+            'firstSeen': '2021-11-02 10:15:12',
+            'lastSeen': machine['lastSeen'][:19].replace('T', ' '),
+            'osPlatform': machine['osPlatform'],
+            'osVersion': machine['osVersion'],
+            'osProcessor': None,
+            'version': machine['version'],
+            'lastIpAddress': None,
+            'lastExternalIpAddress': machine['lastExternalIpAddress'],
+            'agentVersion': machine['agentVersion'],
+            'osBuild': machine['osBuild'],
+            'healthStatus': machine['healthStatus'],
+            'deviceValue': machine['deviceValue'],
+            'rbacGroupId': None,
+            'rbacGroupName': machine['rbacGroupName'],
+            'riskScore': None,
+            'exposureLevel': machine['exposureLevel'],
+            'isAadJoined': machine['isAadJoined'],
+            'aadDeviceId': machine['aadDeviceId'],
+            'machineTags': machine['machineTags'],
+            'defenderAvStatus': None,
+            'onboardingStatus': machine['onboardingStatus'],
+            'osArchitecture': machine['osArchitecture'],
+            'managedBy': None,
+            'managedByStatus': None,
+            'vmMetadata': machine['vmMetadata']
+        }
+
+    def hunting_catalog_row(self, c):
+        '''
+        The DeviceTvmSoftwareVulnerabilitiesKB row of a CVE as report.py projects it server-side
+        '''
+        cve = self.catalog[c]
+
+        return {
+            'id': cve['id'],
+            'name': cve['name'],
+            'description': cve['description'],
+            'severity': cve['severity'],
+            'cvssV3': cve['cvssV3'],
+            'exposedMachines': cve['exposedMachines'],
+            'publishedOn': cve['publishedOn'],
+            'updatedOn': cve['updatedOn'],
+            'publicExploit': cve['publicExploit'],
+            'exploitVerified': None,
+            'exploitInKit': None,
+            'exploitTypes': 'None',
+            'exploitUris': 'None',
+            'cveInformation': f'https://cve.mitre.org/cgi-bin/cvename.cgi?name={cve["id"]}'
+        }
+
+    def iter_hunting_rows(self, table, chunk=0, chunkCount=1):
+        '''
+        Result rows of the 'machines', 'vuln_edges' or 'vuln_catalog' Advanced Hunting query for one hash() slice
+        '''
+        if table == 'vuln_catalog':
+            if self.fleetCveIndexes is None:
+                fleetCveIndexes = set()
+                for m in range(self.machineCount):
+                    fleetCveIndexes.update(self.machine_cve_indexes(m))
+                self.fleetCveIndexes = sorted(fleetCveIndexes)
+            for c in self.fleetCveIndexes:
+                if self.hunting_hash(self.catalog[c]['id'], chunkCount) == chunk:
+                    yield self.hunting_catalog_row(c)
+            return
+
+        for m in range(self.machineCount):
+            machineId = self.machine_id(m)
+            if self.hunting_hash(machineId, chunkCount) != chunk:
+                continue
+            if table == 'machines':
+                row = self.hunting_machine_row(m)
+                if row is not None:
+                    yield row
+            else:
+                for c in self.machine_cve_indexes(m):
+                    yield {'DeviceId': machineId, 'CveId': self.catalog[c]['id']}
+
+    def region_instance_indexes(self, region, accountId=syntheticAccountId):
+        # Instances are dealt out round-robin across the synthetic Regions, and then across the Accounts
+        if region not in self.regions or accountId not in self.accountIds:
+            return range(0)
+        stride = len(self.regions) * len(self.accountIds)
+        start = self.regions.index(region) + self.accountIds.index(accountId) * len(self.regions)
+
+        return range(start, self.instance_count(), stride)
+
+    def instance_state(self, n):
+        # A few Instances are stopped or terminated, picked from the index so the rest of the Instance stays the same
+        if n % 20 == 7:
+            return {'Code': 80, 'Name': 'stopped'}
+        if n % 20 == 13:
+            return {'Code': 48, 'Name': 'terminated'}
+
+        return {'Code': 16, 'Name': 'running'}
+
+    def build_instance(self, n, region):
+        rng = self.rng('instance', n)
+        isPublic = rng.random() < 0.3
+        instance = {
+            'ImageId': f'ami-{rng.getrandbits(64):017x}',
+            'InstanceId': self.instance_id(n),
+            'InstanceType': rng.choice(['t3.micro', 't3.large', 'm5.xlarge', 'c5.2xlarge']),
+            'LaunchTime': datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(minutes=n),
+            'PrivateDnsName': f'ip-10-0-{n // 256 % 256}-{n % 256}.{region}.compute.internal',
+            'PrivateIpAddress': f'10.0.{n // 256 % 256}.{n % 256}',
+            'PublicDnsName': '',
+            'State': self.instance_state(n),
+            'SubnetId': f'subnet-{rng.getrandbits(64):017x}',
+            'VpcId': f'vpc-{rng.getrandbits(64):017x}',
+            'Architecture': 'x86_64',
+            'BlockDeviceMappings': [{'DeviceName': '/dev/xvda', 'Ebs': {'VolumeId': f'vol-{n:017x}'}}],
+            'NetworkInterfaces': [{'NetworkInterfaceId': f'eni-{n:017x}'}],
+            'SecurityGroups': [{'GroupId': f'sg-{n % 50:017x}', 'GroupName': f'sg-{n % 50}'}],
+            'MetadataOptions': {
+                'HttpTokens': rng.choice(['optional', 'required']),
+                'HttpPutResponseHopLimit': 1,
+                'HttpEndpoint': 'enabled',
+                'InstanceMetadataTags': 'disabled'
+            },
+            'EnclaveOptions': {'Enabled': False}
+        }
+        if isPublic:
+            instance['PublicIpAddress'] = f'54.{n // 65536 % 256}.{n // 256 % 256}.{n % 256}'
+            instance['PublicDnsName'] = f'ec2-54-{n // 65536 % 256}-{n // 256 % 256}-{n % 256}.compute-1.amazonaws.com'
+        if rng.random() < 0.5:
+            instance['IamInstanceProfile'] = {'Arn': f'arn:aws:iam::123456789012:instance-profile/role-{n % 20}'}
+
+        return instance
+
+    def describe_instances_by_id(self, region, instanceIds, accountId=syntheticAccountId, states=None):
+        '''
+        A DescribeInstances response filtered on instance-id (and on states when given), IDs which are not in the Account
+        and Region are left out
+        '''
+        indexes = self.region_instance_indexes(region, accountId)
+        reservations = []
+        for instanceId in instanceIds:
+            try:
+                n = int(instanceId[2:], 16)
+            except ValueError:
+                continue
+            if n in indexes and self.instance_id(n) == instanceId and (states is None or self.instance_state(n)['Name'] in states):
+                reservations.append({'ReservationId': f'r-{n:017x}', 'OwnerId': accountId, 'Instances': [self.build_instance(n, region)]})
+
+        return {'Reservations': reservations}
+
+    def describe_instances_page(self, region, nextToken=None, maxResults=1000, accountId=syntheticAccountId, states=None):
+        '''
+        One page of a DescribeInstances response for an Account and Region, one Reservation per Instance. states keeps
+        only the Instances in those states, like an instance-state-name filter
+        '''
+        indexes = self.region_instance_indexes(region, accountId)
+        if states is not None:
+            indexes = [n for n in indexes if self.instance_state(n)['Name'] in states]
+        start = int(nextToken or 0)
+        end = min(len(indexes), start + maxResults)
+        page = {
+            'Reservations': [
+                {
+                    'ReservationId': f'r-{indexes[i]:017x}',
+                    'OwnerId': accountId,
+                    'Instances': [self.build_instance(indexes[i], region)]
+                } for i in range(start, end)
+            ]
+        }
+        if end < len(indexes):
+            page['NextToken'] = str(end)
+
+        return page
@@ -18,11 +18,32 @@
 #specific language governing permissions and limitations
 #under the License.
 
+import argparse
+import bisect
 import boto3
+import contextlib
 import os
+import hashlib
+import sqlite3
+import csv
+import datetime
+import email.utils
+import gzip
+import io
 import requests
 import json
+import random
 import re
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+from itertools import groupby
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from botocore.config import Config
 import botocore
 
@@ -32,468 +53,3083 @@ config = Config(
       'mode': 'adaptive'
    }
 )
-s3 = boto3.client('s3')
-sts = boto3.client('sts')
-sesh = boto3.session.Session()
+# AWS clients and the Account lookup are only created on first use, so importing this module (or running a single stage)
+# does not pay for the whole pipeline
+awsClientLock = threading.Lock()
+s3Client = None
+callerAccountId = None
+callerRegion = None
+
+def get_s3_client():
+    global s3Client
+    # Creating clients from the default Session is not thread safe
+    with awsClientLock:
+        if s3Client is None:
+            s3Client = instrument_aws_client(boto3.client('s3'))
+
+    return s3Client
+
+def get_aws_account_id():
+    global callerAccountId
+    with awsClientLock:
+        if callerAccountId is None:
+            callerAccountId = instrument_aws_client(boto3.client('sts')).get_caller_identity()['Account']
+
+    return callerAccountId
+
+def get_aws_region():
+    global callerRegion
+    with awsClientLock:
+        if callerRegion is None:
+            callerRegion = boto3.session.Session().region_name
+
+    return callerRegion
+
+def get_required_env(envVar):
+    '''
+    Reads a required Environment Variable when a stage first needs it rather than at import time
+    '''
+    value = os.environ.get(envVar)
+    if not value:
+        raise ValueError(f'The {envVar} Environment Variable is required')
+
+    return value
+
+class AccountSessionCache():
+    '''
+    Hands out one Boto3 Session per AWS Account, shared by every Region scanned in it. Other Accounts get a Session built
+    from the credentials of an AssumeRole call, which are cached and only renewed shortly before they expire, the Account
+    we run in uses the default credentials. Every Session shares one botocore data loader, so the service models are
+    parsed once rather than once per Account. Sessions are not thread safe (the clients they create are), so clients are
+    created under a lock
+    '''
+    def __init__(self, roleName, sessionName='MDEReporter'):
+        self.roleName = roleName
+        self.sessionName = sessionName
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.accountLocks = {}
+        self.stsClient = None
+        self.assumeRoleCalls = 0
+        self.dataLoader = botocore.session.get_session().get_component('data_loader')
+
+    def new_session(self, **credentials):
+        botocoreSession = botocore.session.get_session()
+        botocoreSession.register_component('data_loader', self.dataLoader)
+
+        return boto3.Session(botocore_session=botocoreSession, **credentials)
+
+    def get_session(self, accountId):
+        with self.lock:
+            accountLock = self.accountLocks.setdefault(accountId, threading.Lock())
+        # Only one worker per Account assumes the role, the others wait for its credentials
+        with accountLock:
+            cached = self.sessions.get(accountId)
+            if cached is not None and time.time() < cached[1] - stsCredentialRefreshMarginSeconds:
+                return cached[0]
+
+            if accountId == get_aws_account_id():
+                session = self.new_session()
+                expiresAt = float('inf')
+            else:
+                with self.lock:
+                    if self.stsClient is None:
+                        self.stsClient = instrument_aws_client(boto3.client('sts', config=config))
+                    self.assumeRoleCalls += 1
+                credentials = self.stsClient.assume_role(
+                    RoleArn=f'arn:aws:iam::{accountId}:role/{self.roleName}',
+                    RoleSessionName=self.sessionName
+                )['Credentials']
+                session = self.new_session(
+                    aws_access_key_id=credentials['AccessKeyId'],
+                    aws_secret_access_key=credentials['SecretAccessKey'],
+                    aws_session_token=credentials['SessionToken']
+                )
+                expiresAt = credentials['Expiration'].timestamp()
+            self.sessions[accountId] = (session, expiresAt)
+
+            return session
+
+    def client(self, accountId, serviceName, regionName):
+        session = self.get_session(accountId)
+        with self.lock:
+            client = session.client(serviceName, region_name=regionName, config=config)
+
+        return instrument_aws_client(client)
+
+accountSessions = None
+
+def get_account_sessions():
+    global accountSessions
+    with awsClientLock:
+        if accountSessions is None:
+            accountSessions = AccountSessionCache(orgMemberRoleName)
+
+    return accountSessions
 
 # Env Vars
-awsAccountId = sts.get_caller_identity()['Account']
-awsRegion = sesh.region_name
-tenantIdParam = os.environ['AZURE_APP_TENANT_ID_PARAM']
-clientIdParam = os.environ['AZURE_APP_CLIENT_ID_PARAM']
-secretIdParam = os.environ['AZURE_APP_SECRET_ID_PARAM']
-quicksightS3Bucket = os.environ['QUICKSIGHT_S3_BUCKET_NAME']
-
-def get_opted_in_aws_regions():
-    ec2 = boto3.client('ec2')
-    print('Getting all AWS Regions')
+# Required: AZURE_APP_TENANT_ID_PARAM, AZURE_APP_CLIENT_ID_PARAM, AZURE_APP_SECRET_ID_PARAM (names of the SSM Parameters
+# holding the Azure App credentials) and QUICKSIGHT_S3_BUCKET_NAME, read through get_required_env()
+# Optional tuning - number of concurrent workers for per-machine vulnerability calls and the shared MDE call budget
+mdeVulnWorkers = int(os.environ.get('MDE_VULN_WORKERS', '8'))
+mdeCallsPerMinute = int(os.environ.get('MDE_API_CALLS_PER_MINUTE', '50'))
+# MDE also enforces an hourly quota (0 turns the hourly bucket off), and a few calls can go out back to back before the per-minute pacing kicks in
+mdeCallsPerHour = int(os.environ.get('MDE_API_CALLS_PER_HOUR', '1500'))
+mdeApiBurst = int(os.environ.get('MDE_API_BURST', '10'))
+# 429s, 5xx responses and connection errors are retried this many times with jittered exponential backoff
+mdeMaxRetries = int(os.environ.get('MDE_API_MAX_RETRIES', '6'))
+# Vulnerability collection mode - 'machine' makes one call per Machine, 'bulk' pages through the machinesVulnerabilities
+# export, 'auto' picks bulk once the fleet reaches the threshold and 'hunting' runs Advanced Hunting (KQL) queries
+mdeVulnCollectionMode = os.environ.get('MDE_VULN_COLLECTION_MODE', 'auto').lower()
+mdeBulkModeMachineThreshold = int(os.environ.get('MDE_BULK_MODE_MACHINE_THRESHOLD', '100'))
+mdeBulkPageSize = int(os.environ.get('MDE_BULK_PAGE_SIZE', '8000'))
+# Machine collection mode - 'api' lists /api/machines, 'hunting' queries the DeviceInfo table with Advanced Hunting
+mdeMachineCollectionMode = os.environ.get('MDE_MACHINE_COLLECTION_MODE', 'api').lower()
+# OData $filter sent with the machines list call (empty for the whole fleet), and whether to $select only the fields we
+# publish - opt-in, since the machines API does not document $select. A 400 on the first page drops the $select again
+mdeMachinesFilter = os.environ.get('MDE_MACHINES_FILTER', "healthStatus ne 'Inactive'")
+mdeMachinesSelect = os.environ.get('MDE_MACHINES_SELECT', 'false').lower() == 'true'
+# Advanced Hunting queries are split into hash(DeviceId) slices which run concurrently, a slice reaching the row limit of a
+# single query is split in two and run again
+mdeHuntingChunks = int(os.environ.get('MDE_HUNTING_CHUNKS', '8'))
+mdeHuntingWorkers = int(os.environ.get('MDE_HUNTING_WORKERS', '4'))
+mdeHuntingMaxRows = int(os.environ.get('MDE_HUNTING_MAX_ROWS', '100000'))
+# Advanced Hunting has its own, lower quota, so its queries are paced by a separate limiter
+mdeHuntingCallsPerMinute = int(os.environ.get('MDE_HUNTING_CALLS_PER_MINUTE', '45'))
+mdeHuntingCallsPerHour = int(os.environ.get('MDE_HUNTING_CALLS_PER_HOUR', '1500'))
+# Number of AWS Regions scanned for EC2 Instances at the same time, across all Accounts in organization mode
+ec2RegionWorkers = int(os.environ.get('EC2_REGION_WORKERS', '8'))
+# Instance states kept server-side with an instance-state-name filter (empty for every state, terminated included) and the
+# page size of the DescribeInstances calls
+ec2InstanceStates = [state.strip() for state in os.environ.get('EC2_INSTANCE_STATES', 'pending,running,shutting-down,stopping,stopped').split(',') if state.strip()]
+ec2PageSize = int(os.environ.get('EC2_PAGE_SIZE', '1000'))
+# Region activity index kept in S3 - the opted-in Regions of every Account are listed again once they are older than the TTL,
+# and Regions which were empty are probed with a single small page, at most once per EC2_EMPTY_REGION_PROBE_HOURS (0 probes them on every run)
+ec2RegionIndexKey = os.environ.get('EC2_REGION_INDEX_KEY', 'quicksight/state/ec2_region_index.json')
+ec2RegionListTtlHours = float(os.environ.get('EC2_REGION_LIST_TTL_HOURS', '168'))
+ec2EmptyRegionProbeHours = float(os.environ.get('EC2_EMPTY_REGION_PROBE_HOURS', '0'))
+# Organization mode inventories EC2 in every ACTIVE Account of the AWS Organization (or only the Accounts in ORG_ACCOUNT_IDS)
+# by assuming a read-only role in each of them
+organizationMode = os.environ.get('ORGANIZATION_MODE', 'false').lower() == 'true'
+orgMemberRoleName = os.environ.get('ORG_MEMBER_ROLE_NAME', 'MDE-Reporter-EC2ReadOnly')
+orgAccountIds = [accountId.strip() for accountId in os.environ.get('ORG_ACCOUNT_IDS', '').split(',') if accountId.strip()]
+# Streaming mode serializes records one at a time straight into S3 Multipart Uploads instead of building full lists and local files
+streamingMode = os.environ.get('STREAMING_MODE', 'false').lower() == 'true'
+s3MultipartPartSize = int(os.environ.get('S3_MULTIPART_PART_SIZE_MB', '8')) * 1024 * 1024
+# Concurrent S3 uploads and the state object holding the content hash of everything published
+s3UploadWorkers = int(os.environ.get('S3_UPLOAD_WORKERS', '4'))
+publishStateKey = os.environ.get('PUBLISH_STATE_KEY', 'quicksight/state/publish_state.json')
+# Lease on a lock object in S3 held while publishing, so the scheduled full scan and the event-driven patches never write
+# the same datasets and publish state at the same time. A run waits this long for the other one before it fails, and a
+# lease not released by a run which died expires after RUN_LOCK_LEASE_SECONDS (longer than the CodeBuild timeout)
+runLockKey = os.environ.get('RUN_LOCK_KEY', 'quicksight/state/run.lock')
+runLockWaitSeconds = int(os.environ.get('RUN_LOCK_WAIT_SECONDS', '900'))
+runLockLeaseSeconds = int(os.environ.get('RUN_LOCK_LEASE_SECONDS', '4200'))
+# When False (--skip-publish) datasets are only written to the working directory, nothing is uploaded to S3 or changed in QuickSight
+publishEnabled = True
+# Dataset output format - 'json' (default), or gzip compressed 'csv' / 'tsv' with a fixed column schema per dataset
+outputFormat = os.environ.get('OUTPUT_FORMAT', 'json').lower()
+gzipCompressLevel = int(os.environ.get('GZIP_COMPRESS_LEVEL', '6'))
+# Partitioned output splits every dataset into shards of the day (and Account / Region where the dataset has them), which
+# are serialized by a pool of worker processes. The Manifests cover the last few days of partitions, older ones are deleted
+partitionedOutput = os.environ.get('PARTITIONED_OUTPUT', 'false').lower() == 'true'
+partitionShardRecords = int(os.environ.get('PARTITION_SHARD_RECORDS', '20000'))
+partitionWorkers = int(os.environ.get('PARTITION_WORKERS', str(os.cpu_count() or 2)))
+# Lambda has no /dev/shm for the semaphores of a process pool, so the function always serializes shards inline
+if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+    partitionWorkers = 1
+partitionManifestDays = int(os.environ.get('PARTITION_MANIFEST_DAYS', '1'))
+partitionRetentionDays = int(os.environ.get('PARTITION_RETENTION_DAYS', '30'))
+# Build the pre-joined EC2 x MDE Machines x Vulnerabilities exposure dataset alongside the three source datasets
+buildExposureDataset = os.environ.get('BUILD_EXPOSURE_DATASET', 'true').lower() == 'true'
+# Vulnerability dataset layout - 'denormalized' writes one full record per Machine and CVE (processed_machine_vulns),
+# 'normalized' writes a catalog with one row per CVE and a compact Machine to CVE edge table instead, 'both' writes all three
+vulnDatasetLayout = os.environ.get('VULN_DATASET_LAYOUT', 'denormalized').lower()
+# Incremental mode only re-fetches vulnerabilities for Machines that changed since the last run, using a SQLite state file kept in S3
+incrementalMode = os.environ.get('INCREMENTAL_MODE', 'false').lower() == 'true'
+stateDbKey = os.environ.get('STATE_DB_KEY', 'quicksight/state/mde_state.sqlite')
+incrementalMaxAgeHours = float(os.environ.get('INCREMENTAL_MAX_AGE_HOURS', '168'))
+
+# QuickSight - concurrent Group membership calls, and how long to wait for the SPICE ingestions (0 starts them without waiting)
+quicksightWorkers = int(os.environ.get('QUICKSIGHT_WORKERS', '4'))
+quicksightIngestionTimeoutSeconds = int(os.environ.get('QUICKSIGHT_INGESTION_TIMEOUT_SECONDS', '1800'))
+
+# Run metrics - a JSON file in the working directory (also uploaded under the key prefix when publishing) and CloudWatch
+# Embedded Metric Format lines printed to the log under the namespace, an empty namespace turns the EMF lines off
+metricsFile = os.environ.get('METRICS_FILE', './mde_report_metrics.json')
+metricsKeyPrefix = os.environ.get('METRICS_KEY_PREFIX', 'quicksight/metrics/')
+metricsNamespace = os.environ.get('METRICS_NAMESPACE', 'MDEReporter')
+
+# Raw API response cache - off, record (serve fresh entries, fetch and store the rest) or replay (serve only from the cache)
+responseCacheMode = os.environ.get('RESPONSE_CACHE_MODE', 'off').lower()
+responseCacheDir = os.environ.get('RESPONSE_CACHE_DIR', './.mde_report_cache')
+responseCacheTtlSeconds = int(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', '3600'))
+responseCacheMaxBytes = int(os.environ.get('RESPONSE_CACHE_MAX_MB', '2048')) * 1024 * 1024
+
+# MDE API and Azure AD login endpoints - only overridden to point the script at a local stub (see ./benchmarks)
+mdeApiUrl = os.environ.get('MDE_API_URL', 'https://api-us.securitycenter.microsoft.com').rstrip('/')
+mdeLoginUrl = os.environ.get('MDE_LOGIN_URL', 'https://login.microsoftonline.com').rstrip('/')
+# Refresh the cached OAuth token this many seconds before it actually expires
+mdeTokenRefreshMarginSeconds = 300
+# Assumed role credentials are renewed this many seconds before they expire
+stsCredentialRefreshMarginSeconds = 300
+# How often a run waiting for the run lock looks at it again, and the time left for the patches once a Lambda function got it
+runLockPollSeconds = 10
+lambdaLockMarginSeconds = 300
+
+# QuickSight roles whose users are added to the Group, and how often Data Source creations and ingestions are polled
+quicksightGroupRoles = ('ADMIN', 'AUTHOR', 'ADMIN_PRO', 'AUTHOR_PRO')
+quicksightPollSeconds = 5
+
+# Backoff for retried MDE calls without a Retry-After, and how long a single call may take
+mdeBackoffBaseSeconds = 1
+mdeBackoffMaxSeconds = 60
+mdeRequestTimeoutSeconds = 120
+# Largest $top the machines list endpoint accepts, the rest of the fleet is paged through
+mdeMachinesPageSize = 10000
+mdeRetryStatusCodes = (429, 500, 502, 503, 504)
+# Advanced Hunting queries may run for up to 10 minutes, and a slice is not split any further than this
+mdeHuntingTimeoutSeconds = 600
+mdeHuntingMaxChunkCount = 4096
+# EventBridge detail-types handled by the event-driven mode. MDE does not emit AWS events, a forwarder (for example an Azure
+# Logic App on the Defender streaming API) puts 'MDE Machine Change' events with {"machineIds": [...]} on the bus
+ec2StateChangeDetailType = 'EC2 Instance State-change Notification'
+mdeMachineChangeDetailType = 'MDE Machine Change'
+scheduledEventDetailType = 'Scheduled Event'
+# Datasets patched by the event-driven mode, and the column identifying a record in each of them
+patchableDatasetKeys = {
+    'processed_ec2_instances': 'InstanceId',
+    'processed_machines': 'id'
+}
+# Most values a single DescribeInstances filter takes
+ec2FilterMaxValues = 200
+# Smallest page DescribeInstances hands out, used to probe Regions which were empty on the last run
+ec2ProbeMaxResults = 5
+# Partitioned datasets live under this prefix (and locally under the directory) as
+# <dataset>/dt=<day>/[accountid=<id>/region=<region>/]part-<n>, every row carries the day it was collected on
+partitionedKeyPrefix = 'quicksight/partitioned/'
+partitionedLocalDir = './partitioned'
+partitionColumns = ('AccountId', 'Region')
+snapshotColumn = 'SnapshotDate'
+# Cached responses are compressed for speed rather than size, and a full cache is evicted down to this share of its limit
+responseCacheCompressLevel = 1
+responseCacheEvictRatio = 0.9
+
+# Declarative projection of the MDE Machine, MDE Vulnerability and EC2 Instance objects into the records we publish. Each
+# entry is (output column, source, optional transform) where the source is a key, a dotted path into nested objects and
+# lists ('SecurityGroups.0.GroupId'), '*' for the whole object or '$name' for an argument passed to the projection. A
+# trailing '?' marks fields which are often missing. The specs are compiled once into transformer functions by
+# compile_projection() and are also the column schema of each dataset
+projectionSpecs = {
+    'processed_machines': [
+        ('id', 'id'),
+        ('computerDnsName', 'computerDnsName'),
+        ('firstSeen', 'firstSeen', 'quicksight_timestamp'),
+        ('lastSeen', 'lastSeen', 'quicksight_timestamp'),
+        ('osPlatform', 'osPlatform'),
+        ('osVersion', 'osVersion'),
+        ('osProcessor', 'osProcessor'),
+        ('version', 'version'),
+        ('lastIpAddress', 'lastIpAddress'),
+        ('lastExternalIpAddress', 'lastExternalIpAddress'),
+        ('agentVersion', 'agentVersion'),
+        ('osBuild', 'osBuild'),
+        ('healthStatus', 'healthStatus'),
+        ('deviceValue', 'deviceValue'),
+        ('rbacGroupId', 'rbacGroupId'),
+        ('rbacGroupName', 'rbacGroupName'),
+        ('riskScore', 'riskScore'),
+        ('exposureLevel', 'exposureLevel'),
+        ('isAadJoined', 'isAadJoined'),
+        ('aadDeviceId', 'aadDeviceId'),
+        ('machineTags', 'machineTags'),
+        ('defenderAvStatus', 'defenderAvStatus'),
+        ('onboardingStatus', 'onboardingStatus'),
+        ('osArchitecture', 'osArchitecture'),
+        ('managedBy', 'managedBy'),
+        ('managedByStatus', 'managedByStatus'),
+        ('vmMetadata', 'vmMetadata'),
+        ('instanceId', 'machineTags', 'ec2_instance_id')
+    ],
+    'processed_machine_vulns': [
+        ('id', 'id'),
+        ('name', 'name'),
+        ('description', 'description'),
+        ('severity', 'severity'),
+        ('cvssV3', 'cvssV3'),
+        ('exposedMachines', 'exposedMachines'),
+        ('publishedOn', 'publishedOn'),
+        ('updatedOn', 'updatedOn'),
+        ('publicExploit', 'publicExploit'),
+        ('exploitVerified', 'exploitVerified'),
+        ('exploitInKit', 'exploitInKit'),
+        ('exploitTypes', 'exploitTypes', 'first_or_none'),
+        ('exploitUris', 'exploitUris', 'first_or_none'),
+        ('cveInformation', 'id', 'cve_url'),
+        ('vuln_MachineId', '$machineId')
+    ],
+    'processed_ec2_instances': [
+        ('ImageId', 'ImageId', 'str'),
+        ('InstanceId', 'InstanceId', 'str'),
+        ('InstanceType', 'InstanceType', 'str'),
+        ('LaunchTime', 'LaunchTime', 'str'),
+        ('PrivateDnsName', 'PrivateDnsName', 'str'),
+        ('PrivateIpAddress', 'PrivateIpAddress', 'str'),
+        ('PublicIpAddress', 'PublicIpAddress?', 'str'),
+        ('PublicDnsName', 'PublicDnsName', 'non_empty_str'),
+        ('IsPublic', '*', 'ec2_is_public'),
+        ('State', 'State.Name', 'str'),
+        ('SubnetId', 'SubnetId', 'str'),
+        ('VpcId', 'VpcId', 'str'),
+        ('Architecture', 'Architecture', 'str'),
+        ('VolumeId', 'BlockDeviceMappings.0.Ebs.VolumeId', 'str'),
+        ('IamInstanceProfileArn', 'IamInstanceProfile.Arn?', 'str'),
+        ('NetworkInterfaceId', 'NetworkInterfaces.0.NetworkInterfaceId', 'str'),
+        ('SecurityGroupId', 'SecurityGroups.0.GroupId', 'str'),
+        ('SecurityGroupName', 'SecurityGroups.0.GroupName', 'str'),
+        ('MetadataOptionsHttpTokens', 'MetadataOptions.HttpTokens', 'str'),
+        ('MetadataOptionsHttpPutResponseHopLimit', 'MetadataOptions.HttpPutResponseHopLimit', 'str'),
+        ('MetadataOptionsHttpEndpoint', 'MetadataOptions.HttpEndpoint', 'str'),
+        ('MetadataOptionsInstanceMetadataTags', 'MetadataOptions.InstanceMetadataTags', 'str'),
+        ('EnclaveOptions', 'EnclaveOptions.Enabled', 'str'),
+        ('AccountId', '$accountId'),
+        ('Region', '$region')
+    ]
+}
+
+# The normalized layout splits the shaped vulnerability records into the CVE level columns and the Machine to CVE edges
+projectionSpecs['processed_vuln_catalog'] = [
+    (entry[0], entry[0]) for entry in projectionSpecs['processed_machine_vulns'] if entry[0] != 'vuln_MachineId'
+]
+projectionSpecs['processed_machine_vuln_edges'] = [
+    ('machineId', 'vuln_MachineId'),
+    ('cveId', 'id')
+]
+
+# Top level Machine fields the projection reads (plus the ones the Machine is filtered on), sent as the $select of the
+# machines list call so the API leaves everything else - such as the IP address details - out of the response
+mdeMachineSelectFields = list(dict.fromkeys(
+    [entry[1].rstrip('?').split('.')[0] for entry in projectionSpecs['processed_machines']] + ['healthStatus']
+))
+
+# Name of the QuickSight Data Source and SPICE Data Set of each dataset, both use it as their ID
+quicksightDataSetNames = {
+    'processed_machines': 'MDE_Machines',
+    'processed_machine_vulns': 'MDE_Vulnerabilities',
+    'processed_vuln_catalog': 'MDE_Vulnerability_Catalog',
+    'processed_machine_vuln_edges': 'MDE_Machine_Vulnerabilities',
+    'processed_ec2_instances': 'EC2_Instances',
+    'processed_exposure': 'EC2_Exposure'
+}
+
+# Fixed column schema of every dataset, used for the delimited output formats and as the key order of the JSON records
+datasetColumns = {fileName: [entry[0] for entry in spec] for fileName, spec in projectionSpecs.items()}
+datasetColumns['processed_exposure'] = [
+    'AccountId', 'Region', 'InstanceId', 'InstanceType', 'State', 'IsPublic', 'PublicIpAddress', 'PublicDnsName', 'VpcId',
+    'SubnetId', 'SecurityGroupId', 'IamInstanceProfileArn', 'MetadataOptionsHttpTokens', 'IsImdsV1', 'machineId',
+    'computerDnsName', 'osPlatform', 'healthStatus', 'riskScore', 'exposureLevel', 'cveId', 'name', 'severity',
+    'cvssV3', 'publicExploit', 'exploitVerified', 'exploitInKit', 'exploitTypes', 'exploitUris', 'cveInformation'
+]
+
+def get_dataset_columns(fileName):
+    # Partitioned datasets keep several days of rows side by side, each one says which day it was collected on
+    if partitionedOutput:
+        return datasetColumns[fileName] + [snapshotColumn]
+
+    return datasetColumns[fileName]
+
+# EC2 and MDE Machine fields carried into the exposure dataset, everything else is left out of the join indexes
+exposureEc2Fields = [
+    'AccountId', 'Region', 'InstanceId', 'InstanceType', 'State', 'IsPublic', 'PublicIpAddress', 'PublicDnsName', 'VpcId',
+    'SubnetId', 'SecurityGroupId', 'IamInstanceProfileArn', 'MetadataOptionsHttpTokens'
+]
+exposureMachineFields = ['computerDnsName', 'osPlatform', 'healthStatus', 'riskScore', 'exposureLevel']
+exposureVulnFields = [
+    'name', 'severity', 'cvssV3', 'publicExploit', 'exploitVerified', 'exploitInKit', 'exploitTypes', 'exploitUris',
+    'cveInformation'
+]
+# Vulnerability fields held back for the exposure join while the EC2 stage is still running
+exposureJoinFields = ['id', 'vuln_MachineId'] + exposureVulnFields
+
+# Advanced Hunting (KQL) projections of the MDE tables into the dataset columns, as (output column, KQL expression). The
+# filtering, de-duplication and shaping all happen server-side, so only the published fields cross the wire. Fields the
+# tables do not have are null. DeviceInfo only goes back 30 days, so firstSeen is the first time a Machine reported within them
+huntingProjections = {
+    'processed_machines': [
+        ('id', 'DeviceId'),
+        ('computerDnsName', 'DeviceName'),
+        ('firstSeen', "format_datetime(firstSeen, 'yyyy-MM-dd HH:mm:ss')"),
+        ('lastSeen', "format_datetime(Timestamp, 'yyyy-MM-dd HH:mm:ss')"),
+        ('osPlatform', 'OSPlatform'),
+        ('osVersion', 'OSVersion'),
+        ('osProcessor', 'dynamic(null)'),
+        ('version', 'OSVersionInfo'),
+        ('lastIpAddress', 'dynamic(null)'),
+        ('lastExternalIpAddress', 'PublicIP'),
+        ('agentVersion', 'ClientVersion'),
+        ('osBuild', 'OSBuild'),
+        ('healthStatus', 'SensorHealthState'),
+        ('deviceValue', 'AssetValue'),
+        ('rbacGroupId', 'dynamic(null)'),
+        ('rbacGroupName', 'MachineGroup'),
+        ('riskScore', 'dynamic(null)'),
+        ('exposureLevel', 'ExposureLevel'),
+        ('isAadJoined', 'IsAzureADJoined'),
+        ('aadDeviceId', 'AadDeviceId'),
+        ('machineTags', 'set_union(coalesce(DeviceManualTags, dynamic([])), coalesce(DeviceDynamicTags, dynamic([])))'),
+        ('defenderAvStatus', 'dynamic(null)'),
+        ('onboardingStatus', 'OnboardingStatus'),
+        ('osArchitecture', 'OSArchitecture'),
+        ('managedBy', 'dynamic(null)'),
+        ('managedByStatus', 'dynamic(null)'),
+        ('vmMetadata', 'VmMetadata')
+    ],
+    'processed_vuln_catalog': [
+        ('id', 'CveId'),
+        ('name', 'CveId'),
+        ('description', 'VulnerabilityDescription'),
+        ('severity', 'coalesce(VulnerabilitySeverityLevel, fleetSeverity)'),
+        ('cvssV3', 'CvssScore'),
+        ('exposedMachines', 'exposedMachines'),
+        ('publishedOn', 'PublishedDate'),
+        ('updatedOn', 'LastModifiedTime'),
+        ('publicExploit', 'IsExploitAvailable'),
+        ('exploitVerified', 'dynamic(null)'),
+        ('exploitInKit', 'dynamic(null)'),
+        ('exploitTypes', "'None'"),
+        ('exploitUris', "'None'"),
+        ('cveInformation', "strcat('https://cve.mitre.org/cgi-bin/cvename.cgi?name=', CveId)")
+    ]
+}
+
+def get_hunting_project_clause(fileName, localColumns=()):
+    '''
+    Builds the KQL project clause of a dataset, which together with the columns filled in locally has to match the dataset schema
+    '''
+    projection = huntingProjections[fileName]
+    columns = [column for column, _ in projection] + list(localColumns)
+    if columns != datasetColumns[fileName]:
+        raise ValueError(f'The Advanced Hunting projection of {fileName} does not match its columns {datasetColumns[fileName]}')
+
+    return '| project ' + ', '.join(f"['{column}'] = {expression}" for column, expression in projection)
+
+# {chunk} is replaced with the hash() slice each query runs over. Machines which are Inactive are dropped server-side, and
+# the edge query only returns each Machine and CVE pair once instead of once per vulnerable software product
+huntingQueries = {
+    'machines': '\n'.join([
+        'DeviceInfo',
+        '| where Timestamp > ago(30d)',
+        '{chunk}',
+        '| summarize firstSeen = min(Timestamp), arg_max(Timestamp, *) by DeviceId',
+        "| where SensorHealthState != 'Inactive'",
+        # The EC2 Instance ID is pulled out of the Machine Tags locally, as it is in the API mode
+        get_hunting_project_clause('processed_machines', ('instanceId',))
+    ]),
+    'vuln_edges': '\n'.join([
+        'DeviceTvmSoftwareVulnerabilities',
+        '{chunk}',
+        '| distinct DeviceId, CveId'
+    ]),
+    'vuln_catalog': '\n'.join([
+        'DeviceTvmSoftwareVulnerabilities',
+        '{chunk}',
+        '| summarize exposedMachines = count_distinct(DeviceId), fleetSeverity = take_any(VulnerabilitySeverityLevel) by CveId',
+        '| join kind=leftouter DeviceTvmSoftwareVulnerabilitiesKB on CveId',
+        get_hunting_project_clause('processed_vuln_catalog')
+    ])
+}
+
+# File extension and QuickSight Manifest upload settings for each output format
+outputFormats = {
+    'json': {
+        'extension': 'json',
+        'uploadSettings': {
+            'format': 'JSON'
+        }
+    },
+    'csv': {
+        'extension': 'csv.gz',
+        'delimiter': ',',
+        'uploadSettings': {
+            'format': 'CSV',
+            'delimiter': ',',
+            'textqualifier': '"',
+            'containsHeader': 'true'
+        }
+    },
+    'tsv': {
+        'extension': 'tsv.gz',
+        'delimiter': '\t',
+        'uploadSettings': {
+            'format': 'TSV',
+            'delimiter': '\t',
+            'textqualifier': '"',
+            'containsHeader': 'true'
+        }
+    }
+}
+
+class TokenBucket():
+    '''
+    Holds up to capacity tokens and refills them continuously at refillPerSecond, not thread-safe on its own
+    '''
+    def __init__(self, capacity, refillPerSecond):
+        self.capacity = float(capacity)
+        self.refillPerSecond = refillPerSecond
+        self.tokens = float(capacity)
+        self.updatedAt = time.monotonic()
+
+    def take(self, now):
+        '''
+        Takes one token, returns the number of seconds the caller has to wait before using it (the balance can go negative
+        so that tokens are handed out in the order they were asked for)
+        '''
+        self.tokens = min(self.capacity, self.tokens + (now - self.updatedAt) * self.refillPerSecond)
+        self.updatedAt = now
+        self.tokens -= 1
+
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.refillPerSecond
+
+class SlidingWindow():
+    '''
+    Allows at most limit calls in any windowSeconds long window, by remembering when the last limit calls were reserved.
+    Not thread-safe on its own
+    '''
+    def __init__(self, limit, windowSeconds):
+        self.limit = limit
+        self.windowSeconds = windowSeconds
+        self.calls = deque()
+
+    def take(self, at):
+        '''
+        Reserves one call at or after at, returns the time it was reserved for. Reservations never go back in time, so
+        calls are handed out in the order they were asked for
+        '''
+        if self.calls:
+            at = max(at, self.calls[-1])
+        while self.calls and self.calls[0] + self.windowSeconds <= at:
+            self.calls.popleft()
+        if len(self.calls) >= self.limit:
+            at = max(at, self.calls[-self.limit] + self.windowSeconds)
+            while self.calls and self.calls[0] + self.windowSeconds <= at:
+                self.calls.popleft()
+        self.calls.append(at)
+
+        return at
+
+class RateLimiter():
+    '''
+    Thread-safe limiter shared by every worker calling the MDE API, so raising the worker count never raises the call rate.
+    MDE enforces a per-minute and a per-hour quota. The per-minute one is paced by a token bucket, the per-hour one by a
+    sliding window, so the whole hourly quota can be used while no rolling hour goes over it. A 429 pauses the whole limiter
+    until its Retry-After
+    '''
+    def __init__(self, callsPerMinute, callsPerHour=0, burst=1):
+        self.lock = threading.Lock()
+        self.bucket = TokenBucket(burst, callsPerMinute / 60.0)
+        self.hourWindow = SlidingWindow(callsPerHour, 3600.0) if callsPerHour else None
+        self.pausedUntil = 0.0
+        self.waitedSeconds = 0.0
+
+    def wait(self):
+        '''
+        Blocks until the caller may make one call, returns the number of seconds it waited
+        '''
+        # Reserve the call while holding the lock, then sleep outside of it so other workers can queue up behind us
+        with self.lock:
+            now = time.monotonic()
+            delay = max(self.pausedUntil - now, self.bucket.take(now), 0.0)
+            if self.hourWindow is not None:
+                delay = self.hourWindow.take(now + delay) - now
+            self.waitedSeconds += delay
+        if delay > 0:
+            time.sleep(delay)
+
+        return delay
+
+    def pause(self, seconds):
+        # Every worker backs off, not just the one which was throttled
+        with self.lock:
+            self.pausedUntil = max(self.pausedUntil, time.monotonic() + seconds)
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peakRss = peakRss / 1024
+
+    return round(peakRss / 1024, 1)
+
+def get_latency_percentiles(latencies):
+    '''
+    Returns nearest-rank percentiles (in milliseconds) for a list of latencies measured in seconds
+    '''
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+    percentiles = {}
+    for p in (50, 90, 95, 99):
+        rank = max(int(round(p / 100 * len(ordered))) - 1, 0)
+        percentiles[f'p{p}'] = round(ordered[rank] * 1000, 1)
+    percentiles['max'] = round(ordered[-1] * 1000, 1)
+
+    return percentiles
+
+class RunMetrics():
+    '''
+    Thread-safe collector for the performance of a run - wall time, records in / out and peak memory of every stage, call
+    counts, errors and a latency histogram for every external API operation, and records and bytes of every dataset.
+    Written out as a JSON metrics file and as CloudWatch Embedded Metric Format lines at the end of the run
+    '''
+    # Upper bounds (in milliseconds) of the latency histogram buckets, the last bucket catches everything slower
+    latencyBucketsMs = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.startedAt = time.time()
+        self.stages = {}
+        self.calls = {}
+        self.datasets = {}
+
+    def get_stage(self, name):
+        # Callers hold the lock
+        if name not in self.stages:
+            self.stages[name] = {'status': 'not_run', 'seconds': 0.0, 'recordsIn': 0, 'recordsOut': 0, 'bytesSerialized': 0, 'bytesUploaded': 0}
+
+        return self.stages[name]
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        Times a block as a stage and records whether it succeeded, along with the peak RSS of the whole process when it
+        finished. Stages run concurrently, so that is the high-water mark of everything which ran so far and not the memory
+        of the stage itself
+        '''
+        with self.lock:
+            self.get_stage(name)['status'] = 'running'
+        startTime = time.perf_counter()
+        status = 'failed'
+        try:
+            yield
+            status = 'succeeded'
+        finally:
+            with self.lock:
+                stage = self.get_stage(name)
+                stage['status'] = status
+                stage['seconds'] = round(time.perf_counter() - startTime, 3)
+                stage['processPeakRssMb'] = get_peak_rss_mb()
+
+    def count(self, stageName, counter, value=1):
+        with self.lock:
+            stage = self.get_stage(stageName)
+            stage[counter] = stage.get(counter, 0) + value
+
+    def record_call(self, api, operation, seconds, error=False):
+        latencyMs = seconds * 1000
+        bucket = bisect.bisect_left(self.latencyBucketsMs, latencyMs)
+        with self.lock:
+            callKey = f'{api}.{operation}'
+            if callKey not in self.calls:
+                self.calls[callKey] = {
+                    'api': api,
+                    'operation': operation,
+                    'calls': 0,
+                    'errors': 0,
+                    'totalMs': 0.0,
+                    'maxMs': 0.0,
+                    'histogram': [0] * (len(self.latencyBucketsMs) + 1)
+                }
+            call = self.calls[callKey]
+            call['calls'] += 1
+            call['errors'] += int(error)
+            call['totalMs'] += latencyMs
+            call['maxMs'] = max(call['maxMs'], latencyMs)
+            call['histogram'][bucket] += 1
+
+    def record_dataset(self, fileName, key, stageName, records, bytesSerialized):
+        with self.lock:
+            self.datasets[fileName] = {
+                'key': key,
+                'stage': stageName,
+                'records': records,
+                'bytesSerialized': bytesSerialized,
+                'bytesUploaded': 0
+            }
+            stage = self.get_stage(stageName)
+            stage['recordsOut'] += records
+            stage['bytesSerialized'] += bytesSerialized
+
+    def record_upload(self, key, byteCount):
+        with self.lock:
+            # Manifests and state objects are not datasets, their bytes are counted towards the publish stage
+            stageName = 'publish'
+            for dataset in self.datasets.values():
+                # Partitioned datasets are keyed by their prefix, every shard under it is theirs
+                if dataset.get('key') == key or (dataset.get('key', '').endswith('/') and key.startswith(dataset['key'])):
+                    dataset['bytesUploaded'] += byteCount
+                    stageName = dataset['stage']
+            self.get_stage(stageName)['bytesUploaded'] += byteCount
+
+    def record_ingestion(self, fileName, ingestion):
+        with self.lock:
+            self.datasets.setdefault(fileName, {})['ingestion'] = dict(ingestion)
+
+    def to_dict(self):
+        with self.lock:
+            calls = {}
+            for callKey, call in self.calls.items():
+                calls[callKey] = dict(call)
+                calls[callKey]['avgMs'] = round(call['totalMs'] / call['calls'], 1)
+                calls[callKey]['totalMs'] = round(call['totalMs'], 1)
+                calls[callKey]['maxMs'] = round(call['maxMs'], 1)
+                calls[callKey]['histogram'] = list(call['histogram'])
+
+            return {
+                'startedAt': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.startedAt)),
+                'latencyBucketsMs': self.latencyBucketsMs,
+                'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                'calls': calls,
+                'datasets': {fileName: dict(dataset) for fileName, dataset in self.datasets.items()},
+                'peakRssMb': get_peak_rss_mb()
+            }
+
+    def get_emf_lines(self, namespace):
+        '''
+        Returns one Embedded Metric Format line per stage and per API operation. CloudWatch turns these into metrics
+        with the Stage or Api / Operation dimensions, the latencies go out as a histogram of Values and Counts
+        '''
+        runMetrics = self.to_dict()
+        timestamp = int(time.time() * 1000)
+        lines = []
+        for name, stage in runMetrics['stages'].items():
+            lines.append(
+                {
+                    '_aws': {
+                        'Timestamp': timestamp,
+                        'CloudWatchMetrics': [
+                            {
+                                'Namespace': namespace,
+                                'Dimensions': [['Stage']],
+                                'Metrics': [
+                                    {'Name': 'StageDuration', 'Unit': 'Seconds'},
+                                    {'Name': 'StageFailed', 'Unit': 'Count'},
+                                    {'Name': 'RecordsIn', 'Unit': 'Count'},
+                                    {'Name': 'RecordsOut', 'Unit': 'Count'},
+                                    {'Name': 'BytesSerialized', 'Unit': 'Bytes'},
+                                    {'Name': 'BytesUploaded', 'Unit': 'Bytes'},
+                                    {'Name': 'ProcessPeakRssMb', 'Unit': 'Megabytes'}
+                                ]
+                            }
+                        ]
+                    },
+                    'Stage': name,
+                    'StageDuration': stage['seconds'],
+                    'StageFailed': int(stage['status'] == 'failed'),
+                    'RecordsIn': stage['recordsIn'],
+                    'RecordsOut': stage['recordsOut'],
+                    'BytesSerialized': stage['bytesSerialized'],
+                    'BytesUploaded': stage['bytesUploaded'],
+                    'ProcessPeakRssMb': stage.get('processPeakRssMb', 0)
+                }
+            )
+        for call in runMetrics['calls'].values():
+            # Each bucket is reported at its upper bound, the overflow bucket at the slowest call seen
+            bucketValues = self.latencyBucketsMs + [max(call['maxMs'], self.latencyBucketsMs[-1])]
+            usedBuckets = [(value, count) for value, count in zip(bucketValues, call['histogram']) if count]
+            lines.append(
+                {
+                    '_aws': {
+                        'Timestamp': timestamp,
+                        'CloudWatchMetrics': [
+                            {
+                                'Namespace': namespace,
+                                'Dimensions': [['Api', 'Operation']],
+                                'Metrics': [
+                                    {'Name': 'Calls', 'Unit': 'Count'},
+                                    {'Name': 'Errors', 'Unit': 'Count'},
+                                    {'Name': 'Latency', 'Unit': 'Milliseconds'}
+                                ]
+                            }
+                        ]
+                    },
+                    'Api': call['api'],
+                    'Operation': call['operation'],
+                    'Calls': call['calls'],
+                    'Errors': call['errors'],
+                    'Latency': {
+                        'Values': [value for value, _ in usedBuckets],
+                        'Counts': [count for _, count in usedBuckets]
+                    }
+                }
+            )
+
+        return [json.dumps(line) for line in lines]
+
+# Process-wide metrics of the current run
+runMetrics = RunMetrics()
+
+def instrument_aws_client(client):
+    '''
+    Hooks a Boto3 client into the run metrics, every API call it makes is counted and timed (including its retries)
+    '''
+    def before_call(context, **kwargs):
+        context['metricsStartTime'] = time.perf_counter()
+    def after_call(event_name, context, http_response=None, **kwargs):
+        if 'metricsStartTime' not in context:
+            return
+        # Event names look like after-call.s3.PutObject
+        _, service, operation = event_name.split('.', 2)
+        error = http_response is None or http_response.status_code >= 400
+        runMetrics.record_call('aws', f'{service}.{operation}', time.perf_counter() - context.pop('metricsStartTime'), error)
+    client.meta.events.register('before-call', before_call)
+    client.meta.events.register('after-call', after_call)
+    client.meta.events.register('after-call-error', after_call)
+
+    return client
+
+def bounded_ordered_map(func, items, workers):
+    '''
+    Generator version of executor.map() which only keeps a small window of calls in flight. Results come back in input
+    order, but unlike executor.map() the whole input is not submitted (and its results buffered) up front
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        window = deque()
+        for item in items:
+            window.append(executor.submit(func, item))
+            if len(window) >= workers * 2:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+class ResponseCacheMiss(Exception):
+    '''
+    Raised in replay mode for a call whose response was never recorded
+    '''
+
+class CachedResponse():
+    '''
+    Stands in for a requests Response served from the response cache, only what the MDE callers read is provided
+    '''
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+def encode_cached_value(value):
+    # Boto3 parses timestamps into datetimes, they are tagged so a replayed response hands back the same types
+    if isinstance(value, datetime.datetime):
+        return {'$datetime': value.isoformat()}
+
+    return str(value)
+
+def decode_cached_value(value):
+    if len(value) == 1 and '$datetime' in value:
+        return datetime.datetime.fromisoformat(value['$datetime'])
+
+    return value
+
+class ResponseCache():
+    '''
+    Content-addressed on-disk cache of raw MDE and AWS API responses, so re-runs after a failed publish or a change to
+    the transforms do not collect everything again. Entries are keyed by the SHA256 of the API, operation and parameters,
+    stored gzip compressed and fresh for the TTL, expired MDE entries carrying an ETag are revalidated with If-None-Match.
+    In record mode fresh entries are served and everything else is fetched and stored, in replay mode every response
+    comes from the cache regardless of its age and a missing one fails the call. Once the cache grows past its size
+    limit the least recently used entries are evicted
+    '''
+    def __init__(self, cacheDir, mode, ttlSeconds, maxBytes):
+        if mode not in ('off', 'record', 'replay'):
+            raise ValueError(f'Unsupported RESPONSE_CACHE_MODE {mode}, use off, record or replay')
+        self.cacheDir = cacheDir
+        self.mode = mode
+        self.enabled = mode != 'off'
+        self.replay = mode == 'replay'
+        self.ttlSeconds = ttlSeconds
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        # Size of the cache directory, only walked on the first store
+        self.totalBytes = None
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'revalidated': 0,
+            'stored': 0,
+            'bytesStored': 0,
+            'evicted': 0
+        }
+
+    def count(self, stat, value=1):
+        with self.lock:
+            self.stats[stat] += value
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['mode'] = self.mode
+
+        return stats
+
+    def get_key(self, *request):
+        return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def get_path(self, key):
+        # Fan out over 256 directories so none of them holds the whole cache
+        return os.path.join(self.cacheDir, key[:2], f'{key}.gz')
+
+    def load(self, key):
+        '''
+        Returns the (metadata, raw body) of a cached response, or None
+        '''
+        path = self.get_path(key)
+        try:
+            with gzip.open(path, 'rb') as f:
+                metadata = json.loads(f.readline())
+                body = f.read()
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError) as e:
+            # A truncated or corrupt entry is treated as missing, the next store replaces it
+            print(f'Ignoring unreadable response cache entry {path}: {e}')
+            return None
+        # Eviction goes by modification time, so reading an entry marks it as recently used
+        with contextlib.suppress(OSError):
+            os.utime(path)
+
+        return metadata, body
+
+    def lookup(self, key):
+        '''
+        Returns the cached entry of a key (or None) and whether it can be served as is. In replay mode every entry can,
+        and a missing one raises a ResponseCacheMiss
+        '''
+        entry = self.load(key)
+        isFresh = entry is not None and (self.replay or time.time() - entry[0]['storedAt'] < self.ttlSeconds)
+        self.count('hits' if isFresh else 'misses')
+        if entry is None and self.replay:
+            raise ResponseCacheMiss(f'No cached response for {key} in {self.cacheDir}, record it with RESPONSE_CACHE_MODE=record first')
+
+        return entry, isFresh
+
+    def store(self, key, body, etag=None):
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        metadata = {'storedAt': time.time(), 'etag': etag}
+        data = gzip.compress(json.dumps(metadata).encode('utf-8') + b'\n' + body, compresslevel=responseCacheCompressLevel)
+        try:
+            replacedBytes = os.path.getsize(path)
+        except OSError:
+            replacedBytes = 0
+        # Write to a temporary file and rename it into place, so a concurrent or interrupted run never reads half an entry
+        tempPath = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tempPath, 'wb') as f:
+            f.write(data)
+        os.replace(tempPath, path)
+
+        with self.lock:
+            self.stats['stored'] += 1
+            self.stats['bytesStored'] += len(data)
+            if self.totalBytes is None:
+                self.totalBytes = self.get_directory_bytes()
+            else:
+                self.totalBytes += len(data) - replacedBytes
+            if self.totalBytes > self.maxBytes:
+                self.evict()
+
+    def revalidate(self, key, entry):
+        # The API confirmed the expired entry is still current, it is fresh again for another TTL
+        self.count('revalidated')
+        self.store(key, entry[1], entry[0].get('etag'))
+
+    def list_entries(self):
+        entries = []
+        for dirPath, _, fileNames in os.walk(self.cacheDir):
+            for fileName in fileNames:
+                if fileName.endswith('.gz'):
+                    path = os.path.join(dirPath, fileName)
+                    with contextlib.suppress(OSError):
+                        stat = os.stat(path)
+                        entries.append((stat.st_mtime, stat.st_size, path))
+
+        return entries
+
+    def get_directory_bytes(self):
+        return sum(size for _, size, _ in self.list_entries())
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache is back under its size limit, callers hold the lock
+        '''
+        entries = sorted(self.list_entries())
+        totalBytes = sum(size for _, size, _ in entries)
+        # Go a little further than the limit so a full cache is not walked again on every store
+        for _, size, path in entries:
+            if totalBytes <= self.maxBytes * responseCacheEvictRatio:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            totalBytes -= size
+            self.stats['evicted'] += 1
+        self.totalBytes = totalBytes
+
+    def aws_call(self, getClient, operationName, scope, **params):
+        '''
+        Makes a read-only AWS API call through the cache, scope (the Account and Region) tells identical calls apart. The
+        client is only created on a miss, so a replay neither assumes roles nor calls AWS
+        '''
+        if not self.enabled:
+            return getattr(getClient(), operationName)(**params)
+
+        key = self.get_key('aws', operationName, scope, params)
+        entry, isFresh = self.lookup(key)
+        if isFresh:
+            return json.loads(entry[1], object_hook=decode_cached_value)
+
+        response = getattr(getClient(), operationName)(**params)
+        response.pop('ResponseMetadata', None)
+        self.store(key, json.dumps(response, default=encode_cached_value).encode('utf-8'))
+
+        return response
+
+responseCacheLock = threading.Lock()
+responseCache = None
+
+def get_response_cache():
+    '''
+    Returns the process-wide ResponseCache, built on first use from RESPONSE_CACHE_MODE (or --response-cache)
+    '''
+    global responseCache
+    with responseCacheLock:
+        if responseCache is None:
+            responseCache = ResponseCache(responseCacheDir, responseCacheMode, responseCacheTtlSeconds, responseCacheMaxBytes)
+
+    return responseCache
+
+# Machine ID segment of per-machine MDE API paths
+mdeMachinePathRegex = re.compile('/machines/[^/]+(?=/|$)')
+
+# Compile Regex for EC2 Instance IDs in MDE Machine Tags
+ec2IdRegex = re.compile('(?i)\\b[a-z]+-[a-z0-9]+')
+
+def to_quicksight_timestamp(value):
+    # We have to do a hack to reformat the timestamps for QuickSight to take
+    # QUICKSIGHT FORMAT: yyyy-mm-dd HH:mm:ss
+    if value is None:
+        return None
+    datePart, _, timePart = str(value).partition('T')
+
+    return f'{datePart} {timePart.partition(".")[0]}'
+
+def to_ec2_instance_id(machineTags):
+    # EC2 Instances should be tagged with the Instance ID provided you set up properly... Machines without tags are not on AWS
+    if not machineTags:
+        return 'NON_AWS'
+    for tag in machineTags:
+        if ec2IdRegex.search(tag):
+            return str(tag)
+
+    return None
+
+def is_ec2_instance_id(instanceId):
+    # Machines which are not tagged with an Instance ID can never join to an EC2 Instance
+    return bool(instanceId) and instanceId != 'NON_AWS'
+
+def is_public_ec2_instance(i):
+    # Create our own Bool for Public-facing EC2 instances
+    return i.get('PublicIpAddress') is not None or bool(i.get('PublicDnsName'))
+
+# Transforms which can be named in a projection spec. Each one is an expression template which is inlined into the compiled
+# projection, {value} is replaced with the expression reading the source, so the common transforms cost no function call
+projectionTransforms = {
+    'str': '(None if {value} is None else str({value}))',
+    # Public DNS is cheeky and will return an empty string instead of None >:(
+    'non_empty_str': '(str({value}) if {value} else None)',
+    'quicksight_timestamp': 'to_quicksight_timestamp({value})',
+    # Only the first exploit type or URI is kept, otherwise write in String "None"
+    'first_or_none': "(str({value}[0]) if {value} else 'None')",
+    # Create a CVE URL, as the Machine Vulnerability Object does not return it...
+    'cve_url': "('https://cve.mitre.org/cgi-bin/cvename.cgi?name=%s' % ({value},))",
+    'ec2_instance_id': 'to_ec2_instance_id({value})',
+    'ec2_is_public': 'is_public_ec2_instance({value})'
+}
+
+def get_path(record, path):
+    # Walks nested dicts and lists, a missing key or index anywhere along the path gives None
+    value = record
+    for key in path:
+        try:
+            value = value[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+
+    return value
+
+def compile_projection(spec, arguments=()):
+    '''
+    Compiles a projection spec into a function which builds each output record as a single dict literal, and a batch
+    function which projects a whole list in one comprehension. Only the fields named in the spec are read from the source
+    objects, so everything else (such as the IP address details of Machines) is dropped straight away.
+
+    The fast path reads every source with plain subscripts. A record missing any of them is projected again by the safe
+    path, where a missing field is None. Sources ending in '?' are expected to be missing often and are always read safely.
+    The batch function takes any iterable - it is read into a list first, so a generator is never half consumed by the
+    fast path when the batch falls back to the safe one, and errors raised by the generator itself are not mistaken for
+    a missing field
+    '''
+    namespace = {
+        'get_path': get_path,
+        'to_quicksight_timestamp': to_quicksight_timestamp,
+        'to_ec2_instance_id': to_ec2_instance_id,
+        'is_public_ec2_instance': is_public_ec2_instance
+    }
+    fastExpressions = []
+    safeExpressions = []
+    for position, entry in enumerate(spec):
+        column, source = entry[0], entry[1]
+        transform = entry[2] if len(entry) > 2 else None
+        optional = source.endswith('?')
+        source = source.rstrip('?')
+        if source == '*':
+            fastExpression = safeExpression = 'r'
+        elif source.startswith('$'):
+            if source[1:] not in arguments:
+                raise ValueError(f'Projection column {column} reads the argument {source[1:]} which is not one of {arguments}')
+            fastExpression = safeExpression = source[1:]
+        else:
+            path = tuple(int(key) if key.isdigit() else key for key in source.split('.'))
+            namespace[f'path{position}'] = path
+            if len(path) == 1:
+                safeExpression = f'r.get({source!r})'
+            else:
+                safeExpression = f'get_path(r, path{position})'
+            fastExpression = safeExpression if optional else 'r' + ''.join(f'[{key!r}]' for key in path)
+        if transform is not None:
+            fastExpression = projectionTransforms[transform].replace('{value}', fastExpression)
+            safeExpression = projectionTransforms[transform].replace('{value}', safeExpression)
+        fastExpressions.append(f'{column!r}: {fastExpression}')
+        safeExpressions.append(f'{column!r}: {safeExpression}')
+
+    fastLiteral = '{' + ', '.join(fastExpressions) + '}'
+    safeLiteral = '{' + ', '.join(safeExpressions) + '}'
+    argumentList = ''.join(f', {argument}' for argument in arguments)
+    projectionSource = (
+        f'def project(r{argumentList}):\n'
+        f'    try:\n'
+        f'        return {fastLiteral}\n'
+        f'    except (KeyError, IndexError, TypeError):\n'
+        f'        return {safeLiteral}\n'
+        f'def project_batch(records{argumentList}):\n'
+        f'    records = list(records)\n'
+        f'    try:\n'
+        f'        return [{fastLiteral} for r in records]\n'
+        f'    except (KeyError, IndexError, TypeError):\n'
+        f'        return [project(r{argumentList}) for r in records]\n'
+    )
+    exec(projectionSource, namespace)
+
+    return namespace['project'], namespace['project_batch']
+
+# Compiled once when the module is loaded
+projectMachine, _ = compile_projection(projectionSpecs['processed_machines'])
+projectMachineVuln, projectMachineVulns = compile_projection(projectionSpecs['processed_machine_vulns'], ('machineId',))
+projectEc2Instance, projectEc2Instances = compile_projection(projectionSpecs['processed_ec2_instances'], ('accountId', 'region'))
+projectVulnCatalogEntry, _ = compile_projection(projectionSpecs['processed_vuln_catalog'])
+projectVulnEdge, _ = compile_projection(projectionSpecs['processed_machine_vuln_edges'])
+
+class StageRunner():
+    '''
+    Runs the stages of the pipeline concurrently, every stage starts as soon as the stages it depends on are done. A stage
+    whose dependency failed is skipped, but a failing stage never stops the stages which do not depend on it
+    '''
+    def __init__(self):
+        self.stages = {}
+        self.futures = {}
+
+    def add_stage(self, name, func, dependsOn=()):
+        # Dependencies have to be added first, which also rules out cycles
+        for dependency in dependsOn:
+            if dependency not in self.stages:
+                raise ValueError(f'Stage {name} depends on {dependency} which was not added before it')
+        self.stages[name] = (func, list(dependsOn))
+
+    def wait_for(self, name):
+        '''
+        Blocks until a stage is done and returns its result, raises if the stage failed. Stages can call this for any stage added before them
+        '''
+        return self.futures[name].result()
+
+    def get_future(self, name):
+        '''
+        Returns the Future of a stage, so another stage can check whether it is done without blocking on it
+        '''
+        return self.futures[name]
+
+    def run_stage(self, name):
+        func, dependsOn = self.stages[name]
+        dependencyResults = []
+        for dependency in dependsOn:
+            try:
+                dependencyResults.append(self.wait_for(dependency))
+            except Exception:
+                raise RuntimeError(f'Stage {name} was skipped because the {dependency} stage failed')
+        startTime = time.perf_counter()
+        with runMetrics.stage(name):
+            result = func(*dependencyResults)
+        print(f'Stage {name} finished in {round(time.perf_counter() - startTime, 2)} seconds.')
+
+        return result
+
+    def run(self):
+        '''
+        Runs every stage and waits for all of them, returns the results and the errors of the stages by name
+        '''
+        results = {}
+        errors = {}
+        # One thread per stage, so a stage waiting on another one can never starve it of a worker
+        with ThreadPoolExecutor(max_workers=max(len(self.stages), 1)) as executor:
+            for name in self.stages:
+                self.futures[name] = executor.submit(self.run_stage, name)
+            for name, future in self.futures.items():
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    errors[name] = e
+                    print(f'Stage {name} failed: {e}')
+
+        return results, errors
+
+class S3MultipartWriter():
+    '''
+    Write-only file-like object which streams into an S3 Multipart Upload so only a couple of parts are ever held in memory.
+    Objects smaller than a single part are sent with a plain PutObject instead. A SHA256 of the content is kept as it is written
+    '''
+    def __init__(self, bucket, key, partSize=None, executor=None, maxPendingParts=2):
+        self.bucket = bucket
+        self.key = key
+        self.partSize = partSize or s3MultipartPartSize
+        self.executor = executor
+        self.maxPendingParts = maxPendingParts
+        self.buffer = bytearray()
+        self.parts = []
+        self.pendingParts = deque()
+        self.uploadId = None
+        self.bytesWritten = 0
+        self.hasher = hashlib.sha256()
+
+    def write(self, data):
+        self.buffer += data
+        self.hasher.update(data)
+        self.bytesWritten += len(data)
+        if len(self.buffer) >= self.partSize:
+            self.flush_part()
+
+    def flush(self):
+        # Parts are only sent once they are big enough, this exists so the writer can sit underneath a GzipFile
+        pass
+
+    def get_content_hash(self):
+        return self.hasher.hexdigest()
+
+    def upload_part(self, partNumber, body):
+        r = get_s3_client().upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            PartNumber=partNumber,
+            UploadId=self.uploadId,
+            Body=body
+        )
+
+        return {'ETag': r['ETag'], 'PartNumber': partNumber}
+
+    def flush_part(self):
+        # Only start the Multipart Upload once we know the object will not fit in a single part
+        if self.uploadId is None:
+            self.uploadId = get_s3_client().create_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key
+            )['UploadId']
+        partNumber = len(self.parts) + len(self.pendingParts) + 1
+        body = bytes(self.buffer)
+        self.buffer = bytearray()
+        if self.executor is None:
+            self.parts.append(self.upload_part(partNumber, body))
+            return
+        # Upload parts in the background while the next one is being serialized, but cap how many sit in memory
+        self.pendingParts.append(self.executor.submit(self.upload_part, partNumber, body))
+        while len(self.pendingParts) > self.maxPendingParts:
+            self.parts.append(self.pendingParts.popleft().result())
+
+    def close(self):
+        if self.uploadId is None:
+            get_s3_client().put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=bytes(self.buffer)
+            )
+        else:
+            if self.buffer:
+                self.flush_part()
+            while self.pendingParts:
+                self.parts.append(self.pendingParts.popleft().result())
+            get_s3_client().complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.uploadId,
+                MultipartUpload={'Parts': self.parts}
+            )
+        self.buffer = bytearray()
+
+    def abort(self):
+        # Do not leave orphaned parts behind (and billed) if serialization fails halfway through or the content is unchanged
+        while self.pendingParts:
+            try:
+                self.pendingParts.popleft().result()
+            except Exception:
+                pass
+        if self.uploadId is not None:
+            get_s3_client().abort_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.uploadId
+            )
+        self.buffer = bytearray()
+
+class JsonArrayEncoder():
+    '''
+    Incrementally serializes records as a compact JSON array into a binary file-like writer
+    '''
+    def __init__(self, writer):
+        self.writer = writer
+        self.recordCount = 0
+        self.writer.write(b'[')
+
+    def write(self, record):
+        if self.recordCount:
+            self.writer.write(b',\n')
+        self.writer.write(json.dumps(record, default=str).encode('utf-8'))
+        self.recordCount += 1
+
+    def close(self):
+        self.writer.write(b']')
+
+def format_delimited_value(value):
+    # Flatten values so every cell is a plain string - lists (such as machineTags) are joined, objects are kept as JSON
+    if type(value) is str:
+        return value
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        return ';'.join(str(v) for v in value)
+    if isinstance(value, dict):
+        return json.dumps(value, default=str)
+
+    return str(value)
+
+class DelimitedEncoder():
+    '''
+    Incrementally serializes records as gzip compressed delimited text with a header row into a binary file-like writer,
+    only the given columns are written and in that order
+    '''
+    def __init__(self, writer, columns, delimiter, batchSize=1000):
+        # mtime and filename are pinned so the same records always compress to the same bytes (and the same content hash)
+        self.gzipWriter = gzip.GzipFile(filename='', fileobj=writer, mode='wb', compresslevel=gzipCompressLevel, mtime=0)
+        self.columns = columns
+        self.batchSize = batchSize
+        self.buffer = io.StringIO()
+        self.csvWriter = csv.writer(self.buffer, delimiter=delimiter, lineterminator='\n')
+        self.csvWriter.writerow(columns)
+        self.recordCount = 0
+
+    def write(self, record):
+        self.csvWriter.writerow([format_delimited_value(record.get(column)) for column in self.columns])
+        self.recordCount += 1
+        # Hand the text over in batches, encoding and compressing row by row is needlessly slow
+        if self.recordCount % self.batchSize == 0:
+            self.flush_buffer()
+
+    def flush_buffer(self):
+        self.gzipWriter.write(self.buffer.getvalue().encode('utf-8'))
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    def close(self):
+        self.flush_buffer()
+        self.gzipWriter.close()
+
+def get_record_encoder(writer, fileName, outputFormat, columns=None):
+    if outputFormat == 'json':
+        return JsonArrayEncoder(writer)
+
+    return DelimitedEncoder(writer, columns or datasetColumns[fileName], outputFormats[outputFormat]['delimiter'])
+
+def write_records(records, writer, fileName, outputFormat, columns=None):
+    '''
+    Serializes the records of a dataset into a binary file-like writer in the given output format, returns the record count
+    '''
+    encoder = get_record_encoder(writer, fileName, outputFormat, columns)
+    for record in records:
+        encoder.write(record)
+    encoder.close()
+
+    return encoder.recordCount
+
+def get_file_sha256(filePath):
+    hasher = hashlib.sha256()
+    with open(filePath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+class DatasetSink():
+    '''
+    Push-style writer for a single dataset handed out by S3Publisher.open_dataset(). Records are serialized as they are
+    written - straight into an S3 Multipart Upload in streaming mode, otherwise into a local file - and close() queues
+    the upload of the dataset and its Manifest. When publishing is disabled the local file is all that is written
+    '''
+    def __init__(self, publisher, fileName):
+        if outputFormat not in outputFormats:
+            raise ValueError(f'Unsupported OUTPUT_FORMAT {outputFormat}, use json, csv or tsv')
+        self.publisher = publisher
+        self.fileName = fileName
+        self.localFile = f'./{fileName}.{outputFormats[outputFormat]["extension"]}'
+        self.key = f'quicksight/{fileName}.{outputFormats[outputFormat]["extension"]}'
+        self.startTime = time.perf_counter()
+        self.records = None
+        self.encoder = None
+        # There is nothing to stream into when publishing is disabled, the dataset always goes to the local file
+        self.streaming = streamingMode and publisher.publishEnabled
+
+        if self.streaming:
+            self.writer = S3MultipartWriter(publisher.bucket, self.key, executor=publisher.executor)
+            self.encoder = get_record_encoder(self.writer, fileName, outputFormat)
+        elif outputFormat == 'json':
+            # The original indented JSON output needs the full list for json.dump()
+            self.records = []
+        else:
+            self.writer = open(self.localFile, 'wb')
+            self.encoder = get_record_encoder(self.writer, fileName, outputFormat)
+
+    def write(self, record):
+        if self.records is not None:
+            self.records.append(record)
+        else:
+            self.encoder.write(record)
+
+    def abort(self):
+        if self.streaming:
+            self.writer.abort()
+        elif self.records is None:
+            self.writer.close()
+
+    def close(self):
+        '''
+        Finishes serialization and queues the dataset (unless it is unchanged) and its Manifest for upload, returns the record count
+        '''
+        if self.streaming:
+            try:
+                self.encoder.close()
+                recordCount = self.encoder.recordCount
+                contentHash = self.writer.get_content_hash()
+                # The parts already went out, but aborting leaves the published object (and QuickSight) untouched
+                changed = not self.publisher.is_unchanged(self.key, contentHash)
+                if changed:
+                    self.writer.close()
+                else:
+                    self.writer.abort()
+            except Exception as e:
+                self.writer.abort()
+                raise e
+            byteCount = self.writer.bytesWritten
+            runMetrics.record_dataset(self.fileName, self.key, datasetStages.get(self.fileName, 'vulns'), recordCount, byteCount)
+            self.publisher.record_object(self.key, contentHash, byteCount, time.perf_counter() - self.startTime, changed)
+        else:
+            if self.records is not None:
+                recordCount = len(self.records)
+                with open(self.localFile, 'w') as jsonfile:
+                    json.dump(self.records, jsonfile, indent=4, default=str)
+                self.records = None
+            else:
+                self.encoder.close()
+                self.writer.close()
+                recordCount = self.encoder.recordCount
+
+            byteCount = os.path.getsize(self.localFile)
+            # Recorded before the upload is queued so its bytes are credited to the dataset
+            runMetrics.record_dataset(self.fileName, self.key, datasetStages.get(self.fileName, 'vulns'), recordCount, byteCount)
+
+            if not self.publisher.publishEnabled:
+                print(f'{recordCount} records for {self.fileName} written to {self.localFile}, publishing is skipped.')
+                return recordCount
+
+            contentHash = get_file_sha256(self.localFile)
+            changed = not self.publisher.is_unchanged(self.key, contentHash)
+            if changed:
+                self.publisher.submit(self.publisher.upload_file, self.key, self.localFile, contentHash)
+            else:
+                self.publisher.record_object(self.key, contentHash, byteCount, 0, False)
+
+        if changed:
+            with self.publisher.lock:
+                self.publisher.changedDatasets.add(self.fileName)
+        self.publisher.submit(self.publisher.put_manifest, self.fileName, self.key)
+        print(f'{recordCount} records for {self.fileName} serialized and queued for S3.')
+
+        return recordCount
+
+def write_shard(records, localPath, fileName, outputFormat, columns, snapshotDate, copyRecords=False):
+    '''
+    Serializes one shard of a partitioned dataset into a local file, runs in a worker process so shards are serialized
+    (and compressed) in parallel. Returns the record count, byte count and SHA256 of the file. The records are stamped
+    with the snapshot date in place unless copyRecords is set
+    '''
+    if copyRecords:
+        # The records still belong to the caller, so every one is stamped on a copy as it is serialized
+        records = (dict(record, **{snapshotColumn: snapshotDate}) for record in records)
+    else:
+        # Records unpickled in a worker process are its own copies, so they can be stamped in place
+        for record in records:
+            record[snapshotColumn] = snapshotDate
+    os.makedirs(os.path.dirname(localPath), exist_ok=True)
+    with open(localPath, 'wb') as f:
+        recordCount = write_records(records, f, fileName, outputFormat, columns)
+
+    return recordCount, os.path.getsize(localPath), get_file_sha256(localPath)
+
+def get_partition_day(daysAgo=0):
+    # Partitions are named after the UTC day the run started on
+    return time.strftime('%Y-%m-%d', time.gmtime(runMetrics.startedAt - daysAgo * 86400))
+
+class PartitionedDatasetSink():
+    '''
+    DatasetSink for the partitioned layout. Records are split by Account and Region (for the datasets which have them)
+    into shards of at most PARTITION_SHARD_RECORDS records under the partition of the day, serialized in the publisher's
+    process pool while the next shards fill up, and uploaded like any other object unless their content is unchanged.
+    close() also queues the Manifest and the clean up of partitions which fell out of the retention window
+    '''
+    def __init__(self, publisher, fileName):
+        if outputFormat not in outputFormats:
+            raise ValueError(f'Unsupported OUTPUT_FORMAT {outputFormat}, use json, csv or tsv')
+        self.publisher = publisher
+        self.fileName = fileName
+        self.datasetPrefix = f'{partitionedKeyPrefix}{fileName}/'
+        self.snapshotDate = get_partition_day()
+        self.columns = get_dataset_columns(fileName)
+        self.partitionColumns = [column for column in partitionColumns if column in datasetColumns[fileName]]
+        self.startTime = time.perf_counter()
+        self.buffers = {}
+        self.shardCounts = {}
+        # (key, local path, future) of every shard, and the futures still being serialized
+        self.shards = []
+        self.pendingShards = deque()
+
+    def write(self, record):
+        partition = '/'.join(f'{column.lower()}={record.get(column) or "unknown"}' for column in self.partitionColumns)
+        buffer = self.buffers.setdefault(partition, [])
+        buffer.append(record)
+        if len(buffer) >= partitionShardRecords:
+            self.flush_shard(partition)
+
+    def flush_shard(self, partition):
+        records = self.buffers.pop(partition, [])
+        shardNumber = self.shardCounts.get(partition, 0)
+        self.shardCounts[partition] = shardNumber + 1
+        partitionPath = f'dt={self.snapshotDate}/{partition}/' if partition else f'dt={self.snapshotDate}/'
+        key = f'{self.datasetPrefix}{partitionPath}part-{shardNumber:05d}.{outputFormats[outputFormat]["extension"]}'
+        localPath = os.path.join(partitionedLocalDir, key[len(partitionedKeyPrefix):])
+        shardArgs = (records, localPath, self.fileName, outputFormat, self.columns, self.snapshotDate)
+        if partitionWorkers <= 1:
+            # With a single CPU shipping the records to another process only adds pickling, serialize them right here
+            future = Future()
+            try:
+                future.set_result(write_shard(*shardArgs, copyRecords=True))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            future = self.publisher.get_shard_pool().submit(write_shard, *shardArgs)
+        self.shards.append((key, localPath, future))
+        # Only a couple of shards per worker wait on the pool, so memory stays bounded however large the dataset is
+        self.pendingShards.append(future)
+        while len(self.pendingShards) > partitionWorkers * 2:
+            self.pendingShards.popleft().result()
+
+    def abort(self):
+        for _, _, future in self.shards:
+            future.cancel()
+        for _, _, future in self.shards:
+            with contextlib.suppress(Exception):
+                future.result()
+        self.buffers = {}
+
+    def close(self):
+        '''
+        Finishes serialization and queues the changed shards, the Manifest and the partition clean up, returns the record count
+        '''
+        # An empty dataset still gets one (empty) shard, so the Manifest always has something to point at
+        for partition in list(self.buffers) or ([''] if not self.shards else []):
+            self.flush_shard(partition)
+        try:
+            shardResults = [(key, localPath) + future.result() for key, localPath, future in self.shards]
+        except Exception as e:
+            self.abort()
+            raise e
+
+        recordCount = sum(shardRecords for _, _, shardRecords, _, _ in shardResults)
+        byteCount = sum(shardBytes for _, _, _, shardBytes, _ in shardResults)
+        # Keyed by the dataset prefix, so the bytes of every shard are credited to the dataset
+        runMetrics.record_dataset(self.fileName, self.datasetPrefix, datasetStages.get(self.fileName, 'vulns'), recordCount, byteCount)
+        if not self.publisher.publishEnabled:
+            print(f'{recordCount} records for {self.fileName} written to {len(shardResults)} shards under {partitionedLocalDir}, publishing is skipped.')
+            return recordCount
+
+        changed = False
+        for key, localPath, _, shardBytes, contentHash in shardResults:
+            if self.publisher.is_unchanged(key, contentHash):
+                self.publisher.record_object(key, contentHash, shardBytes, 0, False)
+            else:
+                changed = True
+                self.publisher.submit(self.publisher.upload_file, key, localPath, contentHash)
+        if changed:
+            with self.publisher.lock:
+                self.publisher.changedDatasets.add(self.fileName)
+        self.publisher.submit(self.publisher.publish_partitions, self.fileName, [key for key, _, _, _, _ in shardResults])
+        print(f'{recordCount} records for {self.fileName} serialized into {len(shardResults)} shards in {round(time.perf_counter() - self.startTime, 2)} seconds and queued for S3.')
+
+        return recordCount
+
+class S3Publisher():
+    '''
+    Publishes datasets and their QuickSight Manifests to S3. Uploads run concurrently on a small pool of workers, objects
+    whose SHA256 matches what was published last time are skipped, and bytes and time are reported for every object.
+    The hashes are kept in a small JSON state object in the same bucket. With publishEnabled False nothing is read from or
+    written to S3 and the datasets are only written locally
+    '''
+    def __init__(self, bucket, stateKey, publishEnabled=True):
+        self.bucket = bucket
+        self.stateKey = stateKey
+        self.publishEnabled = publishEnabled
+        self.executor = ThreadPoolExecutor(max_workers=s3UploadWorkers)
+        self.lock = threading.Lock()
+        self.futures = []
+        self.publishedCallbacks = []
+        self.objectReport = []
+        self.changedDatasets = set()
+        self.shardPool = None
+        self.publishedHashes = self.load_state()
+
+    def load_state(self):
+        if not self.publishEnabled:
+            return {}
+        try:
+            stateBody = get_s3_client().get_object(
+                Bucket=self.bucket,
+                Key=self.stateKey
+            )['Body'].read()
+            return json.loads(stateBody)
+        except botocore.exceptions.ClientError as error:
+            # Nothing was published yet, every object will be uploaded
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return {}
+            else:
+                raise error
+
+    def is_unchanged(self, key, contentHash):
+        with self.lock:
+            return self.publishedHashes.get(key) == contentHash
+
+    def record_object(self, key, contentHash, byteCount, elapsed, uploaded):
+        with self.lock:
+            if uploaded:
+                self.publishedHashes[key] = contentHash
+            self.objectReport.append(
+                {
+                    'key': key,
+                    'bytes': byteCount,
+                    'seconds': round(elapsed, 3),
+                    'uploaded': uploaded
+                }
+            )
+        if uploaded:
+            runMetrics.record_upload(key, byteCount)
+            print(f'Uploaded s3://{self.bucket}/{key} - {byteCount} bytes in {round(elapsed, 2)} seconds.')
+        else:
+            print(f'Skipped s3://{self.bucket}/{key} - {byteCount} bytes unchanged since the last run.')
+
+    def put_object(self, key, body):
+        startTime = time.perf_counter()
+        contentHash = hashlib.sha256(body).hexdigest()
+        if self.is_unchanged(key, contentHash):
+            self.record_object(key, contentHash, len(body), time.perf_counter() - startTime, False)
+            return False
+        get_s3_client().put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=body
+        )
+        self.record_object(key, contentHash, len(body), time.perf_counter() - startTime, True)
+
+        return True
+
+    def put_manifest(self, fileName, key):
+        # Generate a QuickSight Manifest - the Manifest Key never changes so the Data Sources do not care which format is used
+        manifest = {
+            'fileLocations':[
+                {
+                    'URIs':[
+                        f'https://{self.bucket}.s3.{get_aws_region()}.amazonaws.com/{key}'
+                    ]
+                }
+            ],
+            'globalUploadSettings': outputFormats[outputFormat]['uploadSettings']
+        }
+
+        return self.put_object(f'quicksight/{fileName}_manifest.json', json.dumps(manifest, indent=2).encode('utf-8'))
+
+    def get_shard_pool(self):
+        # Serializing and compressing is CPU bound, so partitioned datasets get a pool of processes rather than threads
+        with self.lock:
+            if self.shardPool is None:
+                self.shardPool = ProcessPoolExecutor(max_workers=partitionWorkers)
+
+            return self.shardPool
+
+    def shutdown_shard_pool(self):
+        with self.lock:
+            shardPool = self.shardPool
+            self.shardPool = None
+        if shardPool is not None:
+            shardPool.shutdown()
+
+    def list_keys(self, prefix):
+        keys = []
+        for page in get_s3_client().get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix):
+            keys.extend(o['Key'] for o in page.get('Contents', []))
+
+        return keys
+
+    def publish_partitions(self, fileName, shardKeys):
+        '''
+        Writes the Manifest of a partitioned dataset - the shards written today by URI and the earlier days within
+        PARTITION_MANIFEST_DAYS by URIPrefix, those are never uploaded again - then deletes the partitions older than
+        PARTITION_RETENTION_DAYS along with shards of today which this run did not write
+        '''
+        datasetPrefix = f'{partitionedKeyPrefix}{fileName}/'
+        today = get_partition_day()
+        oldestManifestDay = get_partition_day(max(min(partitionManifestDays, partitionRetentionDays), 1) - 1)
+        oldestRetainedDay = get_partition_day(max(partitionRetentionDays, 1) - 1)
+        shardKeySet = set(shardKeys)
+        manifestDays = set()
+        expiredKeys = []
+        for key in self.list_keys(datasetPrefix):
+            day = key[len(datasetPrefix):].split('/', 1)[0].partition('dt=')[2]
+            if day < oldestRetainedDay or (day == today and key not in shardKeySet):
+                expiredKeys.append(key)
+            elif oldestManifestDay <= day < today:
+                manifestDays.add(day)
+
+        objectUrl = f'https://{self.bucket}.s3.{get_aws_region()}.amazonaws.com/'
+        fileLocations = [{'URIs': [f'{objectUrl}{key}' for key in shardKeys]}]
+        if manifestDays:
+            fileLocations.append({'URIPrefixes': [f'{objectUrl}{datasetPrefix}dt={day}/' for day in sorted(manifestDays)]})
+        manifest = {
+            'fileLocations': fileLocations,
+            'globalUploadSettings': outputFormats[outputFormat]['uploadSettings']
+        }
+        # A day falling out of the window changes the Manifest, so the Data Set is refreshed even if no shard changed
+        if self.put_object(f'quicksight/{fileName}_manifest.json', json.dumps(manifest, indent=2).encode('utf-8')):
+            with self.lock:
+                self.changedDatasets.add(fileName)
+
+        # Only delete once the new Manifest no longer points at anything being deleted
+        for i in range(0, len(expiredKeys), 1000):
+            batch = expiredKeys[i:i + 1000]
+            get_s3_client().delete_objects(
+                Bucket=self.bucket,
+                Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True}
+            )
+        if expiredKeys:
+            with self.lock:
+                for key in expiredKeys:
+                    self.publishedHashes.pop(key, None)
+            print(f'Deleted {len(expiredKeys)} expired shards of {fileName}, partitions before {oldestRetainedDay} are not kept.')
+
+    def upload_file(self, key, filePath, contentHash):
+        startTime = time.perf_counter()
+        get_s3_client().upload_file(
+            filePath,
+            self.bucket,
+            key
+        )
+        self.record_object(key, contentHash, os.path.getsize(filePath), time.perf_counter() - startTime, True)
+
+    def submit(self, fn, *args):
+        with self.lock:
+            self.futures.append(self.executor.submit(fn, *args))
+
+    def after_publish(self, callback):
+        '''
+        Runs callback once wait_for_uploads() found every upload succeeded, for state which must not get ahead of what is in S3
+        '''
+        with self.lock:
+            self.publishedCallbacks.append(callback)
+
+    def open_dataset(self, fileName):
+        '''
+        Returns a DatasetSink so records can be pushed into several datasets from a single pass over a stream
+        '''
+        if partitionedOutput:
+            return PartitionedDatasetSink(self, fileName)
+
+        return DatasetSink(self, fileName)
+
+    def publish_dataset(self, fileName, records):
+        '''
+        Serializes every record of an iterable into a dataset and queues it and its Manifest for upload, returns the record count
+        '''
+        sink = self.open_dataset(fileName)
+        try:
+            for record in records:
+                sink.write(record)
+        except Exception as e:
+            sink.abort()
+            raise e
+
+        return sink.close()
+
+    def wait_for_uploads(self):
+        '''
+        Blocks until every queued upload is done, persists the content hashes and returns the names of changed datasets
+        '''
+        with self.lock:
+            futures = self.futures
+            self.futures = []
+        errors = []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(e)
+        # Every shard was serialized before its upload was queued, the worker processes are not needed any more
+        self.shutdown_shard_pool()
+
+        # Persist hashes for everything that did upload, even if something else failed
+        if self.publishEnabled:
+            get_s3_client().put_object(
+                Bucket=self.bucket,
+                Key=self.stateKey,
+                Body=json.dumps(self.publishedHashes, indent=2).encode('utf-8')
+            )
+        uploadedBytes = sum(o['bytes'] for o in self.objectReport if o['uploaded'])
+        skippedCount = len([o for o in self.objectReport if not o['uploaded']])
+        print(f'S3 publishing complete. {uploadedBytes} bytes uploaded, {skippedCount} unchanged objects skipped.')
+
+        with self.lock:
+            publishedCallbacks = self.publishedCallbacks
+            self.publishedCallbacks = []
+        if errors:
+            raise errors[0]
+        for callback in publishedCallbacks:
+            callback()
+
+        return set(self.changedDatasets)
+
+s3PublisherLock = threading.Lock()
+s3Publisher = None
+
+def get_s3_publisher():
+    '''
+    Returns the process-wide S3Publisher so every stage shares one upload pool and one set of content hashes
+    '''
+    global s3Publisher
+    with s3PublisherLock:
+        if s3Publisher is None:
+            if publishEnabled:
+                s3Publisher = S3Publisher(get_required_env('QUICKSIGHT_S3_BUCKET_NAME'), publishStateKey)
+            else:
+                s3Publisher = S3Publisher(os.environ.get('QUICKSIGHT_S3_BUCKET_NAME', ''), publishStateKey, publishEnabled=False)
+
+    return s3Publisher
+
+class RunLock():
+    '''
+    Lease on the run lock object in S3. It is taken with a conditional PutObject (If-None-Match), so only one run can
+    create it, and a lease which expired because its holder died is taken over with If-Match on the ETag that was read
+    '''
+    def __init__(self, bucket, key, waitSeconds):
+        self.bucket = bucket
+        self.key = key
+        self.waitSeconds = waitSeconds
+        self.owner = f'{socket.gethostname()}-{os.getpid()}-{random.getrandbits(32):08x}'
+        self.etag = None
+        self.holder = None
+
+    def put_lease(self, **conditions):
+        lease = {'owner': self.owner, 'expiresAt': time.time() + runLockLeaseSeconds}
+        try:
+            self.etag = get_s3_client().put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=json.dumps(lease).encode('utf-8'),
+                **conditions
+            )['ETag']
+            return True
+        except botocore.exceptions.ClientError as error:
+            # Someone else created or took over the lock in the meantime
+            if error.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict', 'NoSuchKey'):
+                return False
+            raise error
+
+    def read_lease(self):
+        try:
+            response = get_s3_client().get_object(Bucket=self.bucket, Key=self.key)
+        except botocore.exceptions.ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None, None
+            raise error
+
+        return json.loads(response['Body'].read()), response['ETag']
+
+    def try_acquire(self):
+        if self.put_lease(IfNoneMatch='*'):
+            return True
+        lease, etag = self.read_lease()
+        # Released since, the next attempt creates it again
+        if lease is None:
+            return False
+        self.holder = lease
+        if lease['expiresAt'] > time.time():
+            return False
+        print(f'The run lock lease of {lease["owner"]} expired, taking it over')
+
+        return self.put_lease(IfMatch=etag)
+
+    def acquire(self):
+        deadline = time.time() + self.waitSeconds
+        while not self.try_acquire():
+            if time.time() >= deadline:
+                raise RuntimeError(
+                    f'The run lock s3://{self.bucket}/{self.key} is held by {self.holder["owner"]} until '
+                    f'{datetime.datetime.fromtimestamp(self.holder["expiresAt"], datetime.timezone.utc).isoformat()}, '
+                    f'gave up after waiting {self.waitSeconds} seconds'
+                )
+            time.sleep(runLockPollSeconds)
+        print(f'Holding the run lock s3://{self.bucket}/{self.key}')
+
+    def release(self):
+        # Only our own lease is deleted - if it expired and was taken over, the new holder keeps it
+        lease, etag = self.read_lease()
+        if lease is None or etag != self.etag:
+            print('The run lock lease expired and was taken over before the run finished')
+            return
+        get_s3_client().delete_object(Bucket=self.bucket, Key=self.key)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+def hold_run_lock(waitSeconds=None):
+    '''
+    Returns the run lock to hold while a run publishes, nothing is locked when publishing is disabled
+    '''
+    if not publishEnabled:
+        return contextlib.nullcontext()
+
+    return RunLock(get_required_env('QUICKSIGHT_S3_BUCKET_NAME'), runLockKey, runLockWaitSeconds if waitSeconds is None else waitSeconds)
+
+def get_target_aws_accounts():
+    '''
+    Returns the AWS Accounts to inventory - only the one we run in, unless organization mode is on
+    '''
+    if not organizationMode:
+        return [get_aws_account_id()]
+    if orgAccountIds:
+        print(f'Organization mode: inventorying the {len(orgAccountIds)} Accounts in ORG_ACCOUNT_IDS')
+        return orgAccountIds
+
+    organizations = None
+    def get_organizations():
+        nonlocal organizations
+        if organizations is None:
+            organizations = instrument_aws_client(boto3.client('organizations', config=config))
+        return organizations
+
+    accountList = []
+    # Paged by hand rather than with a paginator so every page goes through the response cache
+    params = {}
+    while True:
+        page = get_response_cache().aws_call(get_organizations, 'list_accounts', [get_aws_account_id()], **params)
+        for account in page['Accounts']:
+            # Suspended Accounts cannot be assumed into
+            if account['Status'] == 'ACTIVE':
+                accountList.append(account['Id'])
+        if not page.get('NextToken'):
+            break
+        params = {'NextToken': page['NextToken']}
+    print(f'Organization mode: inventorying {len(accountList)} active Accounts of the AWS Organization')
+
+    return accountList
+
+def get_opted_in_aws_regions(accountId):
+    region = get_aws_region()
+    print(f'Getting all AWS Regions for Account {accountId}')
     # create empty list for all opted-in Regions
     regionList = []
 
-    try:
-        # Get all Regions we are opted in for
-        for r in ec2.describe_regions()['Regions']:
-            regionName = str(r['RegionName'])
-            optInStatus = str(r['OptInStatus'])
-            if optInStatus == 'not-opted-in':
-                pass
-            else:
-                regionList.append(regionName)
-        
-        print('All Regions retrieved from EC2 service')
-    except Exception as e:
-        raise e
-        
-    print('Got all AWS Regions')
+    try:
+        # Get all Regions we are opted in for
+        regions = get_response_cache().aws_call(
+            lambda: get_account_sessions().client(accountId, 'ec2', region),
+            'describe_regions',
+            [accountId, region]
+        )
+        for r in regions['Regions']:
+            regionName = str(r['RegionName'])
+            optInStatus = str(r['OptInStatus'])
+            if optInStatus == 'not-opted-in':
+                pass
+            else:
+                regionList.append(regionName)
+        
+        print('All Regions retrieved from EC2 service')
+    except Exception as e:
+        raise e
+        
+    print('Got all AWS Regions')
+
+    return regionList
+
+def get_mde_operation(url):
+    # Metrics are kept per endpoint, so the Machine ID in per-machine paths is replaced with a placeholder
+    return mdeMachinePathRegex.sub('/machines/{id}', urlsplit(url).path)
+
+def get_retry_after_seconds(response):
+    '''
+    Returns the Retry-After of a response in seconds, given either as a number of seconds or as an HTTP date, or None
+    '''
+    retryAfter = response.headers.get('Retry-After')
+    if not retryAfter:
+        return None
+    try:
+        return max(float(retryAfter), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(retryAfter).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+class MdeClient():
+    '''
+    Shared client for the MDE API. The Azure App credentials are read from SSM once, the OAuth token is cached and
+    transparently refreshed shortly before it expires, and every call goes through one pooled, keep-alive requests Session.
+    Calls draw from one RateLimiter shared by every worker (Advanced Hunting queries from their own one), 429s and transient
+    errors are retried after the Retry-After or a jittered backoff, and the time spent throttled is counted
+    '''
+    def __init__(self, poolSize=None, limiter=None, huntingLimiter=None):
+        self.tokenLock = threading.Lock()
+        self.token = None
+        self.tokenExpiresOn = 0
+        self.credentials = None
+        self.tenantId = None
+        self.limiter = limiter or RateLimiter(mdeCallsPerMinute, mdeCallsPerHour, mdeApiBurst)
+        self.huntingLimiter = huntingLimiter or RateLimiter(mdeHuntingCallsPerMinute, mdeHuntingCallsPerHour, min(mdeApiBurst, mdeHuntingWorkers))
+        self.statsLock = threading.Lock()
+        self.stats = {
+            'calls': 0,
+            'throttled': 0,
+            'retries': 0,
+            'throttledSeconds': 0.0,
+            'backoffSeconds': 0.0
+        }
+
+        # Size the connection pool so every concurrent worker can keep its own connection alive
+        poolSize = poolSize or max(mdeVulnWorkers, 10)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=poolSize,
+            pool_maxsize=poolSize
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get_credentials(self):
+        tenantIdParam = get_required_env('AZURE_APP_TENANT_ID_PARAM')
+        clientIdParam = get_required_env('AZURE_APP_CLIENT_ID_PARAM')
+        secretIdParam = get_required_env('AZURE_APP_SECRET_ID_PARAM')
+        # Read all three SSM Parameters in a single call
+        ssm = instrument_aws_client(boto3.client('ssm'))
+        response = ssm.get_parameters(
+            Names=[tenantIdParam, clientIdParam, secretIdParam],
+            WithDecryption=True
+        )
+        if response['InvalidParameters']:
+            raise ValueError(f'SSM Parameters not found: {response["InvalidParameters"]}')
+        paramValues = {p['Name']: p['Value'] for p in response['Parameters']}
+
+        print('SSM Parameters processed')
+
+        return paramValues[tenantIdParam], paramValues[clientIdParam], paramValues[secretIdParam]
+
+    def get_tenant_id(self):
+        '''
+        Returns the Azure AD tenant ID the client calls MDE for. A replay only reads the tenant ID Parameter, the client ID
+        and secret are not needed to serve cached responses
+        '''
+        with self.tokenLock:
+            if self.tenantId is None:
+                if self.credentials is None and get_response_cache().replay:
+                    tenantIdParam = get_required_env('AZURE_APP_TENANT_ID_PARAM')
+                    response = instrument_aws_client(boto3.client('ssm')).get_parameters(Names=[tenantIdParam], WithDecryption=True)
+                    if response['InvalidParameters']:
+                        raise ValueError(f'SSM Parameters not found: {response["InvalidParameters"]}')
+                    self.tenantId = response['Parameters'][0]['Value']
+                else:
+                    if self.credentials is None:
+                        self.credentials = self.get_credentials()
+                    self.tenantId = self.credentials[0]
+
+            return self.tenantId
+
+    def get_token(self):
+        # Workers can ask for the token at the same time, only one of them should ever refresh it
+        with self.tokenLock:
+            if self.token and time.time() < self.tokenExpiresOn - mdeTokenRefreshMarginSeconds:
+                return self.token
+
+            if self.credentials is None:
+                self.credentials = self.get_credentials()
+            tenantId, clientId, secretId = self.credentials
+
+            tokenUrl = f'{mdeLoginUrl}/{tenantId}/oauth2/token'
+            resourceAppIdUri = 'https://api.securitycenter.microsoft.com'
+
+            data = {
+                'grant_type': 'client_credentials',
+                'client_id': clientId,
+                'resource' : resourceAppIdUri,
+                'client_secret': secretId
+            }
+
+            startTime = time.perf_counter()
+            r = self.session.post(
+                tokenUrl,
+                data=data,
+                timeout=mdeRequestTimeoutSeconds
+            )
+            runMetrics.record_call('azure_ad', 'token', time.perf_counter() - startTime, r.status_code >= 400)
+            r.raise_for_status()
+            tokenResponse = r.json()
+
+            self.token = tokenResponse['access_token']
+            # The v1 endpoint returns an absolute epoch in expires_on, fall back to expires_in if it is missing
+            if 'expires_on' in tokenResponse:
+                self.tokenExpiresOn = int(tokenResponse['expires_on'])
+            else:
+                self.tokenExpiresOn = time.time() + int(tokenResponse.get('expires_in', 3599))
+
+            print('OAuth Token created')
+
+            del data
+
+            return self.token
+
+    def count(self, stat, value=1):
+        with self.statsLock:
+            self.stats[stat] += value
+
+    def get_stats(self):
+        with self.statsLock:
+            stats = dict(self.stats)
+        stats['rateLimitWaitSeconds'] = self.limiter.waitedSeconds + self.huntingLimiter.waitedSeconds
+        for stat in ('throttledSeconds', 'backoffSeconds', 'rateLimitWaitSeconds'):
+            stats[stat] = round(stats[stat], 1)
+
+        return stats
+
+    def get(self, url, params=None, latencies=None):
+        return self.request('GET', url, params=params, latencies=latencies)
+
+    def post(self, url, body, latencies=None, timeout=mdeRequestTimeoutSeconds, limiter=None):
+        return self.request('POST', url, body=body, latencies=latencies, timeout=timeout, limiter=limiter)
+
+    def request(self, method, url, params=None, body=None, latencies=None, timeout=mdeRequestTimeoutSeconds, limiter=None):
+        '''
+        Makes a rate limited call and returns the successful response, retrying 429s, 5xx responses and connection errors.
+        Any other error status raises an HTTPError. The latency of the call which succeeded is added to latencies. With
+        the response cache on, successful responses are stored and cached ones may be served instead. The call draws from
+        limiter when one is given, from the client's shared one otherwise
+        '''
+        limiter = limiter or self.limiter
+        # Fresh cached responses skip the rate budget and the token altogether, expired ones with an ETag are revalidated
+        responseCache = get_response_cache()
+        cacheKey = None
+        cachedEntry = None
+        if responseCache.enabled:
+            # Keyed by the path and query rather than the whole URL, so nextLinks and the base URL do not split the cache,
+            # and by the tenant ID (not the name of its SSM Parameter) so two tenants sharing a cache directory are kept apart
+            urlParts = urlsplit(url)
+            cacheKey = responseCache.get_key('mde', self.get_tenant_id(), method, urlParts.path, urlParts.query, params, body)
+            cachedEntry, isFresh = responseCache.lookup(cacheKey)
+            if isFresh:
+                return CachedResponse(cachedEntry[1])
+        etag = cachedEntry[0].get('etag') if cachedEntry is not None else None
+
+        attempt = 0
+        operation = get_mde_operation(url)
+        while True:
+            limiter.wait()
+            headers = {'Authorization': f'Bearer {self.get_token()}'}
+            if etag:
+                headers['If-None-Match'] = etag
+            # Only time the HTTP call itself, not the time spent waiting on the shared rate budget or backing off
+            startTime = time.perf_counter()
+            try:
+                r = self.session.request(
+                    method,
+                    url,
+                    headers=headers,
+                    params=params,
+                    json=body,
+                    timeout=timeout
+                )
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                runMetrics.record_call('mde', operation, time.perf_counter() - startTime, True)
+                if attempt >= mdeMaxRetries:
+                    raise e
+                r = None
+            self.count('calls')
+
+            if r is not None:
+                runMetrics.record_call('mde', operation, time.perf_counter() - startTime, r.status_code >= 400)
+            if r is not None and r.status_code == 304 and cachedEntry is not None:
+                # Not modified, the API did not send the body again
+                if latencies is not None:
+                    latencies.append(time.perf_counter() - startTime)
+                responseCache.revalidate(cacheKey, cachedEntry)
+                return CachedResponse(cachedEntry[1])
+            if r is not None and r.status_code < 400:
+                if latencies is not None:
+                    latencies.append(time.perf_counter() - startTime)
+                if cacheKey is not None:
+                    responseCache.store(cacheKey, r.content, r.headers.get('ETag'))
+                return r
+            if r is not None and r.status_code == 401 and attempt == 0:
+                # The token can be revoked or expire early, drop it so the retry fetches a new one
+                with self.tokenLock:
+                    self.token = None
+            elif r is not None and (r.status_code not in mdeRetryStatusCodes or attempt >= mdeMaxRetries):
+                r.raise_for_status()
+
+            # Full jitter keeps the workers which were throttled together from all retrying at the same moment
+            delay = random.uniform(0, min(mdeBackoffMaxSeconds, mdeBackoffBaseSeconds * 2 ** attempt))
+            retryAfter = get_retry_after_seconds(r) if r is not None else None
+            if r is not None and r.status_code == 429:
+                self.count('throttled')
+                if retryAfter is not None:
+                    delay = retryAfter
+                # The quota is shared, so every worker waits out the throttling instead of only this one
+                limiter.pause(delay)
+                self.count('throttledSeconds', delay)
+            else:
+                if retryAfter is not None:
+                    delay = retryAfter
+                self.count('backoffSeconds', delay)
+            self.count('retries')
+            attempt += 1
+            time.sleep(delay)
+
+mdeClientLock = threading.Lock()
+mdeClient = None
+
+def get_mde_client():
+    '''
+    Returns the process-wide MdeClient so every stage reuses the same token and connection pool
+    '''
+    global mdeClient
+    with mdeClientLock:
+        if mdeClient is None:
+            mdeClient = MdeClient()
+
+    return mdeClient
+
+def run_hunting_query(query, client, latencies=None):
+    '''
+    Runs an Advanced Hunting (KQL) query and returns its result rows, already projected server-side
+    '''
+    r = client.post(
+        f'{mdeApiUrl}/api/advancedqueries/run',
+        {'Query': query},
+        latencies=latencies,
+        timeout=mdeHuntingTimeoutSeconds,
+        limiter=client.huntingLimiter
+    )
+
+    return r.json()['Results']
+
+def get_hunting_chunk(query, hashColumn, chunk, chunkCount, client, latencies, stageName):
+    '''
+    Runs the hash(hashColumn, chunkCount) == chunk slice of a query. A slice which comes back at the row limit may have been
+    cut short, so it is split in two and both halves are run instead - the rows of hash(x, 2N) == i and hash(x, 2N) == i + N
+    are exactly the rows of hash(x, N) == i
+    '''
+    rows = run_hunting_query(
+        query.replace('{chunk}', f'| where hash({hashColumn}, {chunkCount}) == {chunk}'),
+        client,
+        latencies
+    )
+    if len(rows) < mdeHuntingMaxRows:
+        return rows
+    if chunkCount * 2 > mdeHuntingMaxChunkCount:
+        raise ValueError(f'Advanced Hunting query slice {chunk} of {chunkCount} still returns {len(rows)} rows, the limit is {mdeHuntingMaxRows}')
+    runMetrics.count(stageName, 'huntingChunksSplit')
+
+    return (
+        get_hunting_chunk(query, hashColumn, chunk, chunkCount * 2, client, latencies, stageName) +
+        get_hunting_chunk(query, hashColumn, chunk + chunkCount, chunkCount * 2, client, latencies, stageName)
+    )
+
+def iter_hunting_rows(queryName, hashColumn, client, stageName):
+    '''
+    Generator which runs the slices of one of the huntingQueries concurrently and yields the rows of each slice in turn
+    '''
+    latencies = []
+    rowCount = 0
+    chunks = bounded_ordered_map(
+        lambda chunk: get_hunting_chunk(huntingQueries[queryName], hashColumn, chunk, mdeHuntingChunks, client, latencies, stageName),
+        range(mdeHuntingChunks),
+        mdeHuntingWorkers
+    )
+    for rows in chunks:
+        runMetrics.count(stageName, 'recordsIn', len(rows))
+        rowCount += len(rows)
+        yield from rows
+
+    print(f'Advanced Hunting query {queryName} returned {rowCount} rows in {len(latencies)} queries. Per-query latency (ms): {get_latency_percentiles(latencies)}')
+
+def iter_hunting_machines(client):
+    '''
+    Generator which yields every active MDE Machine from the DeviceInfo table, Inactive ones are already filtered out
+    '''
+    for machine in iter_hunting_rows('machines', 'DeviceId', client, 'machines'):
+        machine['instanceId'] = to_ec2_instance_id(machine['machineTags'])
+        yield machine
+
+def iter_machines(client):
+    '''
+    Generator which yields every shaped, active MDE Machine, page by page
+    '''
+    # The API filters the Machines so Inactive ones are left out, with MDE_MACHINES_SELECT it only returns the fields we publish
+    params = {'$top': mdeMachinesPageSize}
+    if mdeMachinesFilter:
+        params['$filter'] = mdeMachinesFilter
+    if mdeMachinesSelect:
+        params['$select'] = ','.join(mdeMachineSelectFields)
+
+    latencies = []
+    machineCount = 0
+    while True:
+        try:
+            for v in get_mde_pages(f'{mdeApiUrl}/api/machines', client, params, latencies):
+                machineCount += 1
+                # Still skip "Inactive" Machines here in case the filter is changed, the projection then pulls out the EC2
+                # Instance ID from the Machine Tags
+                if str(v['healthStatus']) != 'Inactive':
+                    yield projectMachine(v)
+            break
+        except requests.exceptions.HTTPError as e:
+            # Only retried while nothing was listed yet, so no Machine is yielded twice
+            if '$select' not in params or machineCount or e.response is None or e.response.status_code != 400:
+                raise e
+            print(f'The machines list call was rejected with $select, listing the Machines without it: {e}')
+            del params['$select']
+    runMetrics.count('machines', 'recordsIn', machineCount)
+
+    print(f'Retrieved {machineCount} machines in {len(latencies)} calls.')
+
+def get_machines():
+    # Shared MDE client which handles Bearer AuthN
+    client = get_mde_client()
+    # Set filename for upload
+    fileName = 'processed_machines'
+
+    # Only keep a small summary of each Machine around for the vulnerability stage, the full records are streamed out as they are shaped
+    mdeMachines = []
+    def track_machines(machines):
+        for v in machines:
+            machineSummary = {field: v.get(field) for field in exposureMachineFields}
+            machineSummary.update(
+                {
+                    'id': str(v['id']),
+                    'lastSeen': v['lastSeen'],
+                    'instanceId': v.get('instanceId')
+                }
+            )
+            mdeMachines.append(machineSummary)
+            yield v
+
+    if mdeMachineCollectionMode == 'api':
+        machines = iter_machines(client)
+    elif mdeMachineCollectionMode == 'hunting':
+        machines = iter_hunting_machines(client)
+    else:
+        raise ValueError(f'Unsupported MDE_MACHINE_COLLECTION_MODE {mdeMachineCollectionMode}, use api or hunting')
+
+    get_s3_publisher().publish_dataset(fileName, track_machines(machines))
+    print('All machines from MDE retrieved and queued for upload to S3.')
+
+    return mdeMachines
+
+def get_mde_pages(url, client, params=None, latencies=None):
+    '''
+    Generator which yields every record from an MDE list endpoint. It follows @odata.nextLink when the API returns one,
+    otherwise it keeps advancing $skip by $top for as long as full pages come back
+    '''
+    while url:
+        r = client.get(
+            url,
+            params=params,
+            latencies=latencies
+        )
+
+        payload = r.json()
+        page = payload['value']
+        for v in page:
+            yield v
+
+        nextLink = payload.get('@odata.nextLink')
+        if nextLink:
+            # The nextLink already carries the full query string
+            url = nextLink
+            params = None
+        elif params and '$top' in params and len(page) >= int(params['$top']):
+            params = dict(params)
+            params['$skip'] = int(params.get('$skip', 0)) + int(params['$top'])
+        else:
+            url = None
+
+def get_vulns_for_machine(machineId, client):
+    '''
+    Retrieves and shapes the vulnerabilities for a single MDE Machine, returns the records and the call latency in seconds
+    '''
+    callLatencies = []
+    machineVulns = projectMachineVulns(
+        get_mde_pages(
+            f'{mdeApiUrl}/api/machines/{machineId}/vulnerabilities',
+            client,
+            latencies=callLatencies
+        ),
+        machineId
+    )
+    runMetrics.count('vulns', 'recordsIn', len(machineVulns))
+
+    return machineVulns, sum(callLatencies)
+
+def iter_per_machine_vulns(machineIds, client):
+    '''
+    Generator which collects vulnerabilities with one (paged) call per MDE Machine spread across a bounded pool of workers
+    '''
+    latencies = []
+
+    # Results come back in submission order, so the output keeps the same Machine ordering as a serial run
+    results = bounded_ordered_map(
+        lambda machineId: get_vulns_for_machine(machineId, client),
+        machineIds,
+        mdeVulnWorkers
+    )
+    for vulns, latency in results:
+        latencies.append(latency)
+        yield from vulns
+
+    print(f'Retrieved vulnerabilities for {len(machineIds)} machines with {mdeVulnWorkers} workers. Per-machine latency (ms): {get_latency_percentiles(latencies)}')
+
+def iter_bulk_machine_vulns(machineIds, client):
+    '''
+    Generator which collects vulnerabilities for the whole fleet from the bulk machinesVulnerabilities export, joined to the
+    vulnerability catalog so every record has the same shape as the per-machine endpoint returns
+    '''
+    pageParams = {'$top': mdeBulkPageSize, '$skip': 0}
+    latencies = []
+
+    # Map each Machine to its CVEs (dict used as an ordered set) - the export returns one row per Machine, CVE and software
+    # product so the same CVE can show up more than once for a Machine. CVE IDs are interned so each edge only costs a reference
+    machineCves = {machineId: {} for machineId in machineIds}
+    for row in get_mde_pages(f'{mdeApiUrl}/api/vulnerabilities/machinesVulnerabilities', client, pageParams, latencies):
+        runMetrics.count('vulns', 'recordsIn')
+        machineId = str(row['machineId'])
+        # Skip Machines that get_machines() filtered out, such as Inactive ones
+        if machineId in machineCves:
+            machineCves[machineId][sys.intern(str(row['cveId']))] = row['severity']
+    print(f'Retrieved the machinesVulnerabilities export in {len(latencies)} calls.')
+
+    neededCves = set()
+    for cves in machineCves.values():
+        neededCves.update(cves)
+
+    # Pull the full Vulnerability objects once from the catalog and only keep the CVEs our fleet is exposed to
+    vulnCatalog = {}
+    for v in get_mde_pages(f'{mdeApiUrl}/api/vulnerabilities', client, pageParams, latencies):
+        runMetrics.count('vulns', 'recordsIn')
+        if v['id'] in neededCves:
+            vulnCatalog[v['id']] = v
+    print(f'Retrieved {len(vulnCatalog)} of {len(neededCves)} distinct vulnerabilities from the catalog in {len(latencies)} total calls. Per-page latency (ms): {get_latency_percentiles(latencies)}')
+
+    # Emit the records grouped by Machine, in the same order as the per-machine collector
+    for machineId, cves in machineCves.items():
+        for cveId, severity in cves.items():
+            catalogEntry = vulnCatalog.get(cveId)
+            if catalogEntry is None:
+                # Do not drop the exposure just because the catalog did not have the CVE, keep what the export told us
+                catalogEntry = {
+                    'id': cveId,
+                    'name': cveId,
+                    'severity': severity,
+                    'exploitTypes': [],
+                    'exploitUris': []
+                }
+            # The projection builds a new record, so the catalog entry is shared between Machines without copying it
+            yield projectMachineVuln(catalogEntry, machineId)
+
+def iter_hunting_machine_vulns(machineIds, client):
+    '''
+    Generator which collects vulnerabilities for the whole fleet with Advanced Hunting queries - the distinct Machine and
+    CVE pairs, and the shaped catalog entry of every CVE in the fleet - in the same order as the per-machine collector
+    '''
+    # Map each Machine to its CVEs (dict used as an ordered set), CVE IDs are interned so each edge only costs a reference
+    machineCves = {machineId: {} for machineId in machineIds}
+    for row in iter_hunting_rows('vuln_edges', 'DeviceId', client, 'vulns'):
+        cves = machineCves.get(str(row['DeviceId']))
+        # Skip Machines that get_machines() filtered out, such as Inactive ones
+        if cves is not None:
+            cves[sys.intern(str(row['CveId']))] = None
+
+    neededCves = set()
+    for cves in machineCves.values():
+        neededCves.update(cves)
+
+    # The catalog query is sliced by CVE, its rows already have every column of the dataset except the Machine ID
+    vulnCatalog = {}
+    for v in iter_hunting_rows('vuln_catalog', 'CveId', client, 'vulns'):
+        if v['id'] in neededCves:
+            vulnCatalog[v['id']] = v
+    print(f'Retrieved {len(vulnCatalog)} of {len(neededCves)} distinct vulnerabilities with Advanced Hunting.')
+
+    for machineId, cves in machineCves.items():
+        for cveId in cves:
+            catalogEntry = vulnCatalog.get(cveId)
+            if catalogEntry is None:
+                # The CVE showed up between the two queries, keep the exposure with what we know about it
+                yield projectMachineVuln({'id': cveId, 'name': cveId, 'exploitTypes': [], 'exploitUris': []}, machineId)
+                continue
+            record = dict(catalogEntry)
+            record['vuln_MachineId'] = machineId
+            yield record
+
+class MachineStateStore():
+    '''
+    SQLite backed store of each Machine's lastSeen, exposure level, vulnerability set hash and shaped vulnerability rows.
+    The database file is downloaded from S3 at the start of a run and uploaded back once the dataset is published
+    '''
+    def __init__(self, bucket, key, localPath='./mde_state.sqlite'):
+        self.bucket = bucket
+        self.key = key
+        self.localPath = localPath
+        self.changedHashes = 0
+
+        try:
+            get_s3_client().download_file(bucket, key, localPath)
+            print(f'Loaded incremental state from s3://{bucket}/{key}')
+        except botocore.exceptions.ClientError as error:
+            # There is no state on the very first run, every Machine will be fetched
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                print(f'No incremental state found at s3://{bucket}/{key}, starting a new one')
+                if os.path.exists(localPath):
+                    os.remove(localPath)
+            else:
+                raise error
+
+        self.conn = sqlite3.connect(localPath)
+        self.conn.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS machine_state (
+                machineId TEXT PRIMARY KEY,
+                lastSeen TEXT,
+                exposureLevel TEXT,
+                vulnHash TEXT,
+                fetchedAt REAL,
+                vulns TEXT
+            )
+            '''
+        )
+
+    def needs_refresh(self, machine):
+        row = self.conn.execute(
+            'SELECT lastSeen, exposureLevel, fetchedAt FROM machine_state WHERE machineId = ?',
+            (machine['id'],)
+        ).fetchone()
+        if row is None:
+            return True
+        lastSeen, exposureLevel, fetchedAt = row
+        # Force a periodic refresh so newly published CVEs still show up for Machines which never change
+        if time.time() - fetchedAt > incrementalMaxAgeHours * 3600:
+            return True
+
+        return lastSeen != machine['lastSeen'] or exposureLevel != machine['exposureLevel']
+
+    def get_vulns(self, machineId):
+        row = self.conn.execute(
+            'SELECT vulns FROM machine_state WHERE machineId = ?',
+            (machineId,)
+        ).fetchone()
+
+        return json.loads(row[0])
 
-    return regionList
+    def put(self, machine, vulns):
+        vulnsJson = json.dumps(vulns, default=str)
+        # Hash a key-order independent form so the same vulnerability set always gets the same hash
+        vulnHash = hashlib.sha256(json.dumps(vulns, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        row = self.conn.execute(
+            'SELECT vulnHash FROM machine_state WHERE machineId = ?',
+            (machine['id'],)
+        ).fetchone()
+        if row is None or row[0] != vulnHash:
+            self.changedHashes += 1
+        self.conn.execute(
+            'INSERT OR REPLACE INTO machine_state VALUES (?, ?, ?, ?, ?, ?)',
+            (machine['id'], machine['lastSeen'], machine['exposureLevel'], vulnHash, time.time(), vulnsJson)
+        )
 
-def get_token():
-    ssm = boto3.client('ssm')
+    def prune(self, machineIds):
+        # Drop Machines which are no longer part of the fleet (offboarded or Inactive)
+        existingIds = [row[0] for row in self.conn.execute('SELECT machineId FROM machine_state')]
+        staleIds = [(machineId,) for machineId in existingIds if machineId not in machineIds]
+        self.conn.executemany('DELETE FROM machine_state WHERE machineId = ?', staleIds)
 
-    tenantId = ssm.get_parameter(Name=tenantIdParam,WithDecryption=True)['Parameter']['Value']
-    clientId = ssm.get_parameter(Name=clientIdParam,WithDecryption=True)['Parameter']['Value']
-    secretId = ssm.get_parameter(Name=secretIdParam,WithDecryption=True)['Parameter']['Value']
+        return len(staleIds)
 
-    tokenUrl = f'https://login.microsoftonline.com/{tenantId}/oauth2/token'
-    resourceAppIdUri = 'https://api.securitycenter.microsoft.com'
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
 
-    data = {
-        'grant_type': 'client_credentials',
-        'client_id': clientId,
-        'resource' : resourceAppIdUri,
-        'client_secret': secretId
-    }
+    def save(self):
+        self.close()
+        get_s3_client().upload_file(self.localPath, self.bucket, self.key)
+        print(f'Incremental state saved to s3://{self.bucket}/{self.key}')
 
-    r = requests.post(
-        tokenUrl,
-        data=data
-    )
+def iter_incremental_vulns(mdeMachines, freshVulns, refreshIds, stateStore):
+    '''
+    Generator which assembles the full vulnerability dataset in Machine order from cached rows for unchanged Machines and
+    freshly collected rows for the rest, updating the state store as it goes
+    '''
+    # Both collectors emit records grouped by Machine in the order they were given, so we can walk the two in lockstep.
+    # Machines without any vulnerabilities simply have no group
+    freshGroups = groupby(freshVulns, key=lambda v: v['vuln_MachineId'])
+    nextGroup = next(freshGroups, None)
+    for machine in mdeMachines:
+        machineId = machine['id']
+        if machineId in refreshIds:
+            vulns = []
+            if nextGroup is not None and nextGroup[0] == machineId:
+                vulns = list(nextGroup[1])
+                nextGroup = next(freshGroups, None)
+            stateStore.put(machine, vulns)
+            yield from vulns
+        else:
+            yield from stateStore.get_vulns(machineId)
 
-    token = r.json()['access_token']
+    print(f'Incremental mode: {stateStore.changedHashes} of {len(refreshIds)} refreshed machines had a different vulnerability set.')
 
-    print('SSM Parameters processed and OAuth Token created')
+def build_exposure_row(v, machineIndex, ec2Index):
+    '''
+    Joins a single vulnerability record to its MDE Machine and EC2 Instance, returns None if the Machine is not a known EC2 Instance
+    '''
+    machine = machineIndex.get(v['vuln_MachineId'])
+    if machine is None:
+        return None
+    instance = ec2Index.get(machine['instanceId'])
+    if instance is None:
+        return None
 
-    del data
-    del ssm
+    exposureRow = dict(instance)
+    # IMDSv1 is still reachable whenever session tokens are optional
+    exposureRow['IsImdsV1'] = instance['MetadataOptionsHttpTokens'] == 'optional'
+    exposureRow['machineId'] = machine['id']
+    for field in exposureMachineFields:
+        exposureRow[field] = machine[field]
+    exposureRow['cveId'] = v['id']
+    for field in exposureVulnFields:
+        exposureRow[field] = v.get(field)
 
-    return token
+    return exposureRow
 
-def get_machines():
-    # Retrieve OAuth token for Bearer AuthN
-    token = get_token()
-    # Create empty list to hold MDE Machine data
-    mdeMachines = []
+def get_machine_vulns(mdeMachines, ec2IndexFuture=None):
+    '''
+    Collects and publishes the MDE machine vulnerabilities of the Machines returned by get_machines(). When ec2IndexFuture
+    (the Future of the EC2 index, InstanceId to EC2 fields) is passed the exposure dataset is built from the same pass over
+    the vulnerability stream. Fetching never waits on the EC2 stage - until it is done the join fields of the vulnerabilities
+    of EC2 Machines are buffered, they are joined as soon as the index is ready or once every vulnerability was fetched
+    '''
+    # Shared MDE client, the token from the machines stage is reused as long as it is valid
+    client = get_mde_client()
     # Set filename for upload
-    fileName = 'processed_machines'
-
-    headers = {'Authorization': f'Bearer {token}'}
+    fileName = 'processed_machine_vulns'
 
-    # Compile Regex for EC2
-    ec2IdRegex = re.compile('(?i)\\b[a-z]+-[a-z0-9]+')
-    # S3 Waiter
-    waiter = s3.get_waiter('object_exists')
+    # In incremental mode only Machines whose lastSeen or exposure changed (or whose cached rows are too old) are fetched
+    stateStore = None
+    machinesToFetch = mdeMachines
+    if incrementalMode:
+        stateStore = MachineStateStore(get_required_env('QUICKSIGHT_S3_BUCKET_NAME'), stateDbKey)
+        machinesToFetch = [machine for machine in mdeMachines if stateStore.needs_refresh(machine)]
+        print(f'Incremental mode: {len(machinesToFetch)} of {len(mdeMachines)} machines changed since the last run.')
+    mdeMachineIds = [machine['id'] for machine in machinesToFetch]
 
-    # Retrieve all Machines
-    r = requests.get(
-        'https://api-us.securitycenter.microsoft.com/api/machines',
-        headers=headers
-    )
-    # As we loop through Machine data from MDE, we want to pull out only AWS EC2 Instances which should be tagged with the Instance ID
-    # provided you set up properly...
-    for v in r.json()['value']:
-        # We have to do a hack to reformat the timestamps for QuickSight to take
-        firstSeenOriginal = str(v['firstSeen'])
-        lastSeenOriginal = str(v['lastSeen'])
-
-        firstSeenSplitter = firstSeenOriginal.split('T')
-        firstSeenSecondsSplitter = firstSeenSplitter[1].split('.')
-
-        lastSeenSplitter = lastSeenOriginal.split('T')
-        lastSeenSecondsSplitter = lastSeenSplitter[1].split('.')
-        # QUICKSIGHT FORMAT: yyyy-mm-dd HH:mm:ss
-        newFirstSeen = f'{firstSeenSplitter[0]} {firstSeenSecondsSplitter[0]}'
-        newLastSeen = f'{lastSeenSplitter[0]} {lastSeenSecondsSplitter[0]}'
-
-        # reinsert the dates
-        v.update(
-            {
-                'firstSeen': newFirstSeen,
-                'lastSeen': newLastSeen
-            }
-        )
-        # drop the IP address details
-        del v['ipAddresses']
-        # Skip "Inactive" Machines
-        if str(v['healthStatus']) == 'Inactive':
-            continue
-        # ensure the regex matches to select EC2 machines if there are tags for them
-        if v['machineTags']:
-            # now to loop the list and find a match if possible...
-            for tag in v['machineTags']:
-                if ec2IdRegex.search(tag):
-                    instanceId = str(tag)
-                    v['instanceId'] = instanceId
-                    break
+    # Large fleets are far cheaper to collect from the bulk export than with one call per Machine
+    collectionMode = mdeVulnCollectionMode
+    if collectionMode == 'auto':
+        if len(mdeMachineIds) >= mdeBulkModeMachineThreshold:
+            collectionMode = 'bulk'
         else:
-            v['instanceId'] = 'NON_AWS'
-        mdeMachines.append(v)
+            collectionMode = 'machine'
+    print(f'Gathering all MDE machine vulnerabilities for {len(mdeMachineIds)} machines in {collectionMode} mode.')
 
-    with open(f'./{fileName}.json', 'w') as jsonfile:
-        json.dump(mdeMachines, jsonfile, indent=4, default=str)
+    if vulnDatasetLayout not in ('denormalized', 'normalized', 'both'):
+        raise ValueError(f'Unsupported VULN_DATASET_LAYOUT {vulnDatasetLayout}, use denormalized, normalized or both')
 
-    # Upload the MDE Machines JSON file to S3
-    try:
-        s3.upload_file(
-            f'./{fileName}.json',
-            quicksightS3Bucket,
-            f'quicksight/{fileName}.json'
-        )
-        # Wait for eventual consistency
-        waiter.wait(
-            Bucket=quicksightS3Bucket,
-            Key=f'quicksight/{fileName}.json',
-            WaiterConfig={
-                'Delay': 2,
-                'MaxAttempts': 20
-            }
-        )
-        print('All machines from MDE retrieved and JSON uploaded to S3.')
-    except Exception as e:
-        raise e
+    # All workers share the client's rate budget so raising the worker count cannot push us past the MDE API quota
+    if collectionMode == 'bulk':
+        machineVulns = iter_bulk_machine_vulns(mdeMachineIds, client)
+    elif collectionMode == 'machine':
+        machineVulns = iter_per_machine_vulns(mdeMachineIds, client)
+    elif collectionMode == 'hunting':
+        machineVulns = iter_hunting_machine_vulns(mdeMachineIds, client)
+    else:
+        raise ValueError(f'Unsupported MDE_VULN_COLLECTION_MODE {collectionMode}, use auto, machine, bulk or hunting')
 
-    # Generate a QuickSight Manifest and upload file to S3
-    manifest = {
-        'fileLocations':[
-            {
-                'URIs':[
-                    f'https://{quicksightS3Bucket}.s3.{awsRegion}.amazonaws.com/quicksight/{fileName}.json'
-                ]
-            }
-        ],
-        'globalUploadSettings':{
-            'format':'JSON'
-        }
-    }
+    if stateStore is not None:
+        machineVulns = iter_incremental_vulns(mdeMachines, machineVulns, set(mdeMachineIds), stateStore)
+
+    exposure = {'sink': None, 'ec2Index': None, 'pending': []}
+    if ec2IndexFuture is not None:
+        # Hash indexes on both join keys make the join a single linear pass over the vulnerabilities
+        machineIndex = {machine['id']: machine for machine in mdeMachines}
+        exposure['sink'] = get_s3_publisher().open_dataset('processed_exposure')
+        def join_exposure(v):
+            exposureRow = build_exposure_row(v, machineIndex, exposure['ec2Index'])
+            if exposureRow is not None:
+                exposure['sink'].write(exposureRow)
+        def resolve_ec2_index(block):
+            # Returns whether vulnerabilities can be joined right away, only blocks on the EC2 stage when block is set
+            if exposure['sink'] is None:
+                return False
+            if exposure['ec2Index'] is None:
+                if not block and not ec2IndexFuture.done():
+                    return False
+                try:
+                    exposure['ec2Index'] = ec2IndexFuture.result()
+                except Exception as e:
+                    # Without EC2 Instances there is nothing to join, so only the exposure dataset is dropped
+                    print(f'EC2 Instances are not available, the exposure dataset will not be built: {e}')
+                    exposure['sink'].abort()
+                    exposure['sink'] = None
+                    exposure['pending'] = []
+                    return False
+                # Join what was held back while the EC2 stage was running, in the order it was fetched
+                for pendingVuln in exposure['pending']:
+                    join_exposure(pendingVuln)
+                exposure['pending'] = []
 
-    with open(f'{fileName}_manifest.json', 'w') as jsonfile:
-        json.dump(manifest, jsonfile, indent=2)
+            return True
+        def tee_exposure(vulns):
+            for v in vulns:
+                if resolve_ec2_index(False):
+                    join_exposure(v)
+                elif exposure['sink'] is not None:
+                    # Only the vulnerabilities of Machines running on EC2 can join, and only their join fields are kept
+                    machine = machineIndex.get(v['vuln_MachineId'])
+                    if machine is not None and is_ec2_instance_id(machine['instanceId']):
+                        exposure['pending'].append({field: v.get(field) for field in exposureJoinFields})
+                yield v
+            # Every vulnerability was fetched, so waiting on the EC2 stage holds nothing up. Also covers a fleet without any
+            resolve_ec2_index(True)
+        machineVulns = tee_exposure(machineVulns)
+
+    # The normalized layout interns every CVE into the catalog the first time it shows up, after that each Machine it
+    # affects only costs an edge. Memory and output then grow with distinct CVEs plus edges instead of edges x payload
+    vulnCatalog = {}
+    edgeSink = None
+    if vulnDatasetLayout != 'denormalized':
+        edgeSink = get_s3_publisher().open_dataset('processed_machine_vuln_edges')
+        def tee_normalized(vulns):
+            for v in vulns:
+                cveId = sys.intern(str(v['id']))
+                if cveId not in vulnCatalog:
+                    vulnCatalog[cveId] = projectVulnCatalogEntry(v)
+                edge = projectVulnEdge(v)
+                edge['cveId'] = cveId
+                edgeSink.write(edge)
+                yield v
+        machineVulns = tee_normalized(machineVulns)
 
     try:
-        s3.upload_file(
-            f'./{fileName}_manifest.json',
-            quicksightS3Bucket,
-            f'quicksight/{fileName}_manifest.json'
-        )
-        # Wait for eventual consistency
-        waiter.wait(
-            Bucket=quicksightS3Bucket,
-            Key=f'quicksight/{fileName}_manifest.json',
-            WaiterConfig={
-                'Delay': 2,
-                'MaxAttempts': 20
-            }
-        )
-        print('MDE Machines Manifest file sent to S3.')
+        if vulnDatasetLayout == 'normalized':
+            # Nothing is written for the denormalized dataset, the stream only has to be drained into the other sinks
+            deque(machineVulns, maxlen=0)
+        else:
+            get_s3_publisher().publish_dataset(fileName, machineVulns)
     except Exception as e:
+        for sink in (exposure['sink'], edgeSink):
+            if sink is not None:
+                sink.abort()
         raise e
+    print('All MDE machine vulnerabilities retrieved and queued for upload to S3.')
 
-    return mdeMachines
+    if exposure['sink'] is not None:
+        exposure['sink'].close()
+        print('EC2 exposure dataset built and queued for upload to S3.')
 
-def get_machine_vulns():
-    mdeMachines = get_machines()
-    # Retrieve OAuth token for Bearer AuthN
-    token = get_token()
-    headers = headers = {'Authorization': f'Bearer {token}'}
-    # Create an empty list to house all of the machine vulnerabilities
-    machineVulns = []
-    # Set filename for upload
-    fileName = 'processed_machine_vulns'
-    # S3 Waiter
-    waiter = s3.get_waiter('object_exists')
-    print('Gathering all MDE machine vulnerabilities.')
+    if edgeSink is not None:
+        edgeCount = edgeSink.close()
+        get_s3_publisher().publish_dataset('processed_vuln_catalog', vulnCatalog.values())
+        print(f'Normalized vulnerability datasets queued for upload to S3: {len(vulnCatalog)} distinct CVEs and {edgeCount} machine to CVE edges.')
 
-    for machine in mdeMachines:
-        machineId = str(machine['id'])
+    # Only persist the state once the dataset it describes has been fully serialized
+    if stateStore is not None:
+        staleCount = stateStore.prune({machine['id'] for machine in mdeMachines})
+        print(f'Incremental mode: removed {staleCount} machines no longer in the fleet from the state store.')
+        if get_s3_publisher().publishEnabled:
+            stateStore.save()
+        else:
+            # Nothing was published, so the state kept in S3 has to keep describing the last published dataset
+            stateStore.close()
 
-        r = requests.get(
-            f'https://api-us.securitycenter.microsoft.com/api/machines/{machineId}/vulnerabilities',
-            headers=headers
-        )
-        # We will provide some basic shaping of the data returned for Vulnerabilities - namely around Exploit data
-        for v in r.json()['value']:
-            # check for exploit types, gather the first object if present and overwrite the dict
-            # otherwise, write in String "None"
-            if v['exploitTypes']:
-                exploitTypes = str(v['exploitTypes'][0])
-                # delete the original key
-                del v['exploitTypes']
-                # re-insert the new one
-                v['exploitTypes'] = exploitTypes
-            else:
-                # This means there is not any exploit type data
-                exploitTypes = 'None'
-                # delete the original key
-                del v['exploitTypes']
-                # re-insert the new one
-                v['exploitTypes'] = exploitTypes
-            
-            # Repeat the same process for Exploit URIs
-            if v['exploitUris']:
-                exploitUris = str(v['exploitUris'][0])
-                # delete the original key
-                del v['exploitUris']
-                # re-insert the new one
-                v['exploitUris'] = exploitUris
+class Ec2RegionIndex():
+    '''
+    Region activity index kept as a small JSON object in S3 - the opted-in Regions of every Account and when they were
+    listed, and the Instance count of every Account and Region pair on its last scan. It spares the describe_regions
+    calls while the Region lists are fresh and tells which Regions were empty, so those are only probed. With
+    publishEnabled False nothing is read from or written to S3 and every Region is scanned
+    '''
+    def __init__(self, bucket, key, publishEnabled=True):
+        self.bucket = bucket
+        self.key = key
+        self.publishEnabled = publishEnabled
+        self.lock = threading.Lock()
+        self.accounts = self.load()
+
+    def load(self):
+        if not self.publishEnabled:
+            return {}
+        try:
+            indexBody = get_s3_client().get_object(Bucket=self.bucket, Key=self.key)['Body'].read()
+            return json.loads(indexBody)['accounts']
+        except botocore.exceptions.ClientError as error:
+            # There is no index on the very first run, every Region will be listed and scanned
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return {}
             else:
-                # This means there is not any exploit type data
-                exploitUris = 'None'
-                # delete the original key
-                del v['exploitUris']
-                # re-insert the new one
-                v['exploitUris'] = exploitUris
-            # Create a CVE URL, as the Machine Vulnerability Object does not return it...
-            vulnId = str(v['id'])
-            cveUrl = f'https://cve.mitre.org/cgi-bin/cvename.cgi?name={vulnId}'
-            v['cveInformation'] = cveUrl
-            # Write in the Machine ID into the Vuln dict so we can merge the data sets later
-            v['vuln_MachineId'] = machineId
-            machineVulns.append(v)
-
-    with open(f'./{fileName}.json', 'w') as jsonfile:
-        json.dump(machineVulns, jsonfile, indent=4, default=str)
-
-    # Upload the MDE Machines JSON file to S3
-    try:
-        s3.upload_file(
-            f'./{fileName}.json',
-            quicksightS3Bucket,
-            f'quicksight/{fileName}.json'
-        )
-        # Wait for eventual consistency
-        waiter.wait(
-            Bucket=quicksightS3Bucket,
-            Key=f'quicksight/{fileName}.json',
-            WaiterConfig={
-                'Delay': 2,
-                'MaxAttempts': 20
-            }
-        )
-        print('All MDE machine vulnerabilities retrieved and JSON uploaded to S3.')
-    except Exception as e:
-        raise e
+                raise error
 
-    # Generate a QuickSight Manifest and upload file to S3
-    manifest = {
-        'fileLocations':[
-            {
-                'URIs':[
-                    f'https://{quicksightS3Bucket}.s3.{awsRegion}.amazonaws.com/quicksight/{fileName}.json'
-                ]
-            }
-        ],
-        'globalUploadSettings':{
-            'format':'JSON'
-        }
-    }
+    def get_regions(self, accountId):
+        '''
+        Returns the opted-in Regions of an Account as last listed, None when they were never listed or are too old
+        '''
+        with self.lock:
+            account = self.accounts.get(accountId)
+            if account is None or time.time() - account['regionsListedAt'] > ec2RegionListTtlHours * 3600:
+                return None
+            return list(account['regions'])
 
-    with open(f'{fileName}_manifest.json', 'w') as jsonfile:
-        json.dump(manifest, jsonfile, indent=2)
+    def set_regions(self, accountId, regionList):
+        with self.lock:
+            account = self.accounts.setdefault(accountId, {'activity': {}})
+            account['regions'] = list(regionList)
+            account['regionsListedAt'] = time.time()
+            # Regions the Account opted out of are forgotten
+            account['activity'] = {region: activity for region, activity in account['activity'].items() if region in regionList}
 
-    try:
-        s3.upload_file(
-            f'./{fileName}_manifest.json',
-            quicksightS3Bucket,
-            f'quicksight/{fileName}_manifest.json'
-        )
-        # Wait for eventual consistency
-        waiter.wait(
-            Bucket=quicksightS3Bucket,
-            Key=f'quicksight/{fileName}_manifest.json',
-            WaiterConfig={
-                'Delay': 2,
-                'MaxAttempts': 20
-            }
-        )
-        print('MDE Vulnerabilities Manifest file sent to S3.')
-    except Exception as e:
-        raise e
+    def get_activity(self, accountId, region):
+        with self.lock:
+            return self.accounts.get(accountId, {}).get('activity', {}).get(region)
 
-def get_ec2_metadata():
-    regionList = get_opted_in_aws_regions()
-    # Create an empty list to house all EC2 Data
-    ec2Data = []
-    # Set filename for upload
-    fileName = 'processed_ec2_instances'
-    # S3 Waiter
-    waiter = s3.get_waiter('object_exists')
-
-    print('Retrieving EC2 data for all Regions.')
-
-    for region in regionList:
-        # We will pass the Region to a Boto3 Session which will create an Authentication Object
-        # In the specific Account and Region so you can create additional Clients which are thread/process safe
-        session = boto3.Session(region_name=region)
-        tempEc2 = session.client('ec2', config=config)
-        paginator = tempEc2.get_paginator('describe_instances')
-        iterator = paginator.paginate()
-        for page in iterator:
-            for r in page['Reservations']:
-                for i in r['Instances']:
-                    # Now we pull out the information we want - some of it we can write to the dict
-                    # directly and others we will need to ensure they're there
-                    try:
-                        pubIp = str(i['PublicIpAddress'])
-                    except KeyError:
-                        pubIp = None
-                    try:
-                        pubDns = str(i['PublicDnsName'])
-                        # Public DNS is cheeky and will return an empty string instead of None >:(
-                        if pubDns == '':
-                            pubDns = None
-                        else:
-                            pubDns = pubDns
-                    except KeyError:
-                        pubDns = None
-                    # Create our own Bool for Public-facing EC2 instances
-                    if pubIp != None or pubDns != None:
-                        isPublic = True
-                    else:
-                        isPublic = False
-                    # Not all machines have an IAM Role...
-                    try:
-                        instanceProfileArn = str(i['IamInstanceProfile']['Arn'])
-                    except KeyError:
-                        instanceProfileArn = None
-
-                    ec2DataDict = {
-                        'ImageId': str(i['ImageId']),
-                        'InstanceId': str(i['InstanceId']),
-                        'InstanceType': str(i['InstanceType']),
-                        'LaunchTime': str(i['LaunchTime']),
-                        'PrivateDnsName': str(i['PrivateDnsName']),
-                        'PrivateIpAddress': str(i['PrivateIpAddress']),
-                        'PublicIpAddress': pubIp,
-                        'PublicDnsName': pubDns,
-                        'IsPublic': isPublic,
-                        'State': str(i['State']['Name']),
-                        'SubnetId': str(i['SubnetId']),
-                        'VpcId': str(i['VpcId']),
-                        'Architecture': str(i['Architecture']),
-                        'VolumeId': str(i['BlockDeviceMappings'][0]['Ebs']['VolumeId']),
-                        'IamInstanceProfileArn': instanceProfileArn,
-                        'NetworkInterfaceId': str(i['NetworkInterfaces'][0]['NetworkInterfaceId']),
-                        'SecurityGroupId': str(i['SecurityGroups'][0]['GroupId']),
-                        'SecurityGroupName': str(i['SecurityGroups'][0]['GroupName']),
-                        'MetadataOptionsHttpTokens': str(i['MetadataOptions']['HttpTokens']),
-                        'MetadataOptionsHttpPutResponseHopLimit': str(i['MetadataOptions']['HttpPutResponseHopLimit']),
-                        'MetadataOptionsHttpEndpoint': str(i['MetadataOptions']['HttpEndpoint']),
-                        'MetadataOptionsInstanceMetadataTags': str(i['MetadataOptions']['InstanceMetadataTags']),
-                        'EnclaveOptions': str(i['EnclaveOptions']['Enabled'])
-                    }
-                    ec2Data.append(ec2DataDict)
-        print(f'EC2 collection for AWS Region {region} complete.')
+    def was_empty(self, accountId, region):
+        activity = self.get_activity(accountId, region)
+        return activity is not None and activity['instances'] == 0
+
+    def is_probe_due(self, accountId, region):
+        '''
+        Whether a Region which was empty has to be probed on this run, Regions which were populated are always scanned
+        '''
+        activity = self.get_activity(accountId, region)
+        if activity is None or activity['instances'] or ec2EmptyRegionProbeHours <= 0:
+            return True
+
+        return time.time() - activity['scannedAt'] >= ec2EmptyRegionProbeHours * 3600
+
+    def record_scan(self, accountId, region, instanceCount):
+        with self.lock:
+            account = self.accounts.setdefault(accountId, {'activity': {}})
+            account['activity'][region] = {'instances': instanceCount, 'scannedAt': time.time()}
 
-    del regionList
+    def save(self, accountIds):
+        '''
+        Writes the index back to S3, Accounts which are no longer inventoried are dropped from it
+        '''
+        if not self.publishEnabled:
+            return
+        with self.lock:
+            self.accounts = {accountId: account for accountId, account in self.accounts.items() if accountId in accountIds}
+            indexBody = json.dumps({'accounts': self.accounts}, indent=2, sort_keys=True).encode('utf-8')
+        get_s3_client().put_object(Bucket=self.bucket, Key=self.key, Body=indexBody)
+        print(f'Saved the EC2 Region activity index to s3://{self.bucket}/{self.key}')
 
-    with open(f'./{fileName}.json', 'w') as jsonfile:
-        json.dump(ec2Data, jsonfile, indent=4, default=str)
+def get_ec2_instance_filters():
+    # Instances in other states are dropped by EC2 before they are serialized, parsed and shaped
+    if not ec2InstanceStates:
+        return []
 
-    # Upload the MDE Machines JSON file to S3
+    return [{'Name': 'instance-state-name', 'Values': ec2InstanceStates}]
+
+def get_ec2_region_instances(accountId, region, regionIndex):
+    '''
+    Retrieves and shapes every EC2 Instance of an Account in a single Region, returns the records and the elapsed time in
+    seconds. In organization mode a Region which cannot be scanned (an SCP denying the Region, a missing permission or a
+    Region the member Account did not opt in to) is reported and skipped instead of failing every other Account
+    '''
     try:
-        s3.upload_file(
-            f'./{fileName}.json',
-            quicksightS3Bucket,
-            f'quicksight/{fileName}.json'
-        )
-        # Wait for eventual consistency
-        waiter.wait(
-            Bucket=quicksightS3Bucket,
-            Key=f'quicksight/{fileName}.json',
-            WaiterConfig={
-                'Delay': 2,
-                'MaxAttempts': 20
-            }
-        )
-        print('Finished retrieving EC2 data for all Regions and JSON uploaded to S3.')
-    except Exception as e:
-        raise e
+        return scan_ec2_region_instances(accountId, region, regionIndex)
+    except botocore.exceptions.ClientError as e:
+        if not organizationMode:
+            raise e
+        print(f'Organization mode: skipping Region {region} of Account {accountId}, it could not be scanned: {e}')
+        runMetrics.count('ec2', 'regionsFailed')
+        return [], 0.0
 
-    # Generate a QuickSight Manifest and upload file to S3
-    manifest = {
-        'fileLocations':[
-            {
-                'URIs':[
-                    f'https://{quicksightS3Bucket}.s3.{awsRegion}.amazonaws.com/quicksight/{fileName}.json'
-                ]
-            }
-        ],
-        'globalUploadSettings':{
-            'format':'JSON'
-        }
-    }
+def scan_ec2_region_instances(accountId, region, regionIndex):
+    '''
+    Scans a single Region of an Account for get_ec2_region_instances(). A Region which was empty on its last scan is
+    probed with a single small page first, and left alone when its probe is not due yet
+    '''
+    startTime = time.perf_counter()
+    regionData = []
+    if not regionIndex.is_probe_due(accountId, region):
+        runMetrics.count('ec2', 'regionsSkipped')
+        return regionData, 0.0
+    # Every Region of an Account shares the Account's Session (and assumed role credentials), each worker gets its own
+    # Client which is thread safe. It is only created once a page is not served from the response cache
+    tempEc2 = None
+    def get_ec2():
+        nonlocal tempEc2
+        if tempEc2 is None:
+            tempEc2 = get_account_sessions().client(accountId, 'ec2', region)
+        return tempEc2
+
+    filters = get_ec2_instance_filters()
+    if regionIndex.was_empty(accountId, region):
+        runMetrics.count('ec2', 'regionsProbed')
+        probeParams = {'MaxResults': ec2ProbeMaxResults, 'Filters': filters} if filters else {'MaxResults': ec2ProbeMaxResults}
+        page = get_response_cache().aws_call(get_ec2, 'describe_instances', [accountId, region], **probeParams)
+        if not page['Reservations'] and not page.get('NextToken'):
+            regionIndex.record_scan(accountId, region, 0)
+            return regionData, time.perf_counter() - startTime
+        # The Region is populated now, it is scanned from the start with full pages
+        print(f'EC2 Region {region} of AWS Account {accountId} was empty on its last scan and has Instances now, scanning it.')
 
-    with open(f'{fileName}_manifest.json', 'w') as jsonfile:
-        json.dump(manifest, jsonfile, indent=2)
+    # Paged by hand rather than with a paginator so every page goes through the response cache
+    params = {'MaxResults': ec2PageSize, 'Filters': filters} if filters else {'MaxResults': ec2PageSize}
+    while True:
+        page = get_response_cache().aws_call(get_ec2, 'describe_instances', [accountId, region], **params)
+        regionData.extend(projectEc2Instances([i for r in page['Reservations'] for i in r['Instances']], accountId, region))
+        if not page.get('NextToken'):
+            break
+        params = dict(params, NextToken=page['NextToken'])
+    elapsed = time.perf_counter() - startTime
+    regionIndex.record_scan(accountId, region, len(regionData))
+    runMetrics.count('ec2', 'regionsScanned')
+    runMetrics.count('ec2', 'recordsIn', len(regionData))
+    print(f'EC2 collection for AWS Account {accountId} Region {region} complete. {len(regionData)} instances in {round(elapsed, 2)} seconds.')
 
+    return regionData, elapsed
+
+def get_account_regions(accountId, regionIndex):
+    '''
+    Returns the opted-in Regions of an Account, from the Region activity index while its list is fresh. In organization
+    mode an Account which cannot be inventoried (for example because the role is missing) is reported and skipped with an
+    empty list instead of failing every other Account
+    '''
+    regionList = regionIndex.get_regions(accountId)
+    if regionList is not None:
+        return regionList
     try:
-        s3.upload_file(
-            f'./{fileName}_manifest.json',
-            quicksightS3Bucket,
-            f'quicksight/{fileName}_manifest.json'
-        )
-        # Wait for eventual consistency
-        waiter.wait(
-            Bucket=quicksightS3Bucket,
-            Key=f'quicksight/{fileName}_manifest.json',
-            WaiterConfig={
-                'Delay': 2,
-                'MaxAttempts': 20
-            }
-        )
-        print('EC2 Manifest file sent to S3.')
+        regionList = get_opted_in_aws_regions(accountId)
+        regionIndex.set_regions(accountId, regionList)
+        return regionList
     except Exception as e:
-        raise e
+        if not organizationMode:
+            raise e
+        print(f'Organization mode: skipping Account {accountId}, it could not be inventoried: {e}')
+        runMetrics.count('ec2', 'accountsSkipped')
+        return []
 
-def send_to_quicksight():
+def iter_ec2_instances(accountRegions, regionIndex):
     '''
-    This function uploads the final merged dataset to S3 and creates a Data Source within QuickSight
+    Generator which yields every shaped EC2 Instance across all Account and Region pairs, scanning several at a time
     '''
-    get_ec2_metadata()
-    get_machine_vulns()
-    # Filenames & Group name for Quicksight - add all file names to an empty list
-    dataSourceList = []
-    machinesFileName = 'processed_machines'
-    dataSourceList.append(machinesFileName)
-    machineVulnsFileName = 'processed_machine_vulns'
-    dataSourceList.append(machineVulnsFileName)
-    ec2FileName = 'processed_ec2_instances'
-    dataSourceList.append(ec2FileName)
-    groupName = 'MDE_Viewers'
+    instanceCount = 0
+    regionTimings = []
+    # Each Account and Region is scanned by its own worker with its own Client, results keep the Account and Region ordering.
+    # The worker count is a global cap, so a large Organization never has more scans in flight than a single Account
+    results = bounded_ordered_map(lambda accountRegion: get_ec2_region_instances(*accountRegion, regionIndex), accountRegions, ec2RegionWorkers)
+    for (accountId, region), (regionData, elapsed) in zip(accountRegions, results):
+        regionTimings.append((elapsed, accountId, region, len(regionData)))
+        instanceCount += len(regionData)
+        yield from regionData
+
+    # Surface the slowest Regions so we can see which ones dominate the stage
+    regionTimings.sort(reverse=True)
+    slowestRegions = ', '.join(f'{accountId}/{region} ({round(elapsed, 2)}s, {count} instances)' for elapsed, accountId, region, count in regionTimings[:5])
+    print(f'Collected {instanceCount} EC2 instances from {len(accountRegions)} Account Regions with {ec2RegionWorkers} workers. Slowest Regions: {slowestRegions}')
+
+def get_ec2_metadata():
+    '''
+    Collects and publishes the EC2 Instances of every Region (of every Account in organization mode), returns an index of
+    InstanceId to the EC2 fields used by the exposure dataset
+    '''
+    accountList = get_target_aws_accounts()
+    regionIndex = Ec2RegionIndex(get_s3_publisher().bucket, ec2RegionIndexKey, get_s3_publisher().publishEnabled)
+    # Role assumption and Region discovery for the Accounts is spread across the same bounded pool as the scans
+    accountRegions = []
+    accountRegionLists = bounded_ordered_map(lambda accountId: get_account_regions(accountId, regionIndex), accountList, ec2RegionWorkers)
+    for accountId, regionList in zip(accountList, accountRegionLists):
+        accountRegions.extend((accountId, region) for region in regionList)
+    # Set filename for upload
+    fileName = 'processed_ec2_instances'
+
+    print(f'Retrieving EC2 data for {len(accountRegions)} Regions across {len(accountList)} Accounts.')
+
+    ec2Index = {}
+    def index_instances(instances):
+        for i in instances:
+            ec2Index[i['InstanceId']] = {field: i[field] for field in exposureEc2Fields}
+            yield i
 
-    quicksight = boto3.client('quicksight')
+    get_s3_publisher().publish_dataset(fileName, index_instances(iter_ec2_instances(accountRegions, regionIndex)))
+    # Regions are only recorded as scanned once the dataset holding their Instances is in S3
+    get_s3_publisher().after_publish(lambda: regionIndex.save(set(accountList)))
+    print(f'Finished retrieving EC2 data for all Regions and queued for upload to S3. {get_account_sessions().assumeRoleCalls} roles assumed.')
+
+    return ec2Index
+
+def setup_quicksight_group(groupName):
+    '''
+    Creates the QuickSight Group the Data Sources are shared with (or finds the existing one) and adds the Admins and Authors to it
+    '''
+    awsAccountId = get_aws_account_id()
     session = boto3.Session(region_name='us-east-1')
-    quicksightUsEast1 = session.client('quicksight')
+    quicksightUsEast1 = instrument_aws_client(session.client('quicksight'))
 
     print('Creating or updating QuickSight Group for MDE')
     try:
@@ -521,15 +3157,33 @@ def send_to_quicksight():
             raise error
     
     try:
-        response = quicksightUsEast1.list_users(
+        # Page through every user and the current members, only the Admins and Authors missing from the Group are added
+        groupMembers = {
+            str(m['MemberName']) for m in iter_quicksight_pages(
+                quicksightUsEast1.list_group_memberships,
+                'GroupMemberList',
+                GroupName=groupName,
+                AwsAccountId=awsAccountId,
+                MaxResults=100,
+                Namespace='default' # this MUST be 'default'
+            )
+        }
+        missingUsers = []
+        for u in iter_quicksight_pages(
+            quicksightUsEast1.list_users,
+            'UserList',
             AwsAccountId=awsAccountId,
             MaxResults=100,
             Namespace='default' # this MUST be 'default'
-        )
-        for u in response['UserList']:
+        ):
             userName = str(u['UserName'])
             roleLevel = str(u['Role'])
-            if roleLevel == 'ADMIN' or 'AUTHOR':
+            if roleLevel in quicksightGroupRoles and userName not in groupMembers:
+                missingUsers.append(userName)
+        print(f'{len(groupMembers)} users are already in Group {groupName}, adding {len(missingUsers)} Admins and Authors')
+
+        def add_group_member(userName):
+            try:
                 quicksightUsEast1.create_group_membership(
                     MemberName=userName,
                     GroupName=groupName,
@@ -537,68 +3191,602 @@ def send_to_quicksight():
                     Namespace='default' # this MUST be 'default'
                 )
                 print('User ' + userName + ' added to Group ' + groupName)
-            else:
-                pass
+            except botocore.exceptions.ClientError as error:
+                print(f'User {userName} could not be added to Group {groupName}: {error}')
+
+        with ThreadPoolExecutor(max_workers=quicksightWorkers) as executor:
+            list(executor.map(add_group_member, missingUsers))
     except Exception as e:
         print(e)
 
+def iter_quicksight_pages(listMethod, itemsKey, **kwargs):
+    '''
+    Generator which yields every item of a paged QuickSight List call, following NextToken
+    '''
+    while True:
+        response = listMethod(**kwargs)
+        yield from response.get(itemsKey, [])
+        nextToken = response.get('NextToken')
+        if not nextToken:
+            break
+        kwargs['NextToken'] = nextToken
 
-    print('Creating QuickSight Datasources based off MDE Machines, Vulns and EC2 Instances')
-    for filename in dataSourceList:
-        if filename == 'processed_machines':
-            dataSourceName = 'MDE_Machines'
-        elif filename == 'processed_machine_vulns':
-            dataSourceName = 'MDE_Vulnerabilities'
-        elif filename == 'processed_ec2_instances':
-            dataSourceName = 'EC2_Instances'
-        try:
-            response = quicksight.create_data_source(
-                AwsAccountId=awsAccountId,
-                DataSourceId=dataSourceName,
-                Name=dataSourceName,
-                Type='S3',
-                Permissions=[
-                    {
-                        'Principal': f'arn:aws:quicksight:us-east-1:{awsAccountId}:group/default/{groupName}',
-                        'Actions': [
-                            'quicksight:DescribeDataSource',
-                            'quicksight:DescribeDataSourcePermissions',
-                            'quicksight:PassDataSource',
-                            'quicksight:UpdateDataSource',
-                            'quicksight:DeleteDataSource',
-                            'quicksight:UpdateDataSourcePermissions'
-                        ]
+def wait_for_quicksight_ingestion(quicksight, awsAccountId, dataSetId, ingestionId):
+    '''
+    Polls a SPICE ingestion until it finishes or the timeout is reached, returns its status, duration and row counts
+    '''
+    startTime = time.perf_counter()
+    ingestion = {'IngestionStatus': 'RUNNING'}
+    while quicksightIngestionTimeoutSeconds:
+        ingestion = quicksight.describe_ingestion(
+            AwsAccountId=awsAccountId,
+            DataSetId=dataSetId,
+            IngestionId=ingestionId
+        )['Ingestion']
+        if ingestion['IngestionStatus'] in ('COMPLETED', 'FAILED', 'CANCELLED'):
+            break
+        if time.perf_counter() - startTime >= quicksightIngestionTimeoutSeconds:
+            print(f'Stopped waiting for the SPICE ingestion of {dataSetId} after {quicksightIngestionTimeoutSeconds} seconds')
+            break
+        time.sleep(quicksightPollSeconds)
+
+    return {
+        'ingestionId': ingestionId,
+        'status': ingestion['IngestionStatus'],
+        # The time QuickSight reports for the ingestion itself, and how long we waited for it from the moment it started
+        'seconds': ingestion.get('IngestionTimeInSeconds'),
+        'waitSeconds': round(time.perf_counter() - startTime, 1),
+        'rowsIngested': ingestion.get('RowInfo', {}).get('RowsIngested'),
+        'rowsDropped': ingestion.get('RowInfo', {}).get('RowsDropped'),
+        'error': ingestion.get('ErrorInfo', {}).get('Message')
+    }
+
+def get_last_ingestion_status(quicksight, awsAccountId, dataSetId):
+    '''
+    Returns the status of the most recent SPICE ingestion of a Data Set, None when it has none
+    '''
+    # Ingestions are listed newest first, the latest one is on the first page whatever the order within it
+    ingestions = quicksight.list_ingestions(AwsAccountId=awsAccountId, DataSetId=dataSetId, MaxResults=100)['Ingestions']
+    if not ingestions:
+        return None
+
+    return max(ingestions, key=lambda ingestion: ingestion['CreatedTime'])['IngestionStatus']
+
+def refresh_quicksight_dataset(quicksight, fileName, isChanged, dataSourceArns, dataSetIds, groupArn):
+    '''
+    Creates the Data Source and SPICE Data Set of a dataset the first time it is published, afterwards only starts a new
+    ingestion when the content of the dataset changed or its last ingestion did not succeed. Returns the summary of the
+    ingestion, or None if there was none
+    '''
+    awsAccountId = get_aws_account_id()
+    quicksightS3Bucket = get_required_env('QUICKSIGHT_S3_BUCKET_NAME')
+    dataSetId = quicksightDataSetNames[fileName]
+
+    # The Data Source points at the Manifest, whose Key never changes, so it never has to be updated once it exists
+    dataSourceArn = dataSourceArns.get(dataSetId)
+    if dataSourceArn is None:
+        response = quicksight.create_data_source(
+            AwsAccountId=awsAccountId,
+            DataSourceId=dataSetId,
+            Name=dataSetId,
+            Type='S3',
+            Permissions=[
+                {
+                    'Principal': groupArn,
+                    'Actions': [
+                        'quicksight:DescribeDataSource',
+                        'quicksight:DescribeDataSourcePermissions',
+                        'quicksight:PassDataSource',
+                        'quicksight:UpdateDataSource',
+                        'quicksight:DeleteDataSource',
+                        'quicksight:UpdateDataSourcePermissions'
+                    ]
+                }
+            ],
+            DataSourceParameters={
+                'S3Parameters': {
+                    'ManifestFileLocation': {
+                        'Bucket': quicksightS3Bucket,
+                        'Key': f'quicksight/{fileName}_manifest.json'
                     }
-                ],
-                DataSourceParameters={
-                    'S3Parameters': {
-                        'ManifestFileLocation': {
-                            'Bucket': quicksightS3Bucket,
-                            'Key': f'quicksight/{filename}_manifest.json'
-                        }
-                    } 
                 }
-            )
-            print('Data Source ' + dataSourceName + ' was created')
-        except botocore.exceptions.ClientError as error:
-            # If the Group exists already, handle the error gracefull
-            if error.response['Error']['Code'] == 'ResourceExistsException':
-                print('The Data Source ' + dataSourceName + ' already exists, attempting to update it')
-                response = quicksight.update_data_source(
-                    AwsAccountId=awsAccountId,
-                    DataSourceId=dataSourceName,
-                    Name=dataSourceName,
-                    DataSourceParameters={
-                        'S3Parameters': {
-                            'ManifestFileLocation': {
-                                'Bucket': quicksightS3Bucket,
-                                'Key': f'quicksight/{filename}_manifest.json'
-                            }
-                        } 
+            }
+        )
+        dataSourceArn = response['Arn']
+        # The Data Set can only be created once the Data Source is
+        creationStatus = response['CreationStatus']
+        while creationStatus == 'CREATION_IN_PROGRESS':
+            time.sleep(quicksightPollSeconds)
+            creationStatus = quicksight.describe_data_source(
+                AwsAccountId=awsAccountId,
+                DataSourceId=dataSetId
+            )['DataSource']['Status']
+        if creationStatus != 'CREATION_SUCCESSFUL':
+            raise RuntimeError(f'The QuickSight Data Source {dataSetId} could not be created: {creationStatus}')
+        print('Data Source ' + dataSetId + ' was created')
+
+    if dataSetId not in dataSetIds:
+        # Creating a SPICE Data Set starts its first ingestion
+        response = quicksight.create_data_set(
+            AwsAccountId=awsAccountId,
+            DataSetId=dataSetId,
+            Name=dataSetId,
+            ImportMode='SPICE',
+            PhysicalTableMap={
+                fileName: {
+                    'S3Source': {
+                        'DataSourceArn': dataSourceArn,
+                        # S3 columns always come in as strings, they can be cast in the Data Set afterwards
+                        'InputColumns': [{'Name': column, 'Type': 'STRING'} for column in get_dataset_columns(fileName)]
                     }
+                }
+            },
+            Permissions=[
+                {
+                    'Principal': groupArn,
+                    'Actions': [
+                        'quicksight:DescribeDataSet',
+                        'quicksight:DescribeDataSetPermissions',
+                        'quicksight:PassDataSet',
+                        'quicksight:DescribeIngestion',
+                        'quicksight:ListIngestions',
+                        'quicksight:UpdateDataSet',
+                        'quicksight:DeleteDataSet',
+                        'quicksight:CreateIngestion',
+                        'quicksight:CancelIngestion',
+                        'quicksight:UpdateDataSetPermissions'
+                    ]
+                }
+            ]
+        )
+        ingestionId = response['IngestionId']
+        print('SPICE Data Set ' + dataSetId + ' was created')
+    elif isChanged or get_last_ingestion_status(quicksight, awsAccountId, dataSetId) in ('FAILED', 'CANCELLED'):
+        # Incremental refresh is only offered for SQL Data Sources, an S3 Data Set is always fully refreshed which is why
+        # unchanged datasets are not refreshed at all - unless their last ingestion failed (or was still running when an
+        # earlier run stopped waiting for it and failed later), then the SPICE data is older than the dataset in S3
+        # Ingestion IDs must be unique per Data Set, back to back runs can start within the same second
+        ingestionId = f'mde-reporter-{int(time.time())}-{random.getrandbits(32):08x}'
+        quicksight.create_ingestion(
+            AwsAccountId=awsAccountId,
+            DataSetId=dataSetId,
+            IngestionId=ingestionId,
+            IngestionType='FULL_REFRESH'
+        )
+        print('SPICE ingestion of ' + dataSetId + ' was started')
+    else:
+        print('The Data Set ' + dataSetId + ' is unchanged since the last run, skipping it')
+        return None
+
+    return wait_for_quicksight_ingestion(quicksight, awsAccountId, dataSetId, ingestionId)
+
+def refresh_quicksight_datasets(fileNames, changedDatasets, groupName):
+    '''
+    Refreshes the QuickSight Data Sets of the published datasets at the same time and waits for their SPICE ingestions,
+    raises once all of them are done if any failed
+    '''
+    awsAccountId = get_aws_account_id()
+    quicksight = instrument_aws_client(boto3.client('quicksight'))
+    groupArn = f'arn:aws:quicksight:us-east-1:{awsAccountId}:group/default/{groupName}'
+
+    # One listing of each instead of trying to create (and then update) every Data Source on every run
+    dataSourceArns = {
+        d['DataSourceId']: d['Arn'] for d in iter_quicksight_pages(quicksight.list_data_sources, 'DataSources', AwsAccountId=awsAccountId)
+    }
+    dataSetIds = {
+        d['DataSetId'] for d in iter_quicksight_pages(quicksight.list_data_sets, 'DataSetSummaries', AwsAccountId=awsAccountId)
+    }
+
+    def refresh(fileName):
+        try:
+            return refresh_quicksight_dataset(quicksight, fileName, fileName in changedDatasets, dataSourceArns, dataSetIds, groupArn)
+        except Exception as e:
+            return e
+
+    errors = []
+    # Ingestions mostly wait on QuickSight, so every Data Set gets its own worker
+    with ThreadPoolExecutor(max_workers=max(len(fileNames), 1)) as executor:
+        for fileName, result in zip(fileNames, executor.map(refresh, fileNames)):
+            dataSetId = quicksightDataSetNames[fileName]
+            if isinstance(result, Exception):
+                print(f'The Data Set {dataSetId} could not be refreshed: {result}')
+                errors.append(result)
+            elif result is not None:
+                runMetrics.record_ingestion(fileName, result)
+                rowCounts = ''
+                if result['rowsIngested'] is not None:
+                    rowCounts = f', {result["rowsIngested"]} rows ingested and {result["rowsDropped"]} dropped'
+                print(f'SPICE ingestion of {dataSetId}: {result["status"]} in {result["seconds"]} seconds ({result["waitSeconds"]} seconds waited){rowCounts}')
+                if result['status'] in ('FAILED', 'CANCELLED'):
+                    errors.append(RuntimeError(f'The SPICE ingestion of {dataSetId} ended {result["status"]}: {result["error"]}'))
+
+    if errors:
+        raise errors[0]
+
+# Stages of the pipeline in the order they are added to the StageRunner, and the stages each of them needs results from
+pipelineStages = ['ec2', 'machines', 'vulns', 'quicksight_group']
+stageDependencies = {
+    'vulns': ['machines']
+}
+
+# Stage credited with the records and bytes of each dataset in the run metrics, the rest come out of the vulnerability stage
+datasetStages = {
+    'processed_machines': 'machines',
+    'processed_ec2_instances': 'ec2'
+}
+
+# Datasets written by each stage - if a stage fails these are not refreshed. The exposure dataset needs both EC2 and vulnerabilities
+stageDatasets = {
+    'ec2': ['processed_ec2_instances', 'processed_exposure'],
+    'machines': [
+        'processed_machines', 'processed_machine_vulns', 'processed_vuln_catalog', 'processed_machine_vuln_edges',
+        'processed_exposure'
+    ],
+    'vulns': ['processed_machine_vulns', 'processed_vuln_catalog', 'processed_machine_vuln_edges', 'processed_exposure']
+}
+
+def resolve_stages(stages=None):
+    '''
+    Returns the selected stages plus every stage they depend on in pipeline order, all stages when none are selected
+    '''
+    if not stages:
+        return list(pipelineStages)
+    selected = set()
+    pending = list(stages)
+    while pending:
+        stage = pending.pop()
+        if stage not in pipelineStages:
+            raise ValueError(f'Unknown stage {stage}, use one of {", ".join(pipelineStages)}')
+        if stage not in selected:
+            selected.add(stage)
+            pending.extend(stageDependencies.get(stage, []))
+
+    return [stage for stage in pipelineStages if stage in selected]
+
+def send_to_quicksight(stages=None):
+    '''
+    This function runs the collection stages concurrently, uploads the final datasets to S3 and refreshes a SPICE Data Set
+    within QuickSight for each of them. Pass a list of stage names to only run those (and what they depend on)
+    '''
+    stages = resolve_stages(stages)
+    # The QuickSight Group is only needed to share Data Sources, which are not touched without publishing
+    if not publishEnabled and 'quicksight_group' in stages:
+        stages.remove('quicksight_group')
+    groupName = 'MDE_Viewers'
+    print(f'Running stages: {", ".join(stages)}')
+
+    # EC2 and MDE share no data, so EC2 collection, MDE Machines -> Vulnerabilities and the QuickSight Group all run at the
+    # same time. Only the exposure join needs the EC2 index, and it holds its rows back until the EC2 stage is done
+    runner = StageRunner()
+    if 'ec2' in stages:
+        runner.add_stage('ec2', get_ec2_metadata)
+    if 'machines' in stages:
+        runner.add_stage('machines', get_machines)
+    if 'vulns' in stages:
+        if buildExposureDataset and 'ec2' in stages:
+            runner.add_stage('vulns', lambda mdeMachines: get_machine_vulns(mdeMachines, runner.get_future('ec2')), dependsOn=['machines'])
+        else:
+            runner.add_stage('vulns', get_machine_vulns, dependsOn=['machines'])
+    if 'quicksight_group' in stages:
+        runner.add_stage('quicksight_group', lambda: setup_quicksight_group(groupName))
+    _, stageErrors = runner.run()
+    if mdeClient is not None:
+        print(f'MDE API usage: {mdeClient.get_stats()}')
+
+    if not publishEnabled:
+        get_s3_publisher().shutdown_shard_pool()
+        print('Publishing is skipped, the datasets were only written to the working directory.')
+        if stageErrors:
+            raise RuntimeError(f'The {", ".join(stageErrors)} stage(s) failed: {"; ".join(str(e) for e in stageErrors.values())}')
+        return
+
+    # Wait for every dataset and Manifest to land in S3, only datasets whose content changed need QuickSight updates
+    with runMetrics.stage('publish'):
+        changedDatasets = get_s3_publisher().wait_for_uploads()
+    failedDatasets = set()
+    for stageName in stageErrors:
+        failedDatasets.update(stageDatasets.get(stageName, []))
+    # Filenames for Quicksight - add the file names of the stages which ran to an empty list
+    dataSourceList = []
+    if 'machines' in stages:
+        machinesFileName = 'processed_machines'
+        dataSourceList.append(machinesFileName)
+    if 'vulns' in stages and vulnDatasetLayout != 'normalized':
+        machineVulnsFileName = 'processed_machine_vulns'
+        dataSourceList.append(machineVulnsFileName)
+    if 'vulns' in stages and vulnDatasetLayout != 'denormalized':
+        vulnCatalogFileName = 'processed_vuln_catalog'
+        dataSourceList.append(vulnCatalogFileName)
+        vulnEdgesFileName = 'processed_machine_vuln_edges'
+        dataSourceList.append(vulnEdgesFileName)
+    if 'ec2' in stages:
+        ec2FileName = 'processed_ec2_instances'
+        dataSourceList.append(ec2FileName)
+    if buildExposureDataset and 'ec2' in stages and 'vulns' in stages:
+        exposureFileName = 'processed_exposure'
+        dataSourceList.append(exposureFileName)
+    for filename in [filename for filename in dataSourceList if filename in failedDatasets]:
+        print('The Data Set ' + quicksightDataSetNames[filename] + ' was not refreshed because the stage building it failed, skipping it')
+        dataSourceList.remove(filename)
+
+    print('Refreshing QuickSight Data Sets based off MDE Machines, Vulns, EC2 Instances and EC2 Exposure')
+    with runMetrics.stage('quicksight_datasets'):
+        refresh_quicksight_datasets(dataSourceList, changedDatasets, groupName)
+
+    # Everything the other stages produced is published by now, still fail the run so the failed stages are noticed
+    if stageErrors:
+        raise RuntimeError(f'The {", ".join(stageErrors)} stage(s) failed: {"; ".join(str(e) for e in stageErrors.values())}')
+
+def get_changed_ec2_instances(ec2Changes):
+    '''
+    Describes the EC2 Instances named in state-change events again, grouped per Account and Region. Returns the shaped
+    records keyed by InstanceId, None for the Instances which no longer exist
+    '''
+    changedRecords = {}
+    for (accountId, region), instanceIds in ec2Changes.items():
+        instanceIds = sorted(instanceIds)
+        changedRecords.update(dict.fromkeys(instanceIds))
+        ec2 = get_account_sessions().client(accountId, 'ec2', region)
+        # Filtering on the IDs rather than passing InstanceIds, so one Instance which is already gone does not fail the call
+        for i in range(0, len(instanceIds), ec2FilterMaxValues):
+            paginator = ec2.get_paginator('describe_instances')
+            # The state filter of the full scan applies too, so an Instance which left the kept states is dropped
+            instanceFilters = [{'Name': 'instance-id', 'Values': instanceIds[i:i + ec2FilterMaxValues]}] + get_ec2_instance_filters()
+            for page in paginator.paginate(Filters=instanceFilters):
+                for record in projectEc2Instances([i for r in page['Reservations'] for i in r['Instances']], accountId, region):
+                    changedRecords[record['InstanceId']] = record
+    runMetrics.count('ec2', 'recordsIn', len([record for record in changedRecords.values() if record is not None]))
+
+    return changedRecords
+
+def get_changed_machine(machineId, client):
+    '''
+    Retrieves and shapes a single MDE Machine, None when it is gone or Inactive (the full scan leaves those out too)
+    '''
+    try:
+        r = client.get(f'{mdeApiUrl}/api/machines/{machineId}')
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            return None
+        raise e
+    machine = r.json()
+    if str(machine.get('healthStatus')) == 'Inactive':
+        return None
+
+    return projectMachine(machine)
+
+def get_changed_machines(machineIds):
+    '''
+    Retrieves the MDE Machines named in change events concurrently, returns the shaped records keyed by Machine ID
+    '''
+    client = get_mde_client()
+    machineIds = sorted(machineIds)
+    changedRecords = dict(zip(machineIds, bounded_ordered_map(lambda machineId: get_changed_machine(machineId, client), machineIds, mdeVulnWorkers)))
+    runMetrics.count('machines', 'recordsIn', len([record for record in changedRecords.values() if record is not None]))
+
+    return changedRecords
+
+def parse_dataset_object(body, key):
+    # The format is told by the Key rather than OUTPUT_FORMAT, so a dataset published in another format can still be read
+    if key.endswith('.json'):
+        return json.loads(body)
+    delimiter = '\t' if key.endswith('.tsv.gz') else ','
+    reader = csv.DictReader(io.StringIO(gzip.decompress(body).decode('utf-8')), delimiter=delimiter)
+
+    return [{column: (value if value != '' else None) for column, value in row.items()} for row in reader]
+
+def read_published_dataset(fileName):
+    '''
+    Reads back the records of a published dataset from the objects its Manifest lists by URI - the single dataset object,
+    or the shards of the latest day for the partitioned output. Raises when the dataset was published in another format
+    or layout than OUTPUT_FORMAT and PARTITIONED_OUTPUT, publishing it again would leave the full scan's objects behind
+    '''
+    bucket = get_required_env('QUICKSIGHT_S3_BUCKET_NAME')
+    try:
+        manifest = json.loads(get_s3_client().get_object(Bucket=bucket, Key=f'quicksight/{fileName}_manifest.json')['Body'].read())
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            raise RuntimeError(f'{fileName} was never published, run a full scan before handling change events') from error
+        raise error
+
+    records = []
+    for location in manifest['fileLocations']:
+        for uri in location.get('URIs', []):
+            key = urlsplit(uri).path.lstrip('/')
+            if key.startswith(partitionedKeyPrefix) != partitionedOutput or not key.endswith(f'.{outputFormats[outputFormat]["extension"]}'):
+                raise RuntimeError(
+                    f'{fileName} was published as {key}, which does not match OUTPUT_FORMAT {outputFormat} and PARTITIONED_OUTPUT '
+                    f'{str(partitionedOutput).lower()} - give the function the same output settings as the full scan'
                 )
-                print('Data Source ' + dataSourceName + ' was updated')
+            records.extend(parse_dataset_object(get_s3_client().get_object(Bucket=bucket, Key=key)['Body'].read(), key))
+
+    return records
+
+def patch_dataset(fileName, changedRecords):
+    '''
+    Applies changed records to a published dataset - replaced in place, appended when new and dropped when None - and
+    queues it for publishing again. Returns the record count
+    '''
+    keyColumn = patchableDatasetKeys[fileName]
+    pendingRecords = dict(changedRecords)
+    patchedRecords = []
+    for record in read_published_dataset(fileName):
+        recordKey = record.get(keyColumn)
+        if recordKey in pendingRecords:
+            record = pendingRecords.pop(recordKey)
+            if record is None:
+                continue
+        patchedRecords.append(record)
+    patchedRecords.extend(record for record in pendingRecords.values() if record is not None)
+    print(f'Patching {len(changedRecords)} records of {fileName}, {len(patchedRecords)} records after the patch.')
+
+    return get_s3_publisher().publish_dataset(fileName, patchedRecords)
+
+def get_change_events(event):
+    '''
+    Returns the EventBridge events of an invocation - the event itself, or the batch of an SQS event source mapping
+    '''
+    if 'Records' in event:
+        return [json.loads(record['body']) for record in event['Records']]
+
+    return [event]
+
+def apply_change_events(changeEvents):
+    '''
+    Patches the EC2 Instances and MDE Machines named in a batch of change events into their published datasets and
+    refreshes the Data Sets which changed. Vulnerabilities and the exposure dataset are left to the full scan
+    '''
+    ec2Changes = {}
+    machineIds = set()
+    for changeEvent in changeEvents:
+        detailType = changeEvent.get('detail-type')
+        detail = changeEvent.get('detail') or {}
+        if detailType == ec2StateChangeDetailType:
+            accountId = changeEvent['account']
+            # Outside of organization mode only the Account we run in is inventoried
+            if not organizationMode and accountId != get_aws_account_id():
+                print(f'Ignoring the state change of {detail.get("instance-id")} in Account {accountId}, organization mode is off')
+                continue
+            ec2Changes.setdefault((accountId, changeEvent['region']), set()).add(detail['instance-id'])
+        elif detailType == mdeMachineChangeDetailType:
+            machineIds.update(detail.get('machineIds') or [detail['machineId']])
+        else:
+            print(f'Ignoring unsupported event {detailType} from {changeEvent.get("source")}')
+    print(f'Handling changes to {sum(len(instanceIds) for instanceIds in ec2Changes.values())} EC2 Instances and {len(machineIds)} MDE Machines')
+
+    patchedDatasets = []
+    if ec2Changes:
+        with runMetrics.stage('ec2'):
+            patch_dataset('processed_ec2_instances', get_changed_ec2_instances(ec2Changes))
+        patchedDatasets.append('processed_ec2_instances')
+    if machineIds:
+        with runMetrics.stage('machines'):
+            patch_dataset('processed_machines', get_changed_machines(machineIds))
+        patchedDatasets.append('processed_machines')
+    if not patchedDatasets or not publishEnabled:
+        get_s3_publisher().shutdown_shard_pool()
+        return patchedDatasets
+
+    with runMetrics.stage('publish'):
+        changedDatasets = get_s3_publisher().wait_for_uploads()
+    with runMetrics.stage('quicksight_datasets'):
+        refresh_quicksight_datasets(patchedDatasets, changedDatasets, 'MDE_Viewers')
+
+    return patchedDatasets
+
+def reset_run_state():
+    '''
+    Starts a new run in a warm process, such as a Lambda container serving its next invocation - new metrics and a new
+    publisher, while the MDE token, connection pool and assumed role Sessions are reused
+    '''
+    global runMetrics, s3Publisher
+    runMetrics = RunMetrics()
+    with s3PublisherLock:
+        s3Publisher = None
+
+def lambda_handler(event, context=None):
+    '''
+    Entry point of the event-driven mode. EC2 Instance state-change and MDE Machine change events (one at a time, or
+    batched through SQS) are patched into the published datasets, a Scheduled Event runs the full scan instead
+    '''
+    reset_run_state()
+    # Only /tmp is writable in Lambda, local runs keep writing to the working directory
+    if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+        os.chdir(tempfile.gettempdir())
+    changeEvents = get_change_events(event)
+    fullScan = any(changeEvent.get('detail-type') == scheduledEventDetailType for changeEvent in changeEvents)
+    # A full scan holding the lock is waited for as long as the function has time left for its own work, otherwise the
+    # batch fails and SQS hands it out again once its visibility timeout is over
+    lockWaitSeconds = runLockWaitSeconds
+    if context is not None:
+        lockWaitSeconds = max(0, min(lockWaitSeconds, context.get_remaining_time_in_millis() // 1000 - lambdaLockMarginSeconds))
+    try:
+        with runMetrics.stage('pipeline'), hold_run_lock(lockWaitSeconds):
+            if fullScan:
+                send_to_quicksight()
+                patchedDatasets = []
             else:
-                raise error
+                patchedDatasets = apply_change_events(changeEvents)
+    finally:
+        write_run_metrics()
+
+    return {'events': len(changeEvents), 'fullScan': fullScan, 'patchedDatasets': patchedDatasets}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Collects EC2 Instances and MDE Machines and Vulnerabilities, publishes them to S3 and creates QuickSight Data Sources for them'
+    )
+    parser.add_argument(
+        '--only',
+        action='append',
+        choices=pipelineStages,
+        help='Only run this stage and the stages it depends on, can be repeated. All stages run by default'
+    )
+    parser.add_argument(
+        '--skip-publish',
+        action='store_true',
+        help='Only write the datasets to the working directory, nothing is uploaded to S3 or changed in QuickSight'
+    )
+    parser.add_argument(
+        '--response-cache',
+        choices=['off', 'record', 'replay'],
+        help='Overrides RESPONSE_CACHE_MODE. record serves fresh cached API responses and stores the rest, replay serves every response from the cache'
+    )
+    parser.add_argument(
+        '--event',
+        action='append',
+        help='Handle a recorded EventBridge (or SQS batch) event JSON file like the Lambda handler would instead of running the full scan, can be repeated'
+    )
+
+    return parser.parse_args(argv)
+
+def write_run_metrics():
+    '''
+    Writes the run metrics to the JSON metrics file, uploads it next to the datasets when publishing so runs can be
+    compared day over day, and prints the Embedded Metric Format lines for CloudWatch
+    '''
+    metricsReport = runMetrics.to_dict()
+    if responseCache is not None and responseCache.enabled:
+        metricsReport['responseCache'] = responseCache.get_stats()
+        print(f'Response cache: {metricsReport["responseCache"]}')
+    with open(metricsFile, 'w') as f:
+        json.dump(metricsReport, f, indent=2)
+    print(f'Run metrics written to {metricsFile}')
+
+    if publishEnabled and metricsKeyPrefix:
+        metricsKey = f'{metricsKeyPrefix}{time.strftime("%Y-%m-%dT%H-%M-%SZ", time.gmtime(runMetrics.startedAt))}.json'
+        # Losing the metrics is no reason to fail a run which published its datasets
+        try:
+            get_s3_client().put_object(
+                Bucket=get_required_env('QUICKSIGHT_S3_BUCKET_NAME'),
+                Key=metricsKey,
+                Body=json.dumps(metricsReport, indent=2).encode('utf-8')
+            )
+            print(f'Run metrics uploaded to {metricsKey}')
+        except Exception as e:
+            print(f'Run metrics could not be uploaded: {e}')
+
+    if metricsNamespace:
+        for line in runMetrics.get_emf_lines(metricsNamespace):
+            print(line)
+
+def main(argv=None):
+    global publishEnabled, responseCacheMode
+    args = parse_args(argv)
+    publishEnabled = not args.skip_publish
+    if args.response_cache:
+        responseCacheMode = args.response_cache
+    if args.event:
+        for eventFile in args.event:
+            with open(eventFile) as f:
+                event = json.load(f)
+            print(f'{eventFile}: {lambda_handler(event)}')
+        return
+    try:
+        with runMetrics.stage('pipeline'), hold_run_lock():
+            send_to_quicksight(args.only)
+    finally:
+        write_run_metrics()
 
-send_to_quicksight()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
\ No newline at end of file
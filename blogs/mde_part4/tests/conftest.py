@@ -0,0 +1,133 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+import hashlib
+import io
+import json
+import os
+import sys
+
+import botocore.exceptions
+import pytest
+
+# report.py is a single deployable script rather than a package, the tests import it from the directory above
+reportDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.abspath(reportDir))
+# Boto3 clients are only created on first use, but they still need a Region and credentials to be created at all
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+
+import report
+
+def client_error(code, operationName):
+    return botocore.exceptions.ClientError({'Error': {'Code': code, 'Message': code}}, operationName)
+
+class FakeS3():
+    '''
+    Keeps put objects in a dict, enough for the S3Publisher state, its uploads and the conditional writes of the run lock.
+    Writes to the Keys in failKeys fail
+    '''
+    def __init__(self):
+        self.objects = {}
+        self.puts = []
+        self.failKeys = set()
+
+    def get_etag(self, body):
+        return f'"{hashlib.md5(body).hexdigest()}"'
+
+    def put_object(self, Bucket, Key, Body, IfNoneMatch=None, IfMatch=None, **kwargs):
+        if Key in self.failKeys:
+            raise client_error('InternalError', 'PutObject')
+        current = self.objects.get((Bucket, Key))
+        if IfNoneMatch == '*' and current is not None:
+            raise client_error('PreconditionFailed', 'PutObject')
+        if IfMatch is not None and (current is None or self.get_etag(current) != IfMatch):
+            raise client_error('PreconditionFailed', 'PutObject')
+        self.puts.append(Key)
+        self.objects[(Bucket, Key)] = Body
+
+        return {'ETag': self.get_etag(Body)}
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        with open(Filename, 'rb') as f:
+            self.put_object(Bucket=Bucket, Key=Key, Body=f.read())
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        # Like boto3 the missing object surfaces as the 404 of the HeadObject call made before downloading
+        if (Bucket, Key) not in self.objects:
+            raise client_error('404', 'HeadObject')
+        with open(Filename, 'wb') as f:
+            f.write(self.objects[(Bucket, Key)])
+
+    def get_object(self, Bucket, Key, **kwargs):
+        if (Bucket, Key) not in self.objects:
+            raise client_error('NoSuchKey', 'GetObject')
+        body = self.objects[(Bucket, Key)]
+
+        return {'Body': io.BytesIO(body), 'ETag': self.get_etag(body)}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.objects.pop((Bucket, Key), None)
+
+        return {}
+
+@pytest.fixture
+def fakeS3(monkeypatch):
+    s3 = FakeS3()
+    monkeypatch.setattr(report, 'get_s3_client', lambda: s3)
+    return s3
+
+@pytest.fixture
+def localPublisher(monkeypatch, tmp_path):
+    '''
+    Process-wide S3Publisher which only writes the datasets into a temporary working directory
+    '''
+    monkeypatch.chdir(tmp_path)
+    publisher = report.S3Publisher('bucket', 'state.json', publishEnabled=False)
+    monkeypatch.setattr(report, 's3Publisher', publisher)
+    monkeypatch.setattr(report, 'runMetrics', report.RunMetrics())
+    yield publisher
+    publisher.shutdown_shard_pool()
+
+def get_mde_vuln(cveId, severity='High'):
+    '''
+    Vulnerability as the MDE API returns it, before it is shaped
+    '''
+    return {
+        'id': cveId,
+        'name': cveId,
+        'description': f'{cveId} description',
+        'severity': severity,
+        'cvssV3': 7.5,
+        'exposedMachines': 1,
+        'publishedOn': '2026-01-01T00:00:00Z',
+        'updatedOn': '2026-01-02T00:00:00Z',
+        'publicExploit': False,
+        'exploitVerified': False,
+        'exploitInKit': False,
+        'exploitTypes': [],
+        'exploitUris': []
+    }
+
+def read_json_dataset(fileName):
+    # Datasets written by localPublisher in the default json format
+    with open(f'{fileName}.json') as f:
+        return json.load(f)
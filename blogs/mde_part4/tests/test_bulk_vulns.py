@@ -0,0 +1,113 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+
+import json
+
+import requests
+
+import report
+from conftest import get_mde_vuln
+
+exportUrl = f'{report.mdeApiUrl}/api/vulnerabilities/machinesVulnerabilities'
+catalogUrl = f'{report.mdeApiUrl}/api/vulnerabilities'
+
+class FakePagedClient():
+    '''
+    Serves the records of every URL in $top sized pages at $skip, like the MDE list endpoints which do not return a nextLink
+    '''
+    def __init__(self, records):
+        self.records = records
+        self.calls = []
+
+    def get(self, url, params=None, latencies=None):
+        self.calls.append((url, dict(params or {})))
+        if latencies is not None:
+            latencies.append(0.01)
+        skip = int(params.get('$skip', 0))
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps({'value': self.records[url][skip:skip + int(params['$top'])]}).encode('utf-8')
+
+        return response
+
+def get_export_row(machineId, cveId, productName='openssl'):
+    return {'id': f'{machineId}-{cveId}-{productName}', 'machineId': machineId, 'cveId': cveId, 'productName': productName, 'severity': 'Medium'}
+
+def test_skip_paging_stops_after_a_short_page():
+    client = FakePagedClient({catalogUrl: [{'id': str(i)} for i in range(5)]})
+    records = list(report.get_mde_pages(catalogUrl, client, {'$top': 2, '$skip': 0}))
+
+    assert [record['id'] for record in records] == ['0', '1', '2', '3', '4']
+    assert [params['$skip'] for url, params in client.calls] == [0, 2, 4]
+
+def test_skip_paging_asks_once_more_after_a_full_last_page():
+    client = FakePagedClient({catalogUrl: [{'id': str(i)} for i in range(4)]})
+    records = list(report.get_mde_pages(catalogUrl, client, {'$top': 2, '$skip': 0}))
+
+    assert len(records) == 4
+    assert [params['$skip'] for url, params in client.calls] == [0, 2, 4]
+
+def test_next_link_is_followed_without_params():
+    class NextLinkClient():
+        def __init__(self):
+            self.calls = []
+
+        def get(self, url, params=None, latencies=None):
+            self.calls.append((url, params))
+            payload = {'value': [{'id': url}]}
+            if url == catalogUrl:
+                payload['@odata.nextLink'] = f'{catalogUrl}?$skiptoken=abc'
+            response = requests.Response()
+            response.status_code = 200
+            response._content = json.dumps(payload).encode('utf-8')
+
+            return response
+
+    client = NextLinkClient()
+    records = list(report.get_mde_pages(catalogUrl, client, {'$top': 1}))
+
+    assert len(records) == 2
+    assert client.calls == [(catalogUrl, {'$top': 1}), (f'{catalogUrl}?$skiptoken=abc', None)]
+
+def test_bulk_export_is_joined_to_the_catalog(monkeypatch):
+    monkeypatch.setattr(report, 'mdeBulkPageSize', 2)
+    client = FakePagedClient({
+        exportUrl: [
+            get_export_row('m1', 'CVE-2026-0001'),
+            # The same CVE through a second product only counts once
+            get_export_row('m1', 'CVE-2026-0001', 'libssl'),
+            get_export_row('m2', 'CVE-2026-0002'),
+            # Machines get_machines() filtered out are dropped
+            get_export_row('m-inactive', 'CVE-2026-0003'),
+            # A CVE the catalog does not have yet keeps what the export knows about it
+            get_export_row('m2', 'CVE-2026-0009')
+        ],
+        catalogUrl: [get_mde_vuln(f'CVE-2026-000{i}') for i in range(1, 6)]
+    })
+    records = list(report.iter_bulk_machine_vulns(['m1', 'm2'], client))
+
+    assert [(record['vuln_MachineId'], record['id']) for record in records] == [
+        ('m1', 'CVE-2026-0001'), ('m2', 'CVE-2026-0002'), ('m2', 'CVE-2026-0009')
+    ]
+    assert records[0] == report.projectMachineVuln(get_mde_vuln('CVE-2026-0001'), 'm1')
+    assert records[2]['severity'] == 'Medium'
+    assert [params['$skip'] for url, params in client.calls if url == exportUrl] == [0, 2, 4]
+    assert [params['$skip'] for url, params in client.calls if url == catalogUrl] == [0, 2, 4]
@@ -0,0 +1,180 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+
+import json
+import types
+
+import botocore.exceptions
+import pytest
+
+import report
+
+def raise_access_denied(accountId, region, regionIndex):
+    raise botocore.exceptions.ClientError({'Error': {'Code': 'UnauthorizedOperation', 'Message': 'denied by SCP'}}, 'DescribeInstances')
+
+@pytest.fixture
+def deniedRegion(monkeypatch):
+    monkeypatch.setattr(report, 'scan_ec2_region_instances', raise_access_denied)
+    monkeypatch.setattr(report, 'runMetrics', report.RunMetrics())
+
+def test_denied_region_is_skipped_in_organization_mode(monkeypatch, deniedRegion):
+    monkeypatch.setattr(report, 'organizationMode', True)
+    regionIndex = report.Ec2RegionIndex('bucket', 'index.json', publishEnabled=False)
+
+    assert report.get_ec2_region_instances('210987654321', 'eu-south-1', regionIndex) == ([], 0.0)
+    assert report.runMetrics.get_stage('ec2')['regionsFailed'] == 1
+
+def test_denied_region_fails_the_stage_for_a_single_account(monkeypatch, deniedRegion):
+    monkeypatch.setattr(report, 'organizationMode', False)
+    regionIndex = report.Ec2RegionIndex('bucket', 'index.json', publishEnabled=False)
+
+    with pytest.raises(botocore.exceptions.ClientError):
+        report.get_ec2_region_instances('123456789012', 'eu-south-1', regionIndex)
+
+@pytest.fixture
+def ec2Scan(monkeypatch, fakeS3, tmp_path):
+    '''
+    Publishing run over a single Account and Region holding one Instance, the scan is recorded in the Region index as usual
+    '''
+    monkeypatch.chdir(tmp_path)
+    publisher = report.S3Publisher('bucket', 'state.json')
+    monkeypatch.setattr(report, 's3Publisher', publisher)
+    monkeypatch.setattr(report, 'runMetrics', report.RunMetrics())
+    monkeypatch.setattr(report, 'get_target_aws_accounts', lambda: ['123456789012'])
+    monkeypatch.setattr(report, 'get_account_regions', lambda accountId, regionIndex: ['us-east-1'])
+    monkeypatch.setattr(report, 'get_account_sessions', lambda: types.SimpleNamespace(assumeRoleCalls=0))
+    def iter_instances(accountRegions, regionIndex):
+        for accountId, region in accountRegions:
+            regionIndex.record_scan(accountId, region, 1)
+            yield {field: None for field in report.datasetColumns['processed_ec2_instances']} | {'InstanceId': 'i-0123456789abcdef0'}
+    monkeypatch.setattr(report, 'iter_ec2_instances', iter_instances)
+
+    return publisher
+
+def test_region_index_is_saved_once_the_ec2_dataset_is_published(fakeS3, ec2Scan):
+    ec2Index = report.get_ec2_metadata()
+    assert list(ec2Index) == ['i-0123456789abcdef0']
+    # Nothing is saved while the upload may still fail
+    assert ('bucket', report.ec2RegionIndexKey) not in fakeS3.objects
+
+    ec2Scan.wait_for_uploads()
+    regionIndex = json.loads(fakeS3.objects[('bucket', report.ec2RegionIndexKey)])
+    assert regionIndex['accounts']['123456789012']['activity']['us-east-1']['instances'] == 1
+
+def test_region_index_is_not_saved_when_the_ec2_upload_fails(fakeS3, ec2Scan):
+    fakeS3.failKeys.add('quicksight/processed_ec2_instances.json')
+    report.get_ec2_metadata()
+
+    with pytest.raises(botocore.exceptions.ClientError):
+        ec2Scan.wait_for_uploads()
+    assert ('bucket', report.ec2RegionIndexKey) not in fakeS3.objects
+
+def get_ec2_instance(instanceId):
+    return {
+        'ImageId': 'ami-1', 'InstanceId': instanceId, 'InstanceType': 't3.micro', 'LaunchTime': '2026-10-17T00:00:00Z',
+        'PrivateDnsName': 'ip-10-0-0-1.ec2.internal', 'PrivateIpAddress': '10.0.0.1', 'PublicDnsName': '', 'State': {'Name': 'running'},
+        'SubnetId': 'subnet-1', 'VpcId': 'vpc-1', 'Architecture': 'x86_64', 'BlockDeviceMappings': [{'Ebs': {'VolumeId': 'vol-1'}}],
+        'NetworkInterfaces': [{'NetworkInterfaceId': 'eni-1'}], 'SecurityGroups': [{'GroupId': 'sg-1', 'GroupName': 'default'}],
+        'MetadataOptions': {'HttpTokens': 'required', 'HttpPutResponseHopLimit': 2, 'HttpEndpoint': 'enabled', 'InstanceMetadataTags': 'disabled'},
+        'EnclaveOptions': {'Enabled': False}
+    }
+
+class FakeEc2():
+    '''
+    Pages through the Instances of a Region MaxResults at a time, the NextToken is the index of the next Instance
+    '''
+    def __init__(self, instanceIds):
+        self.instances = [get_ec2_instance(instanceId) for instanceId in instanceIds]
+        self.calls = []
+
+    def describe_instances(self, MaxResults, NextToken=None, Filters=None):
+        self.calls.append((MaxResults, NextToken))
+        start = int(NextToken or 0)
+        instances = self.instances[start:start + MaxResults]
+        # Like EC2 an empty page has no Reservations at all
+        page = {'Reservations': [{'Instances': instances}] if instances else []}
+        if start + MaxResults < len(self.instances):
+            page['NextToken'] = str(start + MaxResults)
+
+        return page
+
+@pytest.fixture
+def regionScan(monkeypatch, tmp_path):
+    '''
+    Region scans against a FakeEc2 with probing of empty Regions turned on, returns a function setting the Region's Instances
+    '''
+    monkeypatch.setattr(report, 'runMetrics', report.RunMetrics())
+    monkeypatch.setattr(report, 'responseCache', report.ResponseCache(str(tmp_path / 'cache'), 'off', 0, 0))
+    monkeypatch.setattr(report, 'ec2EmptyRegionProbeHours', 24)
+    monkeypatch.setattr(report, 'ec2PageSize', 2)
+    def use_instances(instanceIds):
+        ec2 = FakeEc2(instanceIds)
+        monkeypatch.setattr(report, 'get_account_sessions', lambda: types.SimpleNamespace(client=lambda accountId, service, region: ec2))
+        return ec2
+
+    return use_instances
+
+def get_region_index(instances=None, scannedHoursAgo=0):
+    regionIndex = report.Ec2RegionIndex('bucket', 'index.json', publishEnabled=False)
+    if instances is not None:
+        regionIndex.record_scan('123456789012', 'eu-west-1', instances)
+        regionIndex.accounts['123456789012']['activity']['eu-west-1']['scannedAt'] -= scannedHoursAgo * 3600
+
+    return regionIndex
+
+def test_probe_is_due_for_unknown_populated_and_old_empty_regions(monkeypatch):
+    monkeypatch.setattr(report, 'ec2EmptyRegionProbeHours', 24)
+
+    assert get_region_index().is_probe_due('123456789012', 'eu-west-1')
+    assert get_region_index(3).is_probe_due('123456789012', 'eu-west-1')
+    assert not get_region_index(0, scannedHoursAgo=23).is_probe_due('123456789012', 'eu-west-1')
+    assert get_region_index(0, scannedHoursAgo=24).is_probe_due('123456789012', 'eu-west-1')
+    monkeypatch.setattr(report, 'ec2EmptyRegionProbeHours', 0)
+    assert get_region_index(0).is_probe_due('123456789012', 'eu-west-1')
+
+def test_empty_region_is_skipped_until_its_probe_is_due(regionScan):
+    ec2 = regionScan(['i-1'])
+    regionIndex = get_region_index(0, scannedHoursAgo=1)
+
+    assert report.scan_ec2_region_instances('123456789012', 'eu-west-1', regionIndex) == ([], 0.0)
+    assert ec2.calls == []
+    assert report.runMetrics.get_stage('ec2')['regionsSkipped'] == 1
+
+def test_empty_probe_is_a_single_small_call(regionScan):
+    ec2 = regionScan([])
+    regionIndex = get_region_index(0, scannedHoursAgo=48)
+    regionData, elapsed = report.scan_ec2_region_instances('123456789012', 'eu-west-1', regionIndex)
+
+    assert regionData == []
+    assert ec2.calls == [(report.ec2ProbeMaxResults, None)]
+    # The probe counts as a scan, so the Region is left alone for another EC2_EMPTY_REGION_PROBE_HOURS
+    assert not regionIndex.is_probe_due('123456789012', 'eu-west-1')
+
+def test_populated_probe_is_followed_by_a_full_scan(regionScan):
+    ec2 = regionScan([f'i-{i}' for i in range(7)])
+    regionIndex = get_region_index(0, scannedHoursAgo=48)
+    regionData, elapsed = report.scan_ec2_region_instances('123456789012', 'eu-west-1', regionIndex)
+
+    assert [record['InstanceId'] for record in regionData] == [f'i-{i}' for i in range(7)]
+    assert ec2.calls == [(report.ec2ProbeMaxResults, None), (2, None), (2, '2'), (2, '4'), (2, '6')]
+    assert regionIndex.get_activity('123456789012', 'eu-west-1')['instances'] == 7
+    assert report.runMetrics.get_stage('ec2')['regionsProbed'] == 1
+    assert report.runMetrics.get_stage('ec2')['regionsScanned'] == 1
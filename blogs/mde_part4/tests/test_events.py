@@ -0,0 +1,162 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+
+
+import gzip
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+import requests
+
+import report
+
+@pytest.fixture
+def publishedBucket(monkeypatch, fakeS3):
+    monkeypatch.setenv('QUICKSIGHT_S3_BUCKET_NAME', 'bucket')
+
+    return fakeS3
+
+@pytest.fixture
+def patchPublisher(monkeypatch, publishedBucket, tmp_path):
+    '''
+    Process-wide S3Publisher uploading into the FakeS3 bucket in the csv output format, QuickSight refreshes are recorded
+    '''
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(report, 'outputFormat', 'csv')
+    monkeypatch.setattr(report, 'partitionedOutput', False)
+    monkeypatch.setattr(report, 'runMetrics', report.RunMetrics())
+    publisher = report.S3Publisher('bucket', 'state.json')
+    monkeypatch.setattr(report, 's3Publisher', publisher)
+    refreshes = []
+    monkeypatch.setattr(report, 'refresh_quicksight_datasets', lambda fileNames, changedDatasets, groupName: refreshes.append((fileNames, changedDatasets)))
+    yield refreshes
+    publisher.shutdown_shard_pool()
+
+def get_mde_machine(machineId, healthStatus='Active', riskScore='Low'):
+    return {
+        'id': machineId, 'computerDnsName': f'{machineId}.corp', 'firstSeen': '2026-01-01T00:00:00Z', 'lastSeen': '2026-10-17T00:00:00Z',
+        'osPlatform': 'Ubuntu', 'healthStatus': healthStatus, 'riskScore': riskScore, 'exposureLevel': 'Medium', 'isAadJoined': False,
+        'machineTags': ['team-a'], 'rbacGroupId': 0, 'lastIpAddress': None
+    }
+
+class FakeMachineClient():
+    '''
+    Answers the single Machine calls of change events from a dict of raw Machines, unknown IDs get a 404
+    '''
+    def __init__(self, machines):
+        self.machines = machines
+
+    def get(self, url, params=None, latencies=None):
+        machineId = url.rsplit('/', 1)[1]
+        response = requests.Response()
+        if machineId not in self.machines:
+            response.status_code = 404
+            raise requests.exceptions.HTTPError('404 Error', response=response)
+        response.status_code = 200
+        response._content = json.dumps(self.machines[machineId]).encode('utf-8')
+
+        return response
+
+def publish_machines(machines):
+    report.get_s3_publisher().publish_dataset('processed_machines', [report.projectMachine(machine) for machine in machines])
+    report.get_s3_publisher().wait_for_uploads()
+    # Change events are handled by a later run, which starts from the content hashes this one saved
+    report.s3Publisher = report.S3Publisher('bucket', 'state.json')
+
+def put_published_dataset(s3, fileName, key, body):
+    manifest = {'fileLocations': [{'URIs': [f'https://bucket.s3.amazonaws.com/{key}']}]}
+    s3.put_object(Bucket='bucket', Key=f'quicksight/{fileName}_manifest.json', Body=json.dumps(manifest).encode('utf-8'))
+    s3.put_object(Bucket='bucket', Key=key, Body=body)
+
+def test_dataset_in_another_format_is_not_patched(monkeypatch, publishedBucket):
+    monkeypatch.setattr(report, 'outputFormat', 'json')
+    monkeypatch.setattr(report, 'partitionedOutput', False)
+    body = gzip.compress(b'id,computerDnsName\nm1,host1\n')
+    put_published_dataset(publishedBucket, 'processed_machines', 'quicksight/processed_machines.csv.gz', body)
+
+    with pytest.raises(RuntimeError, match='does not match OUTPUT_FORMAT json'):
+        report.read_published_dataset('processed_machines')
+
+    monkeypatch.setattr(report, 'outputFormat', 'csv')
+    assert report.read_published_dataset('processed_machines') == [{'id': 'm1', 'computerDnsName': 'host1'}]
+
+def test_partitioned_dataset_is_not_patched_into_a_single_object(monkeypatch, publishedBucket):
+    monkeypatch.setattr(report, 'outputFormat', 'json')
+    monkeypatch.setattr(report, 'partitionedOutput', False)
+    key = 'quicksight/partitioned/processed_machines/dt=2026-10-17/part-00000.json'
+    put_published_dataset(publishedBucket, 'processed_machines', key, b'[{"id": "m1"}]')
+
+    with pytest.raises(RuntimeError, match='PARTITIONED_OUTPUT false'):
+        report.read_published_dataset('processed_machines')
+
+def test_lambda_serializes_shards_inline(monkeypatch):
+    # Lambda has no /dev/shm, so a process pool cannot even be created there
+    monkeypatch.setenv('AWS_LAMBDA_FUNCTION_NAME', 'MDEonAWSPt4Blog-QuickSightReporter')
+    monkeypatch.setenv('PARTITION_WORKERS', '8')
+    result = subprocess.run(
+        [sys.executable, '-c', 'import report; print(report.partitionWorkers)'],
+        cwd=os.path.dirname(report.__file__), capture_output=True, text=True, check=True
+    )
+
+    assert result.stdout.strip() == '1'
+
+def test_unchanged_csv_dataset_round_trips_without_an_upload(patchPublisher, publishedBucket):
+    publish_machines([get_mde_machine('m1'), get_mde_machine('m2')])
+    publishedBucket.puts.clear()
+    report.patch_dataset('processed_machines', {})
+
+    # Read back from CSV and written again the dataset is byte for byte the same, so nothing is uploaded or refreshed
+    assert report.get_s3_publisher().wait_for_uploads() == set()
+    assert publishedBucket.puts == ['state.json']
+
+def test_patch_replaces_appends_and_drops_records(patchPublisher):
+    publish_machines([get_mde_machine('m1'), get_mde_machine('m2'), get_mde_machine('m3')])
+    report.patch_dataset('processed_machines', {
+        'm2': report.projectMachine(get_mde_machine('m2', riskScore='High')),
+        'm3': None,
+        'm4': report.projectMachine(get_mde_machine('m4'))
+    })
+
+    assert report.get_s3_publisher().wait_for_uploads() == {'processed_machines'}
+    records = report.read_published_dataset('processed_machines')
+    assert [(record['id'], record['riskScore']) for record in records] == [('m1', 'Low'), ('m2', 'High'), ('m4', 'Low')]
+    assert list(records[0]) == report.datasetColumns['processed_machines']
+
+def test_machine_change_events_patch_the_machines_dataset(monkeypatch, patchPublisher):
+    publish_machines([get_mde_machine('m1'), get_mde_machine('m2'), get_mde_machine('m3')])
+    monkeypatch.setattr(report, 'get_mde_client', lambda: FakeMachineClient({
+        'm1': get_mde_machine('m1', riskScore='High'),
+        'm2': get_mde_machine('m2', healthStatus='Inactive')
+    }))
+    changeEvents = [
+        {'detail-type': report.mdeMachineChangeDetailType, 'detail': {'machineIds': ['m1', 'm2']}},
+        # Offboarded, the API no longer knows the Machine
+        {'detail-type': report.mdeMachineChangeDetailType, 'detail': {'machineId': 'm3'}},
+        {'detail-type': 'Some Other Event', 'source': 'aws.s3'}
+    ]
+
+    assert report.apply_change_events(changeEvents) == ['processed_machines']
+    assert patchPublisher == [(['processed_machines'], {'processed_machines'})]
+    records = report.read_published_dataset('processed_machines')
+    assert [(record['id'], record['riskScore']) for record in records] == [('m1', 'High')]
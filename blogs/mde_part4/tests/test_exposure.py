@@ -0,0 +1,137 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+
+
+from concurrent.futures import Future
+
+import pytest
+
+import report
+from conftest import get_mde_vuln, read_json_dataset
+
+# One Machine per way a Machine can be tagged - with its Instance ID, without any tags, with tags but no Instance ID
+fleet = [
+    {'id': 'm-aws', 'instanceId': 'i-0123456789abcdef0'},
+    {'id': 'm-onprem', 'instanceId': 'NON_AWS'},
+    {'id': 'm-untagged', 'instanceId': None}
+]
+ec2Index = {
+    'i-0123456789abcdef0': {
+        'AccountId': '123456789012', 'Region': 'us-east-1', 'InstanceId': 'i-0123456789abcdef0', 'InstanceType': 't3.micro',
+        'State': 'running', 'IsPublic': True, 'PublicIpAddress': '203.0.113.10', 'PublicDnsName': None, 'VpcId': 'vpc-1',
+        'SubnetId': 'subnet-1', 'SecurityGroupId': 'sg-1', 'IamInstanceProfileArn': None, 'MetadataOptionsHttpTokens': 'optional'
+    }
+}
+
+def get_fleet_machines():
+    machines = []
+    for machine in fleet:
+        machineSummary = {field: f'{machine["id"]}-{field}' for field in report.exposureMachineFields}
+        machineSummary.update(machine, lastSeen='2026-10-17T00:00:00')
+        machines.append(machineSummary)
+
+    return machines
+
+@pytest.fixture
+def fleetVulns(monkeypatch, localPublisher):
+    '''
+    Serves two CVEs for every Machine of the fleet, the returned Future of the EC2 index is only resolved once every
+    vulnerability was handed out, like an EC2 stage which is slower than the vulnerability stage
+    '''
+    ec2IndexFuture = Future()
+    def iter_fleet_vulns(machineIds, client):
+        for machineId in machineIds:
+            for cveId in ('CVE-2026-0001', 'CVE-2026-0002'):
+                yield report.projectMachineVuln(get_mde_vuln(cveId), machineId)
+        if not ec2IndexFuture.done():
+            ec2IndexFuture.set_result(ec2Index)
+    monkeypatch.setattr(report, 'mdeVulnCollectionMode', 'machine')
+    monkeypatch.setattr(report, 'get_mde_client', lambda: None)
+    monkeypatch.setattr(report, 'iter_per_machine_vulns', iter_fleet_vulns)
+
+    return ec2IndexFuture
+
+def test_only_ec2_machines_are_buffered_while_ec2_runs(monkeypatch, fleetVulns):
+    joinedMachineIds = []
+    buildExposureRow = report.build_exposure_row
+    def spy_exposure_row(v, machineIndex, ec2Index):
+        # The EC2 index is only ready after the last vulnerability, so every row joined here was buffered
+        joinedMachineIds.append(v['vuln_MachineId'])
+        return buildExposureRow(v, machineIndex, ec2Index)
+    monkeypatch.setattr(report, 'build_exposure_row', spy_exposure_row)
+    report.get_machine_vulns(get_fleet_machines(), fleetVulns)
+
+    assert joinedMachineIds == ['m-aws', 'm-aws']
+    assert len(read_json_dataset('processed_machine_vulns')) == 6
+    exposureRows = read_json_dataset('processed_exposure')
+    assert [(row['machineId'], row['cveId']) for row in exposureRows] == [('m-aws', 'CVE-2026-0001'), ('m-aws', 'CVE-2026-0002')]
+
+def test_buffered_rows_match_a_join_against_a_ready_index(fleetVulns):
+    report.get_machine_vulns(get_fleet_machines(), fleetVulns)
+    bufferedRows = read_json_dataset('processed_exposure')
+
+    readyIndex = Future()
+    readyIndex.set_result(ec2Index)
+    report.get_machine_vulns(get_fleet_machines(), readyIndex)
+
+    assert read_json_dataset('processed_exposure') == bufferedRows
+
+def test_failed_ec2_stage_only_drops_the_exposure_dataset(monkeypatch, fleetVulns, tmp_path):
+    failedIndex = Future()
+    failedIndex.set_exception(RuntimeError('ec2 failed'))
+    report.get_machine_vulns(get_fleet_machines(), failedIndex)
+
+    assert len(read_json_dataset('processed_machine_vulns')) == 6
+    assert not (tmp_path / 'processed_exposure.json').exists()
+
+def get_machine_index():
+    return {machine['id']: machine for machine in get_fleet_machines()}
+
+def test_exposure_row_joins_instance_machine_and_vulnerability():
+    v = report.projectMachineVuln(get_mde_vuln('CVE-2026-0001', 'Critical'), 'm-aws')
+    exposureRow = report.build_exposure_row(v, get_machine_index(), ec2Index)
+
+    assert {field: exposureRow[field] for field in ec2Index['i-0123456789abcdef0']} == ec2Index['i-0123456789abcdef0']
+    assert exposureRow['machineId'] == 'm-aws'
+    assert exposureRow['computerDnsName'] == 'm-aws-computerDnsName'
+    assert exposureRow['cveId'] == 'CVE-2026-0001'
+    assert exposureRow['severity'] == 'Critical'
+    assert exposureRow['IsImdsV1'] is True
+    assert list(exposureRow) == report.datasetColumns['processed_exposure']
+    # The join builds a new row, the EC2 index is shared by every vulnerability of the Instance
+    assert 'cveId' not in ec2Index['i-0123456789abcdef0']
+
+def test_exposure_row_flags_only_optional_tokens_as_imdsv1():
+    v = report.projectMachineVuln(get_mde_vuln('CVE-2026-0001'), 'm-aws')
+    requiredIndex = {'i-0123456789abcdef0': dict(ec2Index['i-0123456789abcdef0'], MetadataOptionsHttpTokens='required')}
+
+    assert report.build_exposure_row(v, get_machine_index(), requiredIndex)['IsImdsV1'] is False
+
+@pytest.mark.parametrize('machineId', ['m-unknown', 'm-onprem', 'm-untagged'])
+def test_exposure_row_skips_machines_without_a_known_instance(machineId):
+    v = report.projectMachineVuln(get_mde_vuln('CVE-2026-0001'), machineId)
+
+    assert report.build_exposure_row(v, get_machine_index(), ec2Index) is None
+
+def test_exposure_row_skips_instances_missing_from_the_index():
+    v = report.projectMachineVuln(get_mde_vuln('CVE-2026-0001'), 'm-aws')
+
+    assert report.build_exposure_row(v, get_machine_index(), {}) is None
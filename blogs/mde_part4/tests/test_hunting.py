@@ -0,0 +1,92 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+
+import re
+import threading
+
+import pytest
+
+import report
+
+class FakeHuntingTable():
+    '''
+    Answers the sliced queries of a DeviceInfo table, hash(DeviceId, N) is the number in the Device ID modulo N. Like
+    Advanced Hunting a query returns at most maxRows rows and silently drops the rest
+    '''
+    def __init__(self, deviceCount, maxRows):
+        self.rows = [{'DeviceId': f'd{i}'} for i in range(deviceCount)]
+        self.maxRows = maxRows
+        self.queries = []
+        self.lock = threading.Lock()
+
+    def run_hunting_query(self, query, client, latencies=None):
+        chunk, chunkCount = re.search(r'hash\(DeviceId, (\d+)\) == (\d+)', query).group(2, 1)
+        with self.lock:
+            self.queries.append((int(chunk), int(chunkCount)))
+        rows = [row for row in self.rows if int(row['DeviceId'][1:]) % int(chunkCount) == int(chunk)]
+
+        return rows[:self.maxRows]
+
+@pytest.fixture
+def huntingTable(monkeypatch):
+    def use_table(deviceCount, maxRows):
+        table = FakeHuntingTable(deviceCount, maxRows)
+        monkeypatch.setattr(report, 'run_hunting_query', table.run_hunting_query)
+        monkeypatch.setattr(report, 'mdeHuntingMaxRows', maxRows)
+        monkeypatch.setattr(report, 'runMetrics', report.RunMetrics())
+        return table
+
+    return use_table
+
+def get_device_ids(rows):
+    return sorted(int(row['DeviceId'][1:]) for row in rows)
+
+def test_slice_under_the_row_limit_is_run_once(huntingTable):
+    table = huntingTable(8, 10)
+    rows = report.get_hunting_chunk('DeviceInfo {chunk}', 'DeviceId', 1, 4, None, [], 'machines')
+
+    assert get_device_ids(rows) == [1, 5]
+    assert table.queries == [(1, 4)]
+
+def test_truncated_slice_is_split_until_every_row_is_returned(huntingTable):
+    table = huntingTable(16, 2)
+    rows = report.get_hunting_chunk('DeviceInfo {chunk}', 'DeviceId', 1, 2, None, [], 'machines')
+
+    # Slice 1 of 2 has 8 rows and a query returns at most 2. Slices of 8 return exactly 2, which may be cut short, so it takes slices of 16
+    assert get_device_ids(rows) == [1, 3, 5, 7, 9, 11, 13, 15]
+    assert sorted(query for query in table.queries if query[1] == 8) == [(1, 8), (3, 8), (5, 8), (7, 8)]
+    assert len(table.queries) == 15
+    assert report.runMetrics.get_stage('machines')['huntingChunksSplit'] == 7
+
+def test_slice_which_cannot_be_split_further_fails(monkeypatch, huntingTable):
+    huntingTable(16, 2)
+    monkeypatch.setattr(report, 'mdeHuntingMaxChunkCount', 4)
+    with pytest.raises(ValueError):
+        report.get_hunting_chunk('DeviceInfo {chunk}', 'DeviceId', 0, 2, None, [], 'machines')
+
+def test_hunting_rows_cover_every_slice_once(monkeypatch, huntingTable):
+    monkeypatch.setitem(report.huntingQueries, 'machines', 'DeviceInfo {chunk}')
+    monkeypatch.setattr(report, 'mdeHuntingChunks', 4)
+    huntingTable(40, 4)
+    rows = list(report.iter_hunting_rows('machines', 'DeviceId', None, 'machines'))
+
+    assert get_device_ids(rows) == list(range(40))
+    assert report.runMetrics.get_stage('machines')['recordsIn'] == 40
@@ -0,0 +1,126 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+
+import pytest
+
+import report
+from conftest import get_mde_vuln
+
+stateKey = 'quicksight/state/mde_state.sqlite'
+
+def get_machine(machineId, lastSeen='2026-10-17T00:00:00', exposureLevel='Medium'):
+    return {'id': machineId, 'lastSeen': lastSeen, 'exposureLevel': exposureLevel}
+
+def get_vulns(machineId, cveIds):
+    return [report.projectMachineVuln(get_mde_vuln(cveId), machineId) for cveId in cveIds]
+
+@pytest.fixture
+def stateRun(fakeS3, tmp_path):
+    '''
+    Runs the incremental assembly once like get_machine_vulns does - loads the state from S3, refreshes the changed
+    Machines from fetchedVulns and saves the state back - returns the dataset rows, the refreshed IDs and the store
+    '''
+    def run(machines, fetchedVulns):
+        stateStore = report.MachineStateStore('bucket', stateKey, localPath=str(tmp_path / 'mde_state.sqlite'))
+        refreshIds = {machine['id'] for machine in machines if stateStore.needs_refresh(machine)}
+        freshVulns = [v for v in fetchedVulns if v['vuln_MachineId'] in refreshIds]
+        rows = list(report.iter_incremental_vulns(machines, iter(freshVulns), refreshIds, stateStore))
+        stateStore.prune({machine['id'] for machine in machines})
+        stateStore.save()
+
+        return rows, refreshIds, stateStore
+
+    return run
+
+def test_first_run_fetches_every_machine(stateRun, fakeS3):
+    machines = [get_machine('m1'), get_machine('m2'), get_machine('m3')]
+    fetchedVulns = get_vulns('m1', ['CVE-2026-0001']) + get_vulns('m3', ['CVE-2026-0002', 'CVE-2026-0003'])
+    rows, refreshIds, stateStore = stateRun(machines, fetchedVulns)
+
+    assert refreshIds == {'m1', 'm2', 'm3'}
+    assert rows == fetchedVulns
+    assert stateStore.changedHashes == 3
+    assert ('bucket', stateKey) in fakeS3.objects
+
+def test_unchanged_second_run_fetches_nothing(stateRun):
+    machines = [get_machine('m1'), get_machine('m2'), get_machine('m3')]
+    fetchedVulns = get_vulns('m1', ['CVE-2026-0001']) + get_vulns('m3', ['CVE-2026-0002', 'CVE-2026-0003'])
+    firstRows, _, _ = stateRun(machines, fetchedVulns)
+    rows, refreshIds, stateStore = stateRun(machines, [])
+
+    assert refreshIds == set()
+    assert rows == firstRows
+    assert stateStore.changedHashes == 0
+
+def test_only_changed_machines_are_refreshed(stateRun):
+    stateRun([get_machine('m1'), get_machine('m2')], get_vulns('m1', ['CVE-2026-0001']) + get_vulns('m2', ['CVE-2026-0002']))
+    machines = [get_machine('m1'), get_machine('m2', exposureLevel='High')]
+    rows, refreshIds, stateStore = stateRun(machines, get_vulns('m2', ['CVE-2026-0002', 'CVE-2026-0004']))
+
+    assert refreshIds == {'m2'}
+    assert rows == get_vulns('m1', ['CVE-2026-0001']) + get_vulns('m2', ['CVE-2026-0002', 'CVE-2026-0004'])
+    assert stateStore.changedHashes == 1
+
+def test_same_vulnerabilities_after_a_change_keep_their_hash(stateRun):
+    fetchedVulns = get_vulns('m1', ['CVE-2026-0001'])
+    stateRun([get_machine('m1')], fetchedVulns)
+    rows, refreshIds, stateStore = stateRun([get_machine('m1', lastSeen='2026-10-18T00:00:00')], fetchedVulns)
+
+    assert refreshIds == {'m1'}
+    assert rows == fetchedVulns
+    assert stateStore.changedHashes == 0
+
+def test_old_rows_are_refreshed_and_removed_machines_pruned(monkeypatch, stateRun, tmp_path):
+    stateRun([get_machine('m1'), get_machine('m2')], get_vulns('m1', ['CVE-2026-0001']))
+    monkeypatch.setattr(report, 'incrementalMaxAgeHours', -1)
+    rows, refreshIds, stateStore = stateRun([get_machine('m1')], get_vulns('m1', ['CVE-2026-0005']))
+
+    assert refreshIds == {'m1'}
+    assert rows == get_vulns('m1', ['CVE-2026-0005'])
+    monkeypatch.setattr(report, 'incrementalMaxAgeHours', 168)
+    stateStore = report.MachineStateStore('bucket', stateKey, localPath=str(tmp_path / 'mde_state.sqlite'))
+    assert stateStore.needs_refresh(get_machine('m2'))
+    assert not stateStore.needs_refresh(get_machine('m1'))
+    stateStore.close()
+
+def test_vulnerability_stage_skips_unchanged_machines(monkeypatch, fakeS3, localPublisher):
+    fetchedIds = []
+    def iter_machine_vulns(machineIds, client):
+        fetchedIds.append(list(machineIds))
+        for machineId in machineIds:
+            yield from get_vulns(machineId, ['CVE-2026-0001'])
+    monkeypatch.setenv('QUICKSIGHT_S3_BUCKET_NAME', 'bucket')
+    monkeypatch.setattr(report, 'incrementalMode', True)
+    monkeypatch.setattr(report, 'buildExposureDataset', False)
+    monkeypatch.setattr(report, 'mdeVulnCollectionMode', 'machine')
+    monkeypatch.setattr(report, 'get_mde_client', lambda: None)
+    monkeypatch.setattr(report, 'iter_per_machine_vulns', iter_machine_vulns)
+    # The state is only uploaded when the dataset is published, which the local publisher does not do on its own
+    monkeypatch.setattr(localPublisher, 'publishEnabled', True)
+    machines = [get_machine('m1'), get_machine('m2')]
+    report.get_machine_vulns(machines)
+    report.get_machine_vulns(machines)
+
+    localPublisher.wait_for_uploads()
+
+    assert fetchedIds == [['m1', 'm2'], []]
+    assert ('bucket', report.stateDbKey) in fakeS3.objects
+    assert ('bucket', 'quicksight/processed_machine_vulns.json') in fakeS3.objects
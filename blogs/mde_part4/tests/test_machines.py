@@ -0,0 +1,69 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+
+
+import pytest
+import requests
+
+import report
+
+class FakeMachinesClient():
+    '''
+    Answers the machines list call with one page, a $select is rejected with rejectStatus when one is set
+    '''
+    def __init__(self, rejectStatus=None):
+        self.rejectStatus = rejectStatus
+        self.calls = []
+
+    def get(self, url, params=None, latencies=None):
+        self.calls.append(dict(params or {}))
+        response = requests.Response()
+        if self.rejectStatus and '$select' in (params or {}):
+            response.status_code = self.rejectStatus
+            raise requests.exceptions.HTTPError(f'{self.rejectStatus} Error', response=response)
+        response.status_code = 200
+        response._content = b'{"value": [{"id": "m1", "healthStatus": "Active", "computerDnsName": "host1", "machineTags": []}]}'
+
+        return response
+
+def test_select_is_off_by_default():
+    client = FakeMachinesClient()
+    machines = list(report.iter_machines(client))
+
+    assert report.mdeMachinesSelect is False
+    assert [machine['id'] for machine in machines] == ['m1']
+    assert '$select' not in client.calls[0]
+
+def test_rejected_select_falls_back_to_the_whole_machines(monkeypatch):
+    monkeypatch.setattr(report, 'mdeMachinesSelect', True)
+    client = FakeMachinesClient(rejectStatus=400)
+    machines = list(report.iter_machines(client))
+
+    assert [machine['id'] for machine in machines] == ['m1']
+    assert ['$select' in params for params in client.calls] == [True, False]
+
+def test_other_errors_are_not_retried_without_select(monkeypatch):
+    monkeypatch.setattr(report, 'mdeMachinesSelect', True)
+    client = FakeMachinesClient(rejectStatus=403)
+    with pytest.raises(requests.exceptions.HTTPError):
+        list(report.iter_machines(client))
+
+    assert len(client.calls) == 1
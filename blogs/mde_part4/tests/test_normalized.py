@@ -0,0 +1,68 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+
+import pytest
+
+import report
+from conftest import get_mde_vuln, read_json_dataset
+
+# Two Machines sharing a CVE, so the catalog has to de-duplicate it
+machineCves = {
+    'm-1': ['CVE-2026-0001', 'CVE-2026-0002'],
+    'm-2': ['CVE-2026-0002', 'CVE-2026-0003']
+}
+
+@pytest.fixture
+def machineVulns(monkeypatch, localPublisher):
+    def iter_machine_vulns(machineIds, client):
+        for machineId in machineIds:
+            for cveId in machineCves[machineId]:
+                yield report.projectMachineVuln(get_mde_vuln(cveId), machineId)
+    monkeypatch.setattr(report, 'mdeVulnCollectionMode', 'machine')
+    monkeypatch.setattr(report, 'buildExposureDataset', False)
+    monkeypatch.setattr(report, 'get_mde_client', lambda: None)
+    monkeypatch.setattr(report, 'iter_per_machine_vulns', iter_machine_vulns)
+
+    return [{'id': machineId, 'lastSeen': '2026-10-17T00:00:00'} for machineId in machineCves]
+
+def test_normalized_pair_joins_back_to_denormalized_rows(monkeypatch, machineVulns):
+    monkeypatch.setattr(report, 'vulnDatasetLayout', 'both')
+    report.get_machine_vulns(machineVulns)
+
+    catalog = read_json_dataset('processed_vuln_catalog')
+    edges = read_json_dataset('processed_machine_vuln_edges')
+    assert sorted(entry['id'] for entry in catalog) == ['CVE-2026-0001', 'CVE-2026-0002', 'CVE-2026-0003']
+    assert all('vuln_MachineId' not in entry for entry in catalog)
+    assert [(edge['machineId'], edge['cveId']) for edge in edges] == [
+        (machineId, cveId) for machineId, cveIds in machineCves.items() for cveId in cveIds
+    ]
+
+    catalogIndex = {entry['id']: entry for entry in catalog}
+    joinedRows = [dict(catalogIndex[edge['cveId']], vuln_MachineId=edge['machineId']) for edge in edges]
+    assert joinedRows == read_json_dataset('processed_machine_vulns')
+
+def test_normalized_layout_skips_denormalized_dataset(monkeypatch, machineVulns, tmp_path):
+    monkeypatch.setattr(report, 'vulnDatasetLayout', 'normalized')
+    report.get_machine_vulns(machineVulns)
+
+    assert not (tmp_path / 'processed_machine_vulns.json').exists()
+    assert len(read_json_dataset('processed_machine_vuln_edges')) == 4
+    assert len(read_json_dataset('processed_vuln_catalog')) == 3
@@ -0,0 +1,80 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+
+
+import glob
+import json
+import os
+
+import pytest
+
+import report
+
+def get_instances(count):
+    return [
+        {'AccountId': '123456789012', 'Region': 'us-east-1', 'InstanceId': f'i-{n:08x}', 'InstanceType': 't3.micro'}
+        for n in range(count)
+    ]
+
+def read_shards(localDir):
+    records = []
+    for shardPath in sorted(glob.glob(os.path.join(localDir, '**', '*.json'), recursive=True)):
+        with open(shardPath) as f:
+            records.extend(json.load(f))
+
+    return records
+
+@pytest.mark.parametrize('copyRecords', [False, True])
+def test_write_shard_stamps_the_snapshot_date(tmp_path, copyRecords):
+    records = get_instances(3)
+    localPath = str(tmp_path / 'shard' / 'part-00000.json')
+    recordCount, byteCount, contentHash = report.write_shard(
+        records, localPath, 'processed_ec2_instances', 'json', report.get_dataset_columns('processed_ec2_instances'),
+        '2026-10-17', copyRecords=copyRecords
+    )
+
+    assert recordCount == 3
+    assert byteCount == os.path.getsize(localPath)
+    assert contentHash == report.get_file_sha256(localPath)
+    assert [record[report.snapshotColumn] for record in read_shards(str(tmp_path))] == ['2026-10-17'] * 3
+    # Only the worker process path may stamp the records it was handed
+    assert all((report.snapshotColumn in record) != copyRecords for record in records)
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_partitioned_sink_leaves_the_callers_records_alone(tmp_path, monkeypatch, workers):
+    monkeypatch.setattr(report, 'outputFormat', 'json')
+    monkeypatch.setattr(report, 'partitionWorkers', workers)
+    monkeypatch.setattr(report, 'partitionShardRecords', 4)
+    monkeypatch.setattr(report, 'partitionedLocalDir', str(tmp_path))
+    publisher = report.S3Publisher('bucket', 'state.json', publishEnabled=False)
+    records = get_instances(10)
+    try:
+        sink = report.PartitionedDatasetSink(publisher, 'processed_ec2_instances')
+        for record in records:
+            sink.write(record)
+        assert sink.close() == 10
+    finally:
+        publisher.shutdown_shard_pool()
+
+    assert records == get_instances(10)
+    shardRecords = read_shards(str(tmp_path))
+    assert [record['InstanceId'] for record in shardRecords] == [record['InstanceId'] for record in records]
+    assert {record[report.snapshotColumn] for record in shardRecords} == {report.get_partition_day()}
@@ -0,0 +1,70 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+
+import pytest
+
+import report
+
+spec = [
+    ('id', 'id', 'str'),
+    ('name', 'name', 'str'),
+    ('score', 'details.score')
+]
+
+def make_records():
+    return [
+        {'id': 1, 'name': 'a', 'details': {'score': 1}},
+        {'id': 2, 'name': 'b', 'details': {'score': 2}},
+        # Missing a field, so the batch falls back to the safe path
+        {'id': 3, 'details': {'score': 3}},
+        {'id': 4, 'name': 'd', 'details': {'score': 4}}
+    ]
+
+def test_batch_projects_a_list():
+    _, projectBatch = report.compile_projection(spec)
+    records = projectBatch(make_records())
+
+    assert [r['id'] for r in records] == ['1', '2', '3', '4']
+    assert records[2]['name'] is None
+
+def test_batch_projects_a_generator_with_a_missing_field():
+    _, projectBatch = report.compile_projection(spec)
+    records = projectBatch(iter(make_records()))
+
+    assert [r['id'] for r in records] == ['1', '2', '3', '4']
+    assert records[2]['name'] is None
+    assert records[3]['score'] == 4
+
+def test_batch_does_not_swallow_generator_errors():
+    _, projectBatch = report.compile_projection(spec)
+    def pages():
+        yield from make_records()[:2]
+        # Like a page without 'value' in get_mde_pages
+        raise KeyError('value')
+
+    with pytest.raises(KeyError):
+        projectBatch(pages())
+
+def test_arguments_are_passed_through():
+    project, projectBatch = report.compile_projection([('id', 'id'), ('machineId', '$machineId')], ('machineId',))
+
+    assert project({'id': 1}, 'm1') == {'id': 1, 'machineId': 'm1'}
+    assert projectBatch(iter([{'id': 1}, {}]), 'm1') == [{'id': 1, 'machineId': 'm1'}, {'id': None, 'machineId': 'm1'}]
@@ -0,0 +1,101 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+
+
+import pytest
+
+import report
+
+class FakeClock():
+    '''
+    Stands in for the time module in report, sleeping just moves the clock forward (rounded, so a call reserved for an
+    exact time goes out at that time rather than a float rounding error before it)
+    '''
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now = round(self.now + seconds, 6)
+
+@pytest.fixture
+def clock(monkeypatch):
+    fakeClock = FakeClock()
+    monkeypatch.setattr(report, 'time', fakeClock)
+
+    return fakeClock
+
+def make_calls(limiter, clock, seconds):
+    '''
+    Calls the limiter back to back for the given number of seconds, returns the times the calls went out at
+    '''
+    callTimes = []
+    start = clock.now
+    while True:
+        limiter.wait()
+        if clock.now >= start + seconds:
+            return callTimes
+        callTimes.append(clock.now)
+
+def max_calls_in_window(callTimes, windowSeconds):
+    first = 0
+    maxCalls = 0
+    for last, callTime in enumerate(callTimes):
+        while callTimes[first] + windowSeconds <= callTime:
+            first += 1
+        maxCalls = max(maxCalls, last - first + 1)
+
+    return maxCalls
+
+def test_hourly_quota_is_fully_used(clock):
+    limiter = report.RateLimiter(50, 1500, 10)
+    callTimes = make_calls(limiter, clock, 3 * 3600)
+
+    assert len(callTimes) == 3 * 1500
+    assert max_calls_in_window(callTimes, 3600) == 1500
+
+def test_per_minute_rate_and_burst_are_honoured(clock):
+    limiter = report.RateLimiter(50, 0, 10)
+    callTimes = make_calls(limiter, clock, 600)
+
+    assert max_calls_in_window(callTimes, 60) <= 50 + 10
+    assert len(callTimes) == pytest.approx(10 + 50 * 10, abs=1)
+    assert callTimes[9] == callTimes[0]
+
+def test_pause_holds_every_caller(clock):
+    limiter = report.RateLimiter(6000, 0, 10)
+    limiter.pause(30)
+
+    assert limiter.wait() == pytest.approx(30)
+    assert limiter.waitedSeconds == pytest.approx(30)
+
+def test_hunting_queries_use_their_own_limiter(monkeypatch):
+    client = report.MdeClient()
+    requests = []
+    monkeypatch.setattr(client, 'request', lambda method, url, **kwargs: requests.append(kwargs['limiter']) or None)
+    with pytest.raises(AttributeError):
+        report.run_hunting_query('DeviceInfo', client)
+
+    assert requests == [client.huntingLimiter]
+    assert client.huntingLimiter is not client.limiter
+    assert client.huntingLimiter.bucket.refillPerSecond == pytest.approx(45 / 60.0)
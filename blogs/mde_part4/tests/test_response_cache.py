@@ -0,0 +1,142 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+
+
+import json
+import time
+
+import pytest
+import requests
+
+import report
+
+class FakeMdeSession():
+    '''
+    Stands in for the requests Session of an MdeClient. Every call returns the current body with its ETag, or a 304
+    when the caller already has that ETag
+    '''
+    def __init__(self, body):
+        self.body = body
+        self.requests = []
+
+    def get_etag(self):
+        return f'"{json.dumps(self.body, sort_keys=True)}"'
+
+    def request(self, method, url, headers=None, **kwargs):
+        self.requests.append(headers)
+        response = requests.Response()
+        if headers.get('If-None-Match') == self.get_etag():
+            response.status_code = 304
+            return response
+        response.status_code = 200
+        response.headers['ETag'] = self.get_etag()
+        response._content = json.dumps(self.body).encode('utf-8')
+
+        return response
+
+def use_cache(monkeypatch, tmp_path, mode, ttlSeconds=3600):
+    cache = report.ResponseCache(str(tmp_path / 'cache'), mode, ttlSeconds, 1024 * 1024)
+    monkeypatch.setattr(report, 'responseCache', cache)
+
+    return cache
+
+def get_client(tenantId, body):
+    # The token is already there and the tenant ID already resolved, so nothing is read from SSM or Azure AD
+    client = report.MdeClient()
+    client.token = 'token'
+    client.tokenExpiresOn = time.time() + 3600
+    client.tenantId = tenantId
+    client.session = FakeMdeSession(body)
+
+    return client
+
+@pytest.fixture(autouse=True)
+def tenantParameter(monkeypatch):
+    monkeypatch.setenv('AZURE_APP_TENANT_ID_PARAM', 'MDE-AWSAutomation-App-DirectoryID')
+
+def test_fresh_entries_are_served_without_a_call(monkeypatch, tmp_path):
+    cache = use_cache(monkeypatch, tmp_path, 'record')
+    client = get_client('tenant-a', {'value': [1]})
+    client.get('https://mde/api/machines')
+    client.session.body = {'value': [2]}
+
+    assert client.get('https://mde/api/machines').json() == {'value': [1]}
+    assert len(client.session.requests) == 1
+    assert cache.get_stats()['hits'] == 1
+
+def test_expired_entries_are_revalidated_with_their_etag(monkeypatch, tmp_path):
+    cache = use_cache(monkeypatch, tmp_path, 'record', ttlSeconds=0)
+    client = get_client('tenant-a', {'value': [1]})
+    client.get('https://mde/api/machines')
+
+    assert client.get('https://mde/api/machines').json() == {'value': [1]}
+    assert client.session.requests[1]['If-None-Match'] == client.session.get_etag()
+    assert cache.get_stats()['revalidated'] == 1
+
+    # A changed response replaces the expired entry
+    client.session.body = {'value': [2]}
+    assert client.get('https://mde/api/machines').json() == {'value': [2]}
+
+def test_tenants_sharing_a_parameter_name_are_kept_apart(monkeypatch, tmp_path):
+    use_cache(monkeypatch, tmp_path, 'record')
+    get_client('tenant-a', {'value': ['a']}).get('https://mde/api/machines')
+    otherTenant = get_client('tenant-b', {'value': ['b']})
+
+    assert otherTenant.get('https://mde/api/machines').json() == {'value': ['b']}
+    assert len(otherTenant.session.requests) == 1
+
+def test_replay_serves_expired_entries_and_fails_on_a_miss(monkeypatch, tmp_path):
+    use_cache(monkeypatch, tmp_path, 'record', ttlSeconds=0)
+    get_client('tenant-a', {'value': [1]}).get('https://mde/api/machines')
+    use_cache(monkeypatch, tmp_path, 'replay', ttlSeconds=0)
+    client = get_client('tenant-a', {'value': [2]})
+
+    assert client.get('https://mde/api/machines').json() == {'value': [1]}
+    with pytest.raises(report.ResponseCacheMiss):
+        client.get('https://mde/api/vulnerabilities')
+    assert client.session.requests == []
+
+def test_replay_only_reads_the_tenant_id_parameter(monkeypatch, tmp_path):
+    use_cache(monkeypatch, tmp_path, 'replay')
+    parameterCalls = []
+    class FakeSsm():
+        def get_parameters(self, Names, WithDecryption):
+            parameterCalls.append(Names)
+            return {'Parameters': [{'Name': Names[0], 'Value': 'tenant-a'}], 'InvalidParameters': []}
+    monkeypatch.setattr(report.boto3, 'client', lambda service, **kwargs: FakeSsm())
+    monkeypatch.setattr(report, 'instrument_aws_client', lambda client: client)
+    client = report.MdeClient()
+    monkeypatch.setattr(client, 'get_credentials', lambda: pytest.fail('the client secret is not needed for a replay'))
+
+    assert client.get_tenant_id() == 'tenant-a'
+    assert parameterCalls == [['MDE-AWSAutomation-App-DirectoryID']]
+
+def test_aws_calls_are_replayed_with_their_types(monkeypatch, tmp_path):
+    use_cache(monkeypatch, tmp_path, 'record')
+    launchTime = report.datetime.datetime(2026, 10, 17, tzinfo=report.datetime.timezone.utc)
+    class FakeEc2():
+        def describe_instances(self, **params):
+            return {'Reservations': [{'Instances': [{'InstanceId': 'i-1', 'LaunchTime': launchTime}]}], 'ResponseMetadata': {}}
+    report.get_response_cache().aws_call(FakeEc2, 'describe_instances', ['123456789012', 'us-east-1'], MaxResults=5)
+    use_cache(monkeypatch, tmp_path, 'replay')
+    page = report.get_response_cache().aws_call(lambda: pytest.fail('replay called AWS'), 'describe_instances', ['123456789012', 'us-east-1'], MaxResults=5)
+
+    assert page == {'Reservations': [{'Instances': [{'InstanceId': 'i-1', 'LaunchTime': launchTime}]}]}
@@ -0,0 +1,66 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+
+import json
+import time
+
+import pytest
+
+import report
+
+@pytest.fixture(autouse=True)
+def fastPolling(monkeypatch):
+    monkeypatch.setattr(report, 'runLockPollSeconds', 0.01)
+
+def test_only_one_run_holds_the_lock(fakeS3):
+    with report.RunLock('bucket', 'run.lock', 0):
+        with pytest.raises(RuntimeError, match='is held by'):
+            report.RunLock('bucket', 'run.lock', 0.05).acquire()
+    assert ('bucket', 'run.lock') not in fakeS3.objects
+
+    # Released, so the next run gets it straight away
+    with report.RunLock('bucket', 'run.lock', 0):
+        assert ('bucket', 'run.lock') in fakeS3.objects
+
+def test_expired_lease_is_taken_over(fakeS3):
+    fakeS3.objects[('bucket', 'run.lock')] = json.dumps({'owner': 'dead-run', 'expiresAt': time.time() - 1}).encode('utf-8')
+    lock = report.RunLock('bucket', 'run.lock', 0)
+    lock.acquire()
+
+    assert json.loads(fakeS3.objects[('bucket', 'run.lock')])['owner'] == lock.owner
+    lock.release()
+    assert ('bucket', 'run.lock') not in fakeS3.objects
+
+def test_lease_taken_over_by_another_run_is_not_released(fakeS3):
+    lock = report.RunLock('bucket', 'run.lock', 0)
+    lock.acquire()
+    # Our lease expired and another run took it over
+    fakeS3.objects[('bucket', 'run.lock')] = json.dumps({'owner': 'next-run', 'expiresAt': time.time() + 60}).encode('utf-8')
+    lock.release()
+
+    assert json.loads(fakeS3.objects[('bucket', 'run.lock')])['owner'] == 'next-run'
+
+def test_nothing_is_locked_without_publishing(monkeypatch, fakeS3):
+    monkeypatch.setattr(report, 'publishEnabled', False)
+    with report.hold_run_lock():
+        pass
+
+    assert fakeS3.puts == []
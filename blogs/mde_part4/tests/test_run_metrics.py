@@ -0,0 +1,52 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+
+
+import json
+
+import pytest
+
+import report
+
+def test_stage_reports_the_process_peak_rss():
+    runMetrics = report.RunMetrics()
+    with runMetrics.stage('ec2'):
+        runMetrics.count('ec2', 'recordsIn', 3)
+    with pytest.raises(RuntimeError):
+        with runMetrics.stage('vulns'):
+            raise RuntimeError('vulns failed')
+
+    stages = runMetrics.to_dict()['stages']
+    assert stages['ec2']['status'] == 'succeeded'
+    assert stages['ec2']['recordsIn'] == 3
+    assert stages['vulns']['status'] == 'failed'
+    # A high-water mark of the whole process, so a stage finishing later never reports less
+    assert 0 < stages['ec2']['processPeakRssMb'] <= stages['vulns']['processPeakRssMb']
+
+def test_emf_lines_name_the_process_peak_rss():
+    runMetrics = report.RunMetrics()
+    with runMetrics.stage('machines'):
+        pass
+    stageLine = json.loads(runMetrics.get_emf_lines('MDEReporter')[0])
+
+    metricNames = [metric['Name'] for metric in stageLine['_aws']['CloudWatchMetrics'][0]['Metrics']]
+    assert 'ProcessPeakRssMb' in metricNames and 'PeakRssMb' not in metricNames
+    assert stageLine['ProcessPeakRssMb'] == runMetrics.to_dict()['stages']['machines']['processPeakRssMb']
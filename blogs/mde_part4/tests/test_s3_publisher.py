@@ -0,0 +1,110 @@
+#This file is part of Lightspin EKS Creation Engine.
+#SPDX-License-Identifier: Apache-2.0
+
+#Licensed to the Apache Software Foundation (ASF) under one
+#or more contributor license agreements.  See the NOTICE file
+#distributed with this work for additional information
+#regarding copyright ownership.  The ASF licenses this file
+#to you under the Apache License, Version 2.0 (the
+#"License"); you may not use this file except in compliance
+#with the License.  You may obtain a copy of the License at
+
+#http://www.apache.org/licenses/LICENSE-2.0
+
+#Unless required by applicable law or agreed to in writing,
+#software distributed under the License is distributed on an
+#"AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#KIND, either express or implied.  See the License for the
+#specific language governing permissions and limitations
+#under the License.
+
+
+import datetime
+import json
+
+import pytest
+
+import report
+
+class FakeQuickSight():
+    '''
+    Answers the ingestion calls of an existing Data Set, the last ingestion has the given status
+    '''
+    def __init__(self, lastStatus):
+        self.lastStatus = lastStatus
+        self.ingestionsStarted = []
+
+    def list_ingestions(self, AwsAccountId, DataSetId, **kwargs):
+        if self.lastStatus is None:
+            return {'Ingestions': []}
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return {
+            'Ingestions': [
+                {'IngestionId': 'older', 'IngestionStatus': 'COMPLETED', 'CreatedTime': now - datetime.timedelta(days=1)},
+                {'IngestionId': 'latest', 'IngestionStatus': self.lastStatus, 'CreatedTime': now}
+            ]
+        }
+
+    def create_ingestion(self, AwsAccountId, DataSetId, IngestionId, IngestionType):
+        self.ingestionsStarted.append(IngestionId)
+
+    def describe_ingestion(self, AwsAccountId, DataSetId, IngestionId):
+        return {'Ingestion': {'IngestionId': IngestionId, 'IngestionStatus': 'COMPLETED', 'IngestionTimeInSeconds': 1}}
+
+@pytest.fixture
+def quicksightEnv(monkeypatch):
+    monkeypatch.setenv('QUICKSIGHT_S3_BUCKET_NAME', 'bucket')
+    monkeypatch.setattr(report, 'get_aws_account_id', lambda: '123456789012')
+    monkeypatch.setattr(report, 'quicksightPollSeconds', 0)
+
+def test_unchanged_objects_are_skipped(fakeS3):
+    publisher = report.S3Publisher('bucket', 'state.json')
+
+    assert publisher.put_object('quicksight/a.json', b'[1]')
+    assert not publisher.put_object('quicksight/a.json', b'[1]')
+    assert publisher.put_object('quicksight/a.json', b'[2]')
+    assert fakeS3.puts == ['quicksight/a.json', 'quicksight/a.json']
+
+def test_hashes_carry_over_to_the_next_run(fakeS3):
+    publisher = report.S3Publisher('bucket', 'state.json')
+    publisher.put_object('quicksight/a.json', b'[1]')
+    publisher.wait_for_uploads()
+    assert json.loads(fakeS3.objects[('bucket', 'state.json')]) == publisher.publishedHashes
+
+    nextPublisher = report.S3Publisher('bucket', 'state.json')
+    assert not nextPublisher.put_object('quicksight/a.json', b'[1]')
+    assert nextPublisher.put_object('quicksight/b.json', b'[1]')
+
+def test_nothing_is_read_or_written_without_publishing(fakeS3):
+    publisher = report.S3Publisher('bucket', 'state.json', publishEnabled=False)
+    publisher.wait_for_uploads()
+
+    assert publisher.publishedHashes == {}
+    assert fakeS3.puts == []
+
+@pytest.mark.parametrize('lastStatus, refreshed', [
+    ('COMPLETED', False),
+    ('RUNNING', False),
+    ('FAILED', True),
+    ('CANCELLED', True),
+    (None, False)
+])
+def test_unchanged_dataset_is_ingested_again_after_a_failed_ingestion(quicksightEnv, lastStatus, refreshed):
+    quicksight = FakeQuickSight(lastStatus)
+    dataSetId = report.quicksightDataSetNames['processed_machines']
+    result = report.refresh_quicksight_dataset(
+        quicksight, 'processed_machines', False, {dataSetId: 'arn:data-source'}, {dataSetId}, 'arn:group'
+    )
+
+    assert bool(quicksight.ingestionsStarted) == refreshed
+    assert (result is not None) == refreshed
+
+def test_changed_dataset_is_always_ingested(quicksightEnv):
+    quicksight = FakeQuickSight('COMPLETED')
+    dataSetId = report.quicksightDataSetNames['processed_machines']
+    result = report.refresh_quicksight_dataset(
+        quicksight, 'processed_machines', True, {dataSetId: 'arn:data-source'}, {dataSetId}, 'arn:group'
+    )
+
+    assert len(quicksight.ingestionsStarted) == 1
+    assert result['status'] == 'COMPLETED'